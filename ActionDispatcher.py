@@ -0,0 +1,134 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+
+
+class ActionDispatcher():
+    """
+    Runs votes and comments on detected reposts in the background so a slow Imgur call doesn't hold up detection.
+
+    Actions are stored in a SQLite file so nothing is lost on a restart.  An action already queued for an image isn't
+    queued again.  Finished actions are deleted so the file only holds outstanding and failed ones.  An image is only
+    checked once since its id is marked as seen, so it isn't detected again later.  Failed actions are retried with
+    exponential backoff and given up on after max_attempts.  Every attempt takes a token from the request scheduler.
+    The first attempt runs at live priority and retries only use spare budget.
+    """
+
+    def __init__(self, path, perform, scheduler, workers=2, max_attempts=8, base_delay=30, max_delay=3600):
+        """
+        :param path: SQLite file to keep the queue in
+        :param perform: Function taking (action, image_id, payload).  Raises on failure
+        :param scheduler: RequestScheduler the API budget comes from
+        """
+
+        self.perform = perform
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.condition = threading.Condition()
+        self.in_flight = set()  # Row ids being worked on
+        self.completed = 0
+        self.given_up = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS actions (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            'action TEXT NOT NULL, image_id TEXT NOT NULL, payload TEXT, attempts INTEGER DEFAULT 0, '
+                            "next_attempt REAL NOT NULL, last_error TEXT, status TEXT DEFAULT 'pending', "
+                            'UNIQUE (action, image_id))')
+            # Workers look up the next due action on every claim
+            self.db.execute('CREATE INDEX IF NOT EXISTS actions_due ON actions (status, next_attempt)')
+            # Older versions kept finished actions
+            self.db.execute("DELETE FROM actions WHERE status = 'done'")
+
+        pending = self.pending()
+        if pending:
+            print('Resuming {} Queued Votes And Comments'.format(pending))
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name='ActionWorker-{}'.format(i), daemon=True).start()
+
+    def submit(self, action, image_id, payload=None):
+        """
+        Queue an action.  Ignored if the same action has already been queued for this image
+        :param action: downvote or comment
+        :param payload: Anything JSON serializable the action needs
+        :return: True if queued, False if it was a duplicate
+        """
+
+        with self.condition:
+            with self.db:
+                cursor = self.db.execute('INSERT OR IGNORE INTO actions (action, image_id, payload, next_attempt) '
+                                         'VALUES (?, ?, ?, ?)', (action, image_id, json.dumps(payload), time.time()))
+            self.condition.notify()
+            return cursor.rowcount == 1
+
+    def pending(self):
+        with self.condition:
+            return self.db.execute("SELECT COUNT(*) FROM actions WHERE status = 'pending'").fetchone()[0]
+
+    def failed(self):
+        with self.condition:
+            return self.db.execute("SELECT COUNT(*) FROM actions WHERE status = 'failed'").fetchone()[0]
+
+    def _claim(self):
+        """
+        Take the next action that is due.  Blocks until there is one
+        :return: Tuple of (id, action, image_id, payload, attempts)
+        """
+
+        with self.condition:
+            while True:
+                placeholders = ','.join('?' * len(self.in_flight))
+                row = self.db.execute('SELECT id, action, image_id, payload, attempts, next_attempt FROM actions '
+                                      "WHERE status = 'pending' AND id NOT IN ({}) ORDER BY next_attempt LIMIT 1"
+                                      .format(placeholders), tuple(self.in_flight)).fetchone()
+
+                if row and row[5] <= time.time():
+                    self.in_flight.add(row[0])
+                    return row[0], row[1], row[2], json.loads(row[3]), row[4]
+
+                # Sleep until the next action is due or a new one is submitted
+                self.condition.wait(min(row[5] - time.time(), 5) if row else 5)
+
+    def _worker(self):
+        while True:
+            action_id, action, image_id, payload, attempts = self._claim()
+            self.scheduler.acquire('live' if not attempts else 'retry')
+
+            try:
+                self.perform(action, image_id, payload)
+            except Exception as e:
+                self._failed(action_id, action, image_id, attempts + 1, e)
+            else:
+                with self.condition:
+                    with self.db:
+                        self.db.execute('DELETE FROM actions WHERE id = ?', (action_id,))
+                    self.completed += 1
+            finally:
+                with self.condition:
+                    self.in_flight.discard(action_id)
+                    self.condition.notify()
+
+    def _failed(self, action_id, action, image_id, attempts, error):
+
+        give_up = attempts >= self.max_attempts
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay) * random.uniform(0.8, 1.2)
+
+        with self.condition:
+            with self.db:
+                self.db.execute('UPDATE actions SET attempts = ?, next_attempt = ?, last_error = ?, status = ? '
+                                'WHERE id = ?', (attempts, time.time() + delay, str(error),
+                                                 'failed' if give_up else 'pending', action_id))
+            if give_up:
+                self.given_up += 1
+
+        if give_up:
+            print('[!] Giving Up On {} For {} After {} Attempts: {}'.format(action.title(), image_id, attempts, error))
+        else:
+            print('[!] {} For {} Failed.  Retrying In {} Seconds: {}'.format(action.title(), image_id, round(delay),
+                                                                            error))
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+
+class BackfillCheckpoint():
+    """
+    Record of which backfill pages have been completed so a restart picks up where the last run stopped.
+
+    Saved as JSON after every page.  The file is written to a temp file and swapped in so a crash mid write can't
+    corrupt it.  A checkpoint is only reused if it was made for the same start page and depth.
+    """
+
+    def __init__(self, path, start_page, depth):
+
+        self.path = path
+        self.start_page = start_page
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.skipped = 0  # Pages whose images had all been seen already
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get('start_page') != self.start_page or data.get('depth') != self.depth:
+            print('[!] Backfill Checkpoint Is For A Different Start Page Or Depth.  Starting Over')
+            return
+
+        self.completed = set(data.get('completed', []))
+        self.skipped = data.get('skipped', 0)
+        print('Resuming Backfill.  {} Of {} Pages Already Done'.format(len(self.completed), self.depth))
+
+    @property
+    def pages(self):
+        return range(self.start_page, self.start_page + self.depth)
+
+    def remaining(self):
+        """
+        Pages still to do, lowest first
+        """
+        return [page for page in self.pages if page not in self.completed]
+
+    def mark_done(self, page, all_seen=False):
+        """
+        Record a finished page and save the checkpoint
+        :param all_seen: Every image on the page was already in the database
+        """
+        with self.lock:
+            self.completed.add(page)
+            if all_seen:
+                self.skipped += 1
+            self._save()
+
+    def _save(self):
+        data = {'start_page': self.start_page, 'depth': self.depth, 'completed': sorted(self.completed),
+                'skipped': self.skipped}
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_file, self.path)
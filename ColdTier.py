@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from HashAlgorithms import DHASH_KEYS
+from HashMatrix import WORDS_PER_HASH, hash_to_words, matching_rows
+from Profiling import worker_profiled
+
+
+class ColdTier():
+    """
+    Append only on disk store for older hashes that have been demoted out of the in memory hot tier.
+
+    Each hash size is a flat file of packed uint64 rows that pool workers memory map and search in place.  A row mask
+    marks which hash sizes each row actually has.  Records are stored as JSON lines with a table of byte offsets so
+    only matched records are ever read back.  ids.txt is written last on every append and holds the IDs of all rows
+    so we know what has already been demoted.
+
+    The hash keys stored are fixed when the tier is created and kept in keys.json.  Hash keys added to the bot later
+    aren't searched in the cold tier.
+    """
+
+    def __init__(self, path, hash_keys=DHASH_KEYS):
+
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.ids = []
+        if os.path.isfile(self._file('ids.txt')):
+            with open(self._file('ids.txt')) as f:
+                self.ids = f.read().split('\n')[:-1]
+
+        self.hash_keys = self._load_keys(list(hash_keys))
+
+        self.rows = self._repair()
+        self.ids = self.ids[:self.rows]
+        self._id_set = set(self.ids)
+
+    def __len__(self):
+        return self.rows
+
+    def __contains__(self, image_id):
+        return image_id in self._id_set
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load_keys(self, hash_keys):
+        if os.path.isfile(self._file('keys.json')):
+            with open(self._file('keys.json')) as f:
+                return json.load(f)
+
+        if self.ids:
+            # Made before keys.json existed.  Only ever had the dhash keys
+            hash_keys = list(DHASH_KEYS)
+
+        with open(self._file('keys.json'), 'w') as f:
+            json.dump(hash_keys, f)
+        return hash_keys
+
+    def hash_file(self, hash_key):
+        return self._file('{}.bin'.format(hash_key))
+
+    def valid_file(self):
+        return self._file('valid.bin')
+
+    def _size(self, name):
+        return os.path.getsize(self._file(name)) if os.path.isfile(self._file(name)) else 0
+
+    def _repair(self):
+        """
+        Work out how many complete rows are on disk and cut off anything left over from an interrupted append
+        """
+
+        counts = [len(self.ids), self._size('offsets.bin') // 8, self._size('valid.bin') // len(self.hash_keys)]
+        counts += [self._size('{}.bin'.format(k)) // (WORDS_PER_HASH[k] * 8) for k in self.hash_keys]
+        rows = min(counts)
+
+        offsets = np.fromfile(self._file('offsets.bin'), dtype=np.uint64) if rows else np.empty(0, dtype=np.uint64)
+        records_end = 0
+        if rows:
+            with open(self._file('records.jsonl'), 'rb') as f:
+                f.seek(int(offsets[rows - 1]))
+                f.readline()
+                records_end = f.tell()
+
+        truncate = {'offsets.bin': rows * 8, 'valid.bin': rows * len(self.hash_keys), 'records.jsonl': records_end}
+        truncate.update({'{}.bin'.format(k): rows * WORDS_PER_HASH[k] * 8 for k in self.hash_keys})
+        for name, size in truncate.items():
+            with open(self._file(name), 'ab') as f:
+                f.truncate(size)
+
+        if len(self.ids) > rows:
+            with open(self._file('ids.txt'), 'w') as f:
+                f.write(''.join(i + '\n' for i in self.ids[:rows]))
+
+        return rows
+
+    def append(self, records):
+        """
+        Add demoted records to the end of the cold tier
+        :param records: Record dicts
+        """
+
+        if not records:
+            return
+
+        with self.lock:
+            packed = {k: np.zeros((len(records), WORDS_PER_HASH[k]), dtype=np.uint64) for k in self.hash_keys}
+            valid = np.zeros((len(records), len(self.hash_keys)), dtype=np.uint8)
+            for r, record in enumerate(records):
+                for c, hash_key in enumerate(self.hash_keys):
+                    hash_words = hash_to_words(record.get(hash_key), hash_key)
+                    if hash_words is not None:
+                        packed[hash_key][r] = hash_words
+                        valid[r, c] = 1
+
+            offsets = []
+            with open(self._file('records.jsonl'), 'ab') as f:
+                for record in records:
+                    offsets.append(f.tell())
+                    f.write((json.dumps(record) + '\n').encode())
+
+            with open(self._file('offsets.bin'), 'ab') as f:
+                f.write(np.array(offsets, dtype=np.uint64).tobytes())
+            with open(self.valid_file(), 'ab') as f:
+                f.write(valid.tobytes())
+            for hash_key in self.hash_keys:
+                with open(self.hash_file(hash_key), 'ab') as f:
+                    f.write(packed[hash_key].tobytes())
+
+            # Written last.  A row only counts once its ID is here
+            new_ids = [r['image_id'] for r in records]
+            with open(self._file('ids.txt'), 'a') as f:
+                f.write(''.join(i + '\n' for i in new_ids))
+
+            self.ids.extend(new_ids)
+            self._id_set.update(new_ids)
+            self.rows += len(records)
+
+    def get_records(self, rows):
+        """
+        Read back the records of the provided row numbers
+        """
+
+        if not len(rows):
+            return []
+
+        offsets = np.memmap(self._file('offsets.bin'), dtype=np.uint64, mode='r')
+        records = []
+        with open(self._file('records.jsonl'), 'rb') as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                records.append(json.loads(f.readline()))
+
+        return records
+
+
+@worker_profiled
+def cold_matching_rows(hash_path, valid_path, words, column, columns, rows, hash_words, max_distance):
+    """
+    Runs in a pool worker.  Memory map the cold tier file for one hash size and search its first rows
+    :param hash_path: ColdTier.hash_file for the hash size
+    :param valid_path: ColdTier.valid_file
+    :param words: Words per hash
+    :param column: Position of the hash key in ColdTier.hash_keys
+    :param columns: Number of hash keys in the cold tier
+    :param rows: Number of rows to search
+    :param hash_words: Packed hash to compare
+    :param max_distance: Maximum hamming distance (inclusive) to count as a match
+    :return: numpy array of matching row indexes
+    """
+
+    if not rows:
+        return np.empty(0, dtype=np.intp)
+
+    hashes = np.memmap(hash_path, dtype=np.uint64, mode='r', shape=(rows, words))
+    valid = np.memmap(valid_path, dtype=np.uint8, mode='r', shape=(rows, columns))
+    matches = matching_rows(hashes, hash_words, max_distance)
+    return matches[valid[matches, column] == 1]
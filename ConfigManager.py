@@ -6,6 +6,8 @@ import configparser
 import time
 import threading
 
+from HashAlgorithms import ALGORITHMS
+
 class ConfigManager():
 
     def __init__(self):
@@ -18,17 +20,79 @@ class ConfigManager():
         self.leave_downvote = False
         self.log_reposts = False
         self.min_time_between_requests = 5
+        self.max_poll_interval = 60
+        self.max_poll_pages = 5
+        self.poll_target_images = 30
         self.title_check_values = ['mrw', 'when', 'my reaction']
         self.comment_template = "We Have Detected Reposted Content.  Reference Hash: {}"
         self.logging = False
         self.hash_size = 16
         self.hamming_cutoff = 3
         self.hash_proc_limit = 5
+        self.hash_queue_size = 1000
+        self.repost_queue_size = 1000
+        self.match_engine = 'banded'
+        self.reduced_decode = False
+
+        # Hash algorithm new images are matched on and every algorithm that is generated and indexed.  dhash is always
+        # generated
+        self.hash_algorithm = 'dhash'
+        self.hash_algorithms = ['dhash']
+
+        # Animated GIF frame sampling.  GifFrames = 0 disables it
+        self.gif_frames = 0
+        self.gif_frame_quorum = 0.5
+        self.gif_hamming_cutoff = 6
+
+        # Profiling.  Can be changed while running
+        self.profile = False
+        self.profile_threads = []
+        self.profile_workers = True
+        self.profile_dump_interval = 10
+        self.profile_path = os.path.join(os.getcwd(), 'profiles')
+
+        # Vote and comment queue.  Only read at startup
+        self.action_queue = os.path.join(os.getcwd(), 'actions.db')
+        self.action_threads = 2
+        self.action_max_attempts = 8
+
+        # Metrics endpoint.  Port 0 disables it.  Only read at startup
+        self.metrics_host = '127.0.0.1'
+        self.metrics_port = 0
+
+        # Sharded match engine settings.  Only read at startup
+        self.shard_addresses = []
+        self.local_shards = 2
+        self.shard_auth_key = None  # No default.  The Sharded engine won't run until one is set
+
+        # Image download settings.  Can be overridden via config.  Only read at startup
+        self.download_threads = 8
+        self.downloads_per_host = 4
+        self.download_timeout = 10
+        self.max_image_size = 20
+
+        # Database write buffer.  Can be overridden via config
+        self.db_flush_size = 50
+        self.db_flush_interval = 30
+        self.load_chunk_size = 10000
+
+        # Hash snapshot settings.  Can be overridden via config
+        self.snapshot = False
+        self.snapshot_path = os.path.join(os.getcwd(), 'snapshot')
+        self.snapshot_interval = 60
+
+        # Hot / cold tier settings.  Can be overridden via config
+        self.hot_tier_days = 0
+        self.cold_tier_path = os.path.join(os.getcwd(), 'cold')
+        self.search_cold_tier = True
 
         # Backfill settings.  Can be overridden via config
         self.backfill = False
         self.backfill_depth = 500
         self.backfill_start_page = 1
+        self.backfill_request_divider = 1
+        self.backfill_threads = 4
+        self.backfill_checkpoint = os.path.join(os.getcwd(), 'backfill_checkpoint.json')
 
 
         # Load The Config.  If We Can't Find It Abort
@@ -54,7 +118,7 @@ class ConfigManager():
                               'host': config['MYSQL']['Host'],
                               'database': config['MYSQL']['Database']}
 
-        threading.Thread(target=self.reload_ini, name='ConfigMonitor').start()
+        threading.Thread(target=self.reload_ini, name='ConfigMonitor', daemon=True).start()
 
     def _setup_storage(self, config):
         """
@@ -133,6 +197,15 @@ class ConfigManager():
         if 'MinTimeBetweenRequests' in config['OPTIONS']:
             self.min_time_between_requests = int(config['OPTIONS']['MinTimeBetweenRequests'])
 
+        if 'MaxPollInterval' in config['OPTIONS']:
+            self.max_poll_interval = int(config['OPTIONS']['MaxPollInterval'])
+
+        if 'MaxPollPages' in config['OPTIONS']:
+            self.max_poll_pages = int(config['OPTIONS']['MaxPollPages'])
+
+        if 'PollTargetImages' in config['OPTIONS']:
+            self.poll_target_images = int(config['OPTIONS']['PollTargetImages'])
+
         if 'LogReposts' in config['OPTIONS']:
             self.log_reposts = config['OPTIONS'].getboolean('LogReposts')
 
@@ -142,12 +215,160 @@ class ConfigManager():
         if 'Logging' in config['OPTIONS']:
             self.logging = config['OPTIONS'].getboolean('Logging')
 
+        if 'BackfillThreads' in config['OPTIONS']:
+            self.backfill_threads = int(config['OPTIONS']['BackfillThreads'])
+
+        if 'BackfillCheckpoint' in config['OPTIONS']:
+            self.backfill_checkpoint = config['OPTIONS']['BackfillCheckpoint']
+
+        if 'BackfillRequestDivider' in config['OPTIONS']:
+            self.backfill_request_divider = float(config['OPTIONS']['BackfillRequestDivider'])
+
         if 'BackfillDepth' in config['OPTIONS']:
             self.backfill_depth = int(config['OPTIONS']['BackfillDepth'])
 
         if 'HashCheckProcesses' in config['OPTIONS']:
             self.hash_proc_limit = int(config['OPTIONS']['HashCheckProcesses'])
 
+        if 'DownloadThreads' in config['OPTIONS']:
+            self.download_threads = int(config['OPTIONS']['DownloadThreads'])
+
+        if 'DownloadsPerHost' in config['OPTIONS']:
+            self.downloads_per_host = int(config['OPTIONS']['DownloadsPerHost'])
+
+        if 'DownloadTimeout' in config['OPTIONS']:
+            self.download_timeout = int(config['OPTIONS']['DownloadTimeout'])
+
+        if 'MaxImageSize' in config['OPTIONS']:
+            self.max_image_size = int(config['OPTIONS']['MaxImageSize'])
+
+        if 'DBFlushSize' in config['OPTIONS']:
+            self.db_flush_size = int(config['OPTIONS']['DBFlushSize'])
+
+        if 'DBFlushInterval' in config['OPTIONS']:
+            self.db_flush_interval = int(config['OPTIONS']['DBFlushInterval'])
+
+        if 'LoadChunkSize' in config['OPTIONS']:
+            self.load_chunk_size = int(config['OPTIONS']['LoadChunkSize'])
+
+        if 'Snapshot' in config['OPTIONS']:
+            self.snapshot = config['OPTIONS'].getboolean('Snapshot')
+
+        if 'SnapshotPath' in config['OPTIONS']:
+            self.snapshot_path = config['OPTIONS']['SnapshotPath']
+
+        if 'SnapshotInterval' in config['OPTIONS']:
+            self.snapshot_interval = int(config['OPTIONS']['SnapshotInterval'])
+
+        if 'HotTierDays' in config['OPTIONS']:
+            self.hot_tier_days = int(config['OPTIONS']['HotTierDays'])
+
+        if 'ColdTierPath' in config['OPTIONS']:
+            self.cold_tier_path = config['OPTIONS']['ColdTierPath']
+
+        if 'SearchColdTier' in config['OPTIONS']:
+            self.search_cold_tier = config['OPTIONS'].getboolean('SearchColdTier')
+
+        if 'ReducedDecode' in config['OPTIONS']:
+            self.reduced_decode = config['OPTIONS'].getboolean('ReducedDecode')
+
+        if self.reduced_decode and str(self.hash_size) != '16':
+            # Only hash16 can be made from a reduced decode without drifting from the hashes already stored
+            print('[!] ERROR: ReducedDecode Only Works With HashSize = 16.  Disabling It')
+            self.reduced_decode = False
+
+        if 'GifFrames' in config['OPTIONS']:
+            self.gif_frames = int(config['OPTIONS']['GifFrames'])
+
+        if 'GifFrameQuorum' in config['OPTIONS']:
+            self.gif_frame_quorum = float(config['OPTIONS']['GifFrameQuorum'])
+
+        if 'GifHammingCutoff' in config['OPTIONS']:
+            self.gif_hamming_cutoff = int(config['OPTIONS']['GifHammingCutoff'])
+
+        if 'HashAlgorithms' in config['OPTIONS']:
+            algorithms = ['dhash']
+            for algorithm in config['OPTIONS']['HashAlgorithms'].split(','):
+                algorithm = algorithm.strip().lower()
+                if algorithm not in ALGORITHMS:
+                    print('[!] ERROR: {} Is Not a Valid Hash Algorithm'.format(algorithm))
+                elif algorithm not in algorithms:
+                    algorithms.append(algorithm)
+            self.hash_algorithms = algorithms
+
+        if 'HashAlgorithm' in config['OPTIONS']:
+            if config['OPTIONS']['HashAlgorithm'].lower() in ALGORITHMS:
+                self.hash_algorithm = config['OPTIONS']['HashAlgorithm'].lower()
+            else:
+                print('[!] ERROR: {} Is Not a Valid Hash Algorithm'.format(config['OPTIONS']['HashAlgorithm']))
+
+        if self.hash_algorithm not in self.hash_algorithms:
+            # Can't match on hashes that aren't generated
+            self.hash_algorithms.append(self.hash_algorithm)
+
+        if 'MatchEngine' in config['OPTIONS']:
+            if config['OPTIONS']['MatchEngine'].lower() in ['banded', 'bktree', 'matrix', 'sharded']:
+                self.match_engine = config['OPTIONS']['MatchEngine'].lower()
+            else:
+                print('[!] ERROR: {} Is Not a Valid Match Engine'.format(config['OPTIONS']['MatchEngine']))
+
+        if 'Profile' in config['OPTIONS']:
+            self.profile = config['OPTIONS'].getboolean('Profile')
+
+        if 'ProfileThreads' in config['OPTIONS']:
+            self.profile_threads = [t.strip() for t in config['OPTIONS']['ProfileThreads'].split(',') if t.strip()]
+
+        if 'ProfileWorkers' in config['OPTIONS']:
+            self.profile_workers = config['OPTIONS'].getboolean('ProfileWorkers')
+
+        if 'ProfileDumpInterval' in config['OPTIONS']:
+            self.profile_dump_interval = int(config['OPTIONS']['ProfileDumpInterval'])
+
+        if 'ProfilePath' in config['OPTIONS']:
+            self.profile_path = config['OPTIONS']['ProfilePath']
+
+        if 'ActionQueue' in config['OPTIONS']:
+            self.action_queue = config['OPTIONS']['ActionQueue']
+
+        if 'ActionThreads' in config['OPTIONS']:
+            self.action_threads = int(config['OPTIONS']['ActionThreads'])
+
+        if 'ActionMaxAttempts' in config['OPTIONS']:
+            self.action_max_attempts = int(config['OPTIONS']['ActionMaxAttempts'])
+
+        if 'MetricsHost' in config['OPTIONS']:
+            self.metrics_host = config['OPTIONS']['MetricsHost']
+
+        if 'MetricsPort' in config['OPTIONS']:
+            self.metrics_port = int(config['OPTIONS']['MetricsPort'])
+
+        if 'ShardAddresses' in config['OPTIONS']:
+            self.shard_addresses = []
+            for address in config['OPTIONS']['ShardAddresses'].split(','):
+                if address.strip():
+                    host, port = address.strip().rsplit(':', 1)
+                    self.shard_addresses.append((host, int(port)))
+
+        if 'LocalShards' in config['OPTIONS']:
+            self.local_shards = int(config['OPTIONS']['LocalShards'])
+
+        if 'ShardAuthKey' in config['OPTIONS']:
+            if config['OPTIONS']['ShardAuthKey'].strip().lower() == 'repostbot':
+                print('[!] ERROR: ShardAuthKey repostbot Is Public.  Set Your Own Secret Key')
+            else:
+                self.shard_auth_key = config['OPTIONS']['ShardAuthKey'].strip() or None
+
+        if self.match_engine == 'sharded' and not self.shard_auth_key:
+            # Shard traffic is pickled so running without a secret key would let anyone run code on the bot
+            print('[!] ERROR: The Sharded Match Engine Needs ShardAuthKey Set.  Using Matrix Instead')
+            self.match_engine = 'matrix'
+
+        if 'HashQueueSize' in config['OPTIONS']:
+            self.hash_queue_size = int(config['OPTIONS']['HashQueueSize'])
+
+        if 'RepostQueueSize' in config['OPTIONS']:
+            self.repost_queue_size = int(config['OPTIONS']['RepostQueueSize'])
+
         if 'BackfillStartPage' in config['OPTIONS']:
             self.backfill_start_page = int(config['OPTIONS']['BackfillStartPage'])
 
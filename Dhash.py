@@ -1,7 +1,23 @@
+import time
+
+import numpy as np
 from PIL import Image
 from PIL.GifImagePlugin import GifImageFile
 from PIL.JpegImagePlugin import JpegImageFile
-from PIL.PngImagePlugin import PngImageFile
+
+# When decoding at reduced resolution keep the image at least this many times larger than the hash grid, so 72x64 for
+# hash16.  On synthetic images benchmarks/decode_drift.py measures hash16 drifting from a full decode by about 1.5 bits
+# on average, well inside the usual HammingCutoff, while hashing 1.8 times faster overall (16 times for JPEGs).  At
+# 128 times it drifts under 0.1 bits but only JPEGs over 2304x2048 get any faster.  hash64 and hash256 drift at any
+# margin small enough to save time, so they are never made from a reduced decode
+REDUCED_DECODE_MARGIN = 8
+
+# Largest hash grid made from a reduced decode.  The reduced resolution only depends on this so a hash never depends on
+# which other sizes were generated alongside it
+REDUCED_DECODE_HASH_SIZE = 8
+
+# GIF frames can only be reached by decoding every frame before them, so frames past this are never sampled
+GIF_MAX_SCAN_FRAMES = 100
 
 def dhash(image, hash_size=8):
     """
@@ -9,34 +25,116 @@ def dhash(image, hash_size=8):
     This function expects and instance of PIL to be passed in.
     """
 
-    if not isinstance(image, (GifImageFile, JpegImageFile, PngImageFile)):
+    hashes = dhash_multi(image, hash_sizes=(hash_size,))
+    if not hashes:
+        return None
+
+    return hashes[hash_size][0]
+
+def dhash_multi(image, hash_sizes=(8, 16, 32), reduced_decode=False, timings=None):
+    """
+    Create hashes of several sizes from one decode of the provided image.
+    Same as HashAlgorithms.hash_multi with just dhash, which does the decoding and hashing for every algorithm.
+    :param image: PIL image
+    :param hash_sizes: Hash sizes to generate.  8 = 16 hex chars, 16 = 64 hex chars, 32 = 256 hex chars
+    :param reduced_decode: Decode and grayscale at a reduced resolution.  Much faster on large images.  Only sizes up to
+    REDUCED_DECODE_HASH_SIZE are generated, larger sizes are left out of the result
+    :param timings: Optional dict.  Seconds spent decoding and hashing are stored under 'decode' and 'hash'
+    :return: {hash_size: (hex string, packed uint64 words)} or None if the image can't be hashed
+    """
+
+    # HashAlgorithms imports this module for the reduced decode
+    from HashAlgorithms import hash_multi
+
+    hashes = hash_multi(image, ('dhash',), hash_sizes, reduced_decode, timings)
+    return hashes['dhash'] if hashes else None
+
+def gif_frame_hashes(image, max_frames=8, hash_size=8, max_scan_frames=GIF_MAX_SCAN_FRAMES, timings=None):
+    """
+    Hash a sample of the frames of an animated GIF.
+    Up to max_frames evenly spaced frames are picked from the first max_scan_frames, shrunk to the hash grid and hashed
+    together as one array.  Frames in between are only seeked past.  Identical frame hashes are only kept once.
+    :param image: PIL image.  Anything other than an animated GIF returns None
+    :param max_frames: Most frames to hash
+    :param max_scan_frames: Frames to pick the sample from.  Caps the cost of very long GIFs
+    :param timings: Optional dict.  Seconds spent and frames scanned and hashed are stored under 'gif', 'gif_scanned'
+    and 'gif_frames'
+    :return: 2D uint64 array with one packed hash per row or None
+    """
+
+    if not isinstance(image, GifImageFile) or not getattr(image, 'is_animated', False) or max_frames < 1:
+        return None
+
+    start = time.perf_counter()
+    try:
+        # Evenly spaced sample including the first and last frame scanned.  Counting frames doesn't decode them and
+        # only the picked frames are converted and shrunk
+        scanned = min(image.n_frames, max_scan_frames)
+        if scanned < 2:
+            return None
+        picks = np.unique(np.linspace(0, scanned - 1, min(max_frames, scanned)).round().astype(int))
+
+        grids = []
+        for frame in picks:
+            image.seek(int(frame))
+            grids.append(np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS),
+                                    dtype=np.int16))
+    except (TypeError, OSError, ValueError, EOFError) as e:
+        print('Error Creating GIF Frame Hashes. \n Error Message: {}'.format(e))
+        return None
+
+    pixels = np.stack(grids)
+
+    # Same bit layout as dhash_multi, for every frame at once
+    difference = pixels[:, :, :-1] > pixels[:, :, 1:]
+    packed = np.packbits(difference.reshape(len(picks), -1), axis=1, bitorder='little')
+    words = np.unique(packed.view('>u8').astype(np.uint64), axis=0)
+
+    if timings is not None:
+        timings['gif'] = time.perf_counter() - start
+        timings['gif_scanned'] = scanned
+        timings['gif_frames'] = len(words)
+
+    return words
+
+def frame_hashes_to_hex(words):
+    """
+    Store a set of frame hashes as one hex string
+    """
+    return words.astype('>u8').tobytes().hex()
+
+def hex_to_frame_hashes(value, hash_size=8):
+    """
+    Parse a hex string from frame_hashes_to_hex
+    :return: 2D uint64 array with one packed hash per row or None if the value is missing or malformed
+    """
+
+    width = hash_size * hash_size // 4
+    if not isinstance(value, str) or not value or len(value) % width:
         return None
 
-    # Grayscale and shrink the image
     try:
-        image = image.convert('L').resize((hash_size + 1, hash_size), Image.ANTIALIAS)
-    except (TypeError, OSError) as e:
-        print('Error Creating Image Hash. \n Error Message: {}'.format(e))
+        return np.frombuffer(bytes.fromhex(value), dtype='>u8').astype(np.uint64).reshape(len(value) // width, -1)
+    except ValueError:
         return None
 
-    pixels = list(image.getdata())
-
-    # Compare Adjacent Pixels
-    difference = []
-    for row in list(range(hash_size)):
-        for col in list(range(hash_size)):
-            pixel_left = image.getpixel((col, row))
-            pixel_right = image.getpixel((col + 1, row))
-            difference.append(pixel_left > pixel_right)
-
-    # Convert to binary array to hexadecimal string
-    decimal_value = 0
-    hex_string = []
-    for index, value in enumerate(difference):
-        if value:
-            decimal_value += 2**(index % 8)
-        if (index % 8) == 7:
-            hex_string.append(hex(decimal_value)[2:].rjust(2, '0'))
-            decimal_value = 0
-
-    return ''.join(hex_string)
\ No newline at end of file
+def _reduced_grayscale(image, hash_size=REDUCED_DECODE_HASH_SIZE):
+    """
+    Grayscale the image at the smallest resolution that is still REDUCED_DECODE_MARGIN times the hash grid.
+    JPEGs are scaled by the decoder itself (1/2, 1/4 or 1/8) so the full size image is never decoded.  Other formats
+    are reduced by an integer factor straight after the grayscale conversion.
+    """
+
+    min_size = ((hash_size + 1) * REDUCED_DECODE_MARGIN, hash_size * REDUCED_DECODE_MARGIN)
+
+    # Must be called before the image data is loaded
+    if isinstance(image, JpegImageFile):
+        image.draft('L', min_size)
+
+    grayscale = image.convert('L')
+
+    factor = min(grayscale.width // min_size[0], grayscale.height // min_size[1])
+    if factor >= 2:
+        grayscale = grayscale.reduce(factor)
+
+    return grayscale
@@ -0,0 +1,148 @@
+import functools
+import time
+
+import numpy as np
+from PIL import Image
+from PIL.GifImagePlugin import GifImageFile
+from PIL.JpegImagePlugin import JpegImageFile
+from PIL.PngImagePlugin import PngImageFile
+
+from Dhash import REDUCED_DECODE_HASH_SIZE, _reduced_grayscale
+
+# Hash key size (hex chars, as used by HashSize in bot.ini) to the grid size the image is reduced to
+HASH_KEY_SIZES = {16: 8, 64: 16, 256: 32}
+
+# pHash works from an image this many times larger than the hash grid
+PHASH_SCALE = 4
+
+
+def _dhash_bits(grayscale, hash_size):
+    """
+    Difference hash.  Row by row, left pixel brighter than right pixel
+    """
+    pixels = np.asarray(grayscale.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    return pixels[:, :-1] > pixels[:, 1:]
+
+
+def _ahash_bits(grayscale, hash_size):
+    """
+    Average hash.  Pixel brighter than the mean of the image
+    """
+    pixels = np.asarray(grayscale.resize((hash_size, hash_size), Image.LANCZOS), dtype=np.float32)
+    return pixels > pixels.mean()
+
+
+@functools.lru_cache(maxsize=None)
+def _dct_matrix(n):
+    """
+    Orthonormal DCT-II matrix.  D @ X @ D.T is the 2D DCT of an n x n block
+    """
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def _phash_bits(grayscale, hash_size):
+    """
+    Perceptual hash.  2D DCT of the image at PHASH_SCALE times the grid, then the lowest frequencies compared to
+    their median
+    """
+    size = hash_size * PHASH_SCALE
+    pixels = np.asarray(grayscale.resize((size, size), Image.LANCZOS), dtype=np.float32)
+    dct = _dct_matrix(size)
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    return low > np.median(low)
+
+
+# Available hash algorithms.  Each takes a grayscale PIL image and the grid size and returns a 2D bool array
+ALGORITHMS = {'dhash': _dhash_bits, 'phash': _phash_bits, 'ahash': _ahash_bits}
+
+# Key prefix of each algorithm.  dhash has none so its keys match the original hash, hash64 and hash256 columns
+PREFIXES = {'dhash': '', 'phash': 'p', 'ahash': 'a'}
+
+
+def hash_key(algorithm, size):
+    """
+    Record key and column name of a hash, e.g. hash64 for a 64 char dhash and phash64 for a 64 char pHash
+    :param size: Hash size in hex chars.  16, 64 or 256
+    """
+    return '{}hash{}'.format(PREFIXES[algorithm], int(size))
+
+
+def hash_keys(algorithms):
+    """
+    Every hash key generated for the provided algorithms.  dhash is always included and always comes first
+    """
+    return [hash_key(a, s) for a in ALGORITHMS if a == 'dhash' or a in algorithms for s in HASH_KEY_SIZES]
+
+
+# Keys every record has.  Also all that snapshots and cold tiers made before the other algorithms were added hold
+DHASH_KEYS = tuple(hash_keys(['dhash']))
+
+
+def parse_hash_key(key):
+    """
+    :return: Tuple of (algorithm, grid size) for a hash key
+    """
+    for algorithm in ALGORITHMS:
+        for size, grid in HASH_KEY_SIZES.items():
+            if hash_key(algorithm, size) == key:
+                return algorithm, grid
+    raise KeyError(key)
+
+
+def hash_multi(image, algorithms=('dhash',), hash_sizes=(8, 16, 32), reduced_decode=False, timings=None):
+    """
+    Create hashes with several algorithms and sizes from one decode of the provided image.
+    The image is converted to grayscale once and every hash is made from that.  Bits are packed the same way for every
+    algorithm.  Dhash.dhash_multi goes through here too.
+    :param image: PIL image
+    :param algorithms: Names from ALGORITHMS
+    :param hash_sizes: Grid sizes.  8 = 16 hex chars, 16 = 64 hex chars, 32 = 256 hex chars
+    :param reduced_decode: Decode and grayscale at a reduced resolution.  Much faster on large images.  Every algorithm
+    works from the same reduced image, whichever algorithms and sizes are asked for, so a hash is the same however it
+    was generated.  Only sizes up to REDUCED_DECODE_HASH_SIZE are generated, larger sizes are left out of the result
+    :param timings: Optional dict.  Seconds spent decoding are stored under 'decode' and hashing under 'hash'
+    :return: {algorithm: {hash_size: (hex string, packed uint64 words)}} or None if the image can't be hashed
+    """
+
+    if not isinstance(image, (GifImageFile, JpegImageFile, PngImageFile)):
+        return None
+
+    if reduced_decode:
+        hash_sizes = [s for s in hash_sizes if s <= REDUCED_DECODE_HASH_SIZE]
+        if not hash_sizes:
+            return None
+
+    start = time.perf_counter()
+    try:
+        if reduced_decode:
+            # Always reduced for REDUCED_DECODE_HASH_SIZE, which leaves more than PHASH_SCALE times the grid
+            grayscale = _reduced_grayscale(image)
+        else:
+            grayscale = image.convert('L')
+    except (TypeError, OSError, ValueError) as e:
+        print('Error Creating Image Hash. \n Error Message: {}'.format(e))
+        return None
+
+    decoded = time.perf_counter()
+    results = {}
+    for algorithm in algorithms:
+        results[algorithm] = {}
+        for hash_size in hash_sizes:
+            try:
+                bits = ALGORITHMS[algorithm](grayscale, hash_size)
+            except (TypeError, OSError, ValueError) as e:
+                print('Error Creating Image Hash. \n Error Message: {}'.format(e))
+                return None
+
+            packed = np.packbits(bits.ravel(), bitorder='little')
+            words = packed.view('>u8').astype(np.uint64) if packed.size % 8 == 0 else None
+            results[algorithm][hash_size] = (packed.tobytes().hex(), words)
+
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['hash'] = time.perf_counter() - decoded
+
+    return results
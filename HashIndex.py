@@ -0,0 +1,90 @@
+def bit_distance(hash_a, hash_b):
+    """
+    Hamming distance in bits between two hashes stored as ints
+    """
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class BKTree():
+    """
+    Burkhard-Keller tree over image hashes stored as ints.  Lets us find every hash within a given hamming distance
+    without comparing against every record we have stored.
+
+    Nodes are kept in flat lists rather than nested objects so the tree never hits recursion limits as it grows.
+    Records that share an identical hash are stored together on the same node.
+    """
+
+    def __init__(self, distance_func=bit_distance):
+
+        self.distance_func = distance_func
+        self.total_records = 0
+        self._hashes = []  # Hash stored at each node
+        self._records = []  # Records with the exact hash of each node
+        self._children = []  # {distance: child node index} for each node
+
+    def __len__(self):
+        return self.total_records
+
+    def _new_node(self, hash_value, record):
+        self._hashes.append(hash_value)
+        self._records.append([record])
+        self._children.append({})
+        self.total_records += 1
+        return len(self._hashes) - 1
+
+    def add(self, hash_value, record):
+        """
+        Insert a hash into the tree.
+        :param hash_value: Hash to index
+        :param record: Record to return when this hash matches a search
+        """
+
+        if not self._hashes:
+            self._new_node(hash_value, record)
+            return
+
+        node = 0
+        while True:
+            node_distance = self.distance_func(hash_value, self._hashes[node])
+
+            if node_distance == 0:
+                self._records[node].append(record)
+                self.total_records += 1
+                return
+
+            child = self._children[node].get(node_distance)
+            if child is None:
+                self._children[node][node_distance] = self._new_node(hash_value, record)
+                return
+
+            node = child
+
+    def search(self, hash_value, max_distance):
+        """
+        Find all records with a hash within max_distance of the provided hash.
+        :param hash_value: Hash to search for
+        :param max_distance: Maximum hamming distance (inclusive) to count as a match
+        :return: List of (distance, record) tuples
+        """
+
+        results = []
+
+        if not self._hashes:
+            return results
+
+        to_visit = [0]
+        while to_visit:
+            node = to_visit.pop()
+            node_distance = self.distance_func(hash_value, self._hashes[node])
+
+            if node_distance <= max_distance:
+                for r in self._records[node]:
+                    results.append((node_distance, r))
+
+            # Triangle inequality.  Only children in this band can hold a match
+            low, high = node_distance - max_distance, node_distance + max_distance
+            for child_distance, child in self._children[node].items():
+                if low <= child_distance <= high:
+                    to_visit.append(child)
+
+        return results
@@ -0,0 +1,388 @@
+from bisect import bisect_right
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from HashAlgorithms import ALGORITHMS, HASH_KEY_SIZES, hash_key
+
+# Number of 64 bit words needed to hold each hash type.  hash16 is 16 hex chars = 64 bits and so on.
+# Every hash algorithm has a key for each size.  dhash keys come first
+WORDS_PER_HASH = {hash_key(a, size): size // 16 for a in ALGORITHMS for size in HASH_KEY_SIZES}
+
+# Fallback popcount for NumPy versions without bitwise_count.  Bit count of every possible byte value
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Shared memory segments a pool worker is attached to.  {words: (segment name, SharedMemory)}
+_attached_segments = {}
+
+
+def hash_to_words(hash_value, hash_key):
+    """
+    Pack a hex hash string into an array of uint64 words.
+    :param hash_value: Hex string as generated by Dhash
+    :param hash_key: hash16, hash64 or hash256
+    :return: numpy array of uint64 or None if the hash is missing or malformed
+    """
+
+    if not isinstance(hash_value, str) or len(hash_value) != WORDS_PER_HASH[hash_key] * 16:
+        return None
+
+    try:
+        return np.frombuffer(bytes.fromhex(hash_value), dtype='>u8').astype(np.uint64)
+    except ValueError:
+        return None
+
+
+def popcount(words):
+    """
+    Count the set bits in each row of a 2D uint64 array
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.uint32)
+
+    byte_view = np.ascontiguousarray(words).view(np.uint8).reshape(words.shape[0], -1)
+    return _BYTE_POPCOUNT[byte_view].sum(axis=1, dtype=np.uint32)
+
+
+def matching_rows(hashes, hash_words, max_distance):
+    """
+    XOR the provided hash against every row and return the indexes of rows within max_distance bits.
+    :param hashes: 2D uint64 array.  One hash per row
+    :param hash_words: Packed hash to compare
+    :param max_distance: Maximum hamming distance (inclusive) to count as a match
+    :return: numpy array of matching row indexes
+    """
+    if not len(hashes):
+        return np.empty(0, dtype=np.intp)
+
+    distances = popcount(np.bitwise_xor(hashes, hash_words))
+    return np.flatnonzero(distances <= max_distance)
+
+
+class RecordList():
+    """
+    List of records that can also hold lazy sequences (such as the rows of a HashSnapshot) without expanding them.
+    Records are looked up by position the same way as a list
+    """
+
+    def __init__(self, records=()):
+
+        self._starts = []  # Position of the first record of each segment
+        self._segments = []
+        self._tail = None  # Last segment when it's a plain list that append can add to
+        self._length = 0
+        self.extend(records)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for segment in self._segments:
+            yield from segment
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(self._length)[i]]
+
+        i = range(self._length)[i]
+        segment = bisect_right(self._starts, i) - 1
+        return self._segments[segment][i - self._starts[segment]]
+
+    def _add_segment(self, segment):
+        self._starts.append(self._length)
+        self._segments.append(segment)
+        self._length += len(segment)
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        """
+        :param records: List of records or a sequence supporting len and indexing, which is kept as is
+        """
+        if isinstance(records, (list, tuple)):
+            if self._tail is None:
+                self._tail = []
+                self._add_segment(self._tail)
+            self._tail.extend(records)
+            self._length += len(records)
+        elif len(records):
+            self._add_segment(records)
+            self._tail = None
+
+
+class HashMatrix():
+    """
+    Stores every hash of a single size as packed uint64 words in one contiguous array.  Hash checks are done with a
+    single vectorized XOR and popcount over the whole array.
+
+    records is kept parallel to the rows so a matching row index maps straight back to its record.
+    """
+
+    def __init__(self, hash_key, capacity=1024):
+
+        self.hash_key = hash_key
+        self.words = WORDS_PER_HASH[hash_key]
+        self.rows = 0
+        self.records = RecordList()
+        self._hashes = self._allocate(capacity)
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def hashes(self):
+        """
+        View of the filled rows.  Rows that are added later don't show up in a view that has already been handed out
+        """
+        return self._hashes[:self.rows]
+
+    def _allocate(self, capacity):
+        return np.zeros((capacity, self.words), dtype=np.uint64)
+
+    def _grow(self, min_capacity=0):
+        grown = self._allocate(max(self._hashes.shape[0] * 2, min_capacity))
+        grown[:self.rows] = self._hashes[:self.rows]
+        self._hashes = grown
+
+    def add(self, hash_words, record):
+        """
+        Append a packed hash to the matrix.  Capacity is doubled when full.
+        :param hash_words: Packed hash from hash_to_words
+        :param record: Record this row belongs to
+        """
+
+        if self.rows == self._hashes.shape[0]:
+            self._grow()
+
+        self._hashes[self.rows] = hash_words
+        self.records.append(record)
+        self.rows += 1
+
+    def extend(self, hashes, records):
+        """
+        Append many packed hashes in one copy.
+        :param hashes: 2D uint64 array with one hash per row
+        :param records: Records for each row
+        """
+
+        count = len(hashes)
+        if self.rows + count > self._hashes.shape[0]:
+            self._grow(self.rows + count)
+
+        self._hashes[self.rows:self.rows + count] = hashes
+        self.records.extend(records)
+        self.rows += count
+
+    def search(self, hash_words, max_distance):
+        """
+        Find all rows within max_distance bits of the provided hash.
+        :return: numpy array of matching row indexes
+        """
+        return matching_rows(self.hashes, hash_words, max_distance)
+
+
+class BandedHashMatrix(HashMatrix):
+    """
+    HashMatrix that only compares against rows that could possibly match (multi-index hashing).
+
+    The bits of each hash are split into at least max_distance + 1 bands and every row is bucketed by the exact value of
+    each band.  Two hashes within max_distance bits can't differ in every band, so any match shares at least one bucket
+    with the hash being searched.  Only rows from those buckets are XORed and popcounted.  The fewer bits per band, the
+    bigger the buckets, so this pays off most with larger hashes and small cutoffs.  When the buckets hold more rows
+    than the matrix, or a search is wider than the matrix was built for, every row is compared instead.
+
+    Each band is kept as its values sorted alongside their rows so a bucket is a slice found by binary search.  New rows
+    go to an unsorted tail that is merged in once it reaches a sixteenth of the sorted rows.
+    """
+
+    MERGE_ROWS = 4096  # Smallest tail that's merged into the sorted bands
+
+    def __init__(self, hash_key, max_distance, capacity=1024):
+
+        super().__init__(hash_key, capacity)
+        self.max_distance = max_distance
+
+        # No band wider than 64 bits so a band's value fits in one word
+        bits = self.words * 64
+        self.bands = np.array_split(np.arange(bits), min(max(max_distance + 1, -(-bits // 64)), bits))
+        self._band_weights = [np.left_shift(np.uint64(1), np.arange(len(band), dtype=np.uint64)) for band in self.bands]
+        self._band_dtype = np.uint32 if max(len(band) for band in self.bands) <= 32 else np.uint64
+
+        # Per band (sorted band values, row of each value).  Rows from _merged_rows on are in _tail, one column per band
+        self._sorted = [(np.empty(0, dtype=self._band_dtype), np.empty(0, dtype=np.int32)) for band in self.bands]
+        self._merged_rows = 0
+        self._tail = np.empty((self.MERGE_ROWS, len(self.bands)), dtype=self._band_dtype)
+
+    def _band_values(self, hashes):
+        """
+        :param hashes: 2D uint64 array with one hash per row
+        :return: 2D array with the value of each band's bits for every row
+        """
+        bits = np.unpackbits(np.ascontiguousarray(hashes, dtype=np.uint64).view(np.uint8), axis=1)
+        return np.stack([bits[:, band] @ weights for band, weights in zip(self.bands, self._band_weights)],
+                        axis=1).astype(self._band_dtype)
+
+    def add(self, hash_words, record):
+        self.extend(np.reshape(hash_words, (1, -1)), [record])
+
+    def extend(self, hashes, records):
+        super().extend(hashes, records)
+        if not len(hashes):
+            return
+
+        values = self._band_values(hashes)
+        tail_rows = self.rows - len(hashes) - self._merged_rows
+        if self.rows - self._merged_rows < max(self.MERGE_ROWS, self._merged_rows // 16):
+            if self.rows - self._merged_rows > len(self._tail):
+                grown = np.empty((len(self._tail) * 2, len(self.bands)), dtype=self._band_dtype)
+                grown[:tail_rows] = self._tail[:tail_rows]
+                self._tail = grown
+            self._tail[tail_rows:tail_rows + len(values)] = values
+            return
+
+        # Both parts are already in order per band, so the stable sort only has to merge them
+        values = np.concatenate([self._tail[:tail_rows], values])
+        rows = np.arange(self._merged_rows, self.rows, dtype=np.int32)
+        for band, (band_values, band_rows) in enumerate(self._sorted):
+            band_values = np.concatenate([band_values, values[:, band]])
+            band_rows = np.concatenate([band_rows, rows])
+            order = np.argsort(band_values, kind='stable')
+            self._sorted[band] = (band_values[order], band_rows[order])
+        self._merged_rows = self.rows
+
+    def search(self, hash_words, max_distance=None):
+        """
+        Find all rows within max_distance bits of the provided hash
+        :return: numpy array of matching row indexes
+        """
+
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            return matching_rows(self.hashes, hash_words, max_distance)
+
+        query = self._band_values(np.reshape(hash_words, (1, -1)))[0]
+        candidates = []
+        for value, (band_values, band_rows) in zip(query, self._sorted):
+            start, end = np.searchsorted(band_values, value, 'left'), np.searchsorted(band_values, value, 'right')
+            if end > start:
+                candidates.append(band_rows[start:end])
+
+        tail_rows = self.rows - self._merged_rows
+        if tail_rows:
+            candidates.append(np.flatnonzero((self._tail[:tail_rows] == query).any(axis=1)) + self._merged_rows)
+
+        candidates = np.concatenate(candidates) if candidates else ()
+        if not len(candidates):
+            return np.empty(0, dtype=np.intp)
+        if len(candidates) >= self.rows:
+            return matching_rows(self.hashes, hash_words, max_distance)
+
+        # A row can be in several of the buckets.  Duplicates are only dropped from the matches
+        return np.unique(candidates[matching_rows(self._hashes[candidates], hash_words, max_distance)]).astype(np.intp)
+
+
+class SharedHashMatrix(HashMatrix):
+    """
+    HashMatrix backed by a shared memory segment.  Pool workers attach to the segment once and read it in place, so a
+    hash check only needs to send the hash being checked plus the segment name and row count it was submitted against.
+
+    Rows are only ever appended, so the row count acts as a generation counter.  A worker reading the first N rows is
+    never affected by rows added after the task was submitted.  When the matrix grows a new segment is created and the
+    old one is unlinked once no submitted task is still using it.
+    """
+
+    def __init__(self, hash_key, capacity=1024):
+
+        self.segment = None
+        self.retired = False  # Replaced by a new matrix.  Closed once its pending tasks finish
+        self._pending = {}  # {segment name: tasks submitted against it that haven't finished}
+        self._retired = []  # Old segments waiting for their pending tasks to finish
+        super().__init__(hash_key, capacity)
+
+    def _allocate(self, capacity):
+        self.segment = shared_memory.SharedMemory(create=True, size=capacity * self.words * 8)
+        return np.ndarray((capacity, self.words), dtype=np.uint64, buffer=self.segment.buf)
+
+    def _grow(self, min_capacity=0):
+        old_segment = self.segment
+        super()._grow(min_capacity)
+        self._retired.append(old_segment)
+        self._cleanup()
+
+    def acquire(self):
+        """
+        Pin the current segment for a pool task.  Must be matched by a call to release once the task finishes
+        :return: Tuple of segment name and the number of rows the task should search
+        """
+        name = self.segment.name
+        self._pending[name] = self._pending.get(name, 0) + 1
+        return name, self.rows
+
+    def release(self, name):
+        self._pending[name] -= 1
+        if not self._pending[name]:
+            del self._pending[name]
+        self._cleanup()
+
+        if self.retired and not self._pending:
+            self.close()
+
+    def retire(self):
+        """
+        Mark this matrix as replaced.  Its segments are freed as soon as no submitted task is using them
+        """
+        self.retired = True
+        if not self._pending:
+            self.close()
+
+    def _cleanup(self):
+        for segment in list(self._retired):
+            if segment.name in self._pending:
+                continue
+            try:
+                segment.close()
+            except BufferError:
+                # Something in this process still holds a view of the old buffer.  Try again on the next release
+                continue
+            segment.unlink()
+            self._retired.remove(segment)
+
+    def close(self):
+        """
+        Free every segment.  Call on shutdown so nothing is left behind in shared memory
+        """
+        self._hashes = None
+        for segment in self._retired + [self.segment]:
+            if segment is None:
+                continue
+            try:
+                segment.close()
+                segment.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+        self._retired = []
+        self.segment = None
+
+
+def shared_matching_rows(segment_name, words, rows, hash_words, max_distance):
+    """
+    Runs in a pool worker.  Attach to the shared hash matrix (reusing the mapping from earlier tasks when the segment
+    hasn't changed) and search the first rows of it.
+    :param segment_name: Name of the SharedHashMatrix segment
+    :param words: Words per hash of the matrix
+    :param rows: Number of rows filled when the task was submitted
+    :param hash_words: Packed hash to compare
+    :param max_distance: Maximum hamming distance (inclusive) to count as a match
+    :return: numpy array of matching row indexes
+    """
+
+    attached = _attached_segments.get(words)
+    if not attached or attached[0] != segment_name:
+        if attached:
+            attached[1].close()
+        _attached_segments[words] = (segment_name, shared_memory.SharedMemory(name=segment_name))
+
+    segment = _attached_segments[words][1]
+    hashes = np.ndarray((rows, words), dtype=np.uint64, buffer=segment.buf)
+    return matching_rows(hashes, hash_words, max_distance)
@@ -0,0 +1,263 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+from HashMatrix import HashMatrix, WORDS_PER_HASH, hash_to_words
+
+# Key used before ShardAuthKey had to be set.  It's public so it's refused
+OLD_DEFAULT_AUTH_KEY = b'repostbot'
+
+
+def check_authkey(authkey):
+    """
+    Requests and replies are pickled, so anyone who knows the key can run code on a shard and a shard can run code on
+    the bot.  Shards never run without a key of the operator's own
+    :param authkey: Key as bytes
+    :raises ValueError: If the key is missing or is the old default
+    """
+    if not authkey or authkey == OLD_DEFAULT_AUTH_KEY:
+        raise ValueError('Hash shards need ShardAuthKey set to a secret key')
+
+
+class ShardServer():
+    """
+    Holds one shard of the hash corpus and answers searches against it.
+
+    Every shard keeps a HashMatrix per hash size for the records it has been sent.  Requests arrive as (op, args)
+    tuples over a multiprocessing connection and each reply is ('ok', value) or ('error', message).  Each client
+    connection is served by its own thread so a slow search doesn't hold up adds from another client.
+
+    Connections are authenticated with authkey before anything is read, but the messages themselves are pickled.  The
+    port must only be reachable from the bot's own trusted network, never the internet.
+    """
+
+    def __init__(self, address, authkey):
+
+        check_authkey(authkey)
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.lock = threading.Lock()
+        self.matrices = {}  # {hash_key: HashMatrix}.  Created the first time a record has a hash for the key
+        self.image_ids = set()
+
+    def serve_forever(self):
+        while True:
+            conn = self.listener.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+
+        ops = {'add': self._add, 'search': self._search, 'remove': self._remove, 'count': self._count}
+        while True:
+            try:
+                op, args = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                return
+
+            try:
+                reply = ('ok', ops[op](*args))
+            except Exception as e:
+                reply = ('error', '{}: {}'.format(type(e).__name__, e))
+            conn.send(reply)
+
+    def _add(self, records):
+        with self.lock:
+            for record in records:
+                if record['image_id'] in self.image_ids:
+                    continue
+                self.image_ids.add(record['image_id'])
+                for hash_key in WORDS_PER_HASH:
+                    hash_words = hash_to_words(record.get(hash_key), hash_key)
+                    if hash_words is not None:
+                        if hash_key not in self.matrices:
+                            self.matrices[hash_key] = HashMatrix(hash_key)
+                        self.matrices[hash_key].add(hash_words, record)
+            return len(self.image_ids)
+
+    def _search(self, hash_key, hash_value, max_distance):
+
+        hash_words = hash_to_words(hash_value, hash_key)
+        if hash_words is None:
+            return []
+
+        with self.lock:
+            matrix = self.matrices.get(hash_key)
+            if matrix is None:
+                return []
+            return [matrix.records[i] for i in matrix.search(hash_words, max_distance)]
+
+    def _remove(self, image_ids):
+        """
+        Drop records from the shard.  The matrices are rebuilt without them
+        """
+        image_ids = set(image_ids)
+        with self.lock:
+            if not image_ids & self.image_ids:
+                return len(self.image_ids)
+
+            for hash_key, matrix in self.matrices.items():
+                keep = [i for i, r in enumerate(matrix.records) if r['image_id'] not in image_ids]
+                rebuilt = HashMatrix(hash_key, capacity=max(1024, len(keep)))
+                rebuilt.extend(matrix.hashes[keep], [matrix.records[i] for i in keep])
+                self.matrices[hash_key] = rebuilt
+
+            self.image_ids -= image_ids
+            return len(self.image_ids)
+
+    def _count(self):
+        return len(self.image_ids)
+
+
+def run_shard(address, authkey, ready=None):
+    """
+    Process entry point for a shard.
+    :param address: (host, port) to listen on.  Port 0 picks a free port
+    :param authkey: Shared key clients must present
+    :param ready: Optional pipe connection.  The address actually bound is sent back through it
+    """
+    server = ShardServer(address, authkey)
+    if ready:
+        ready.send(server.address)
+        ready.close()
+    server.serve_forever()
+
+
+def start_local_shards(count, authkey):
+    """
+    Start shard processes on this machine.  Used when no shard addresses are configured and for testing.  They only
+    listen on 127.0.0.1
+    :return: List of shard addresses
+    """
+
+    check_authkey(authkey)
+    addresses = []
+    for i in range(count):
+        parent_conn, child_conn = Pipe()
+        Process(target=run_shard, args=(('127.0.0.1', 0), authkey, child_conn), name='HashShard-{}'.format(i),
+                daemon=True).start()
+        addresses.append(parent_conn.recv())
+    return addresses
+
+
+class ShardedIndex():
+    """
+    Splits the hash corpus across shard servers.
+
+    A near duplicate can differ from the original in any bit, so shards are split by record rather than by hash value
+    and every search is sent to every shard.  The partial matches are merged into one list.  New records go to the
+    smallest shard, so a shard added while running fills up with new records without reloading the existing ones.
+    """
+
+    def __init__(self, addresses, authkey, max_workers=8):
+
+        check_authkey(authkey)
+        self.authkey = authkey
+        self.shards = []  # [{'address', 'conn', 'lock', 'rows'}]
+        self.shards_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ShardSearch')
+
+        # Queries wait on the per shard calls in executor so they need their own threads
+        self.query_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ShardQuery')
+
+        for address in addresses:
+            self.add_shard(address)
+
+    def __len__(self):
+        return sum(shard['rows'] for shard in self.shards)
+
+    def add_shard(self, address):
+        """
+        Connect to another shard.  It starts receiving new records straight away
+        :param address: (host, port) of a running shard server
+        """
+
+        shard = {'address': address, 'conn': Client(address, authkey=self.authkey), 'lock': threading.Lock()}
+        shard['rows'] = self._call(shard, 'count')
+        with self.shards_lock:
+            self.shards.append(shard)
+        print('Connected To Hash Shard {}:{} With {} Records'.format(address[0], address[1], shard['rows']))
+
+    def _call(self, shard, op, *args):
+        with shard['lock']:
+            shard['conn'].send((op, args))
+            status, value = shard['conn'].recv()
+
+        if status != 'ok':
+            raise RuntimeError('Shard {}:{} Failed {}: {}'.format(shard['address'][0], shard['address'][1], op, value))
+        return value
+
+    def add_records(self, records):
+        """
+        Spread records across the shards, filling the smallest first
+        """
+
+        if not records:
+            return
+
+        # Each record goes to whichever shard is smallest at that point.  Counts are bumped straight away so
+        # concurrent adds spread out too
+        batches = {}
+        with self.shards_lock:
+            for record in records:
+                shard = min(self.shards, key=lambda s: s['rows'])
+                shard['rows'] += 1
+                batches.setdefault(shard['address'], (shard, []))[1].append(record)
+
+        for shard, batch in batches.values():
+            shard['rows'] = self._call(shard, 'add', batch)
+
+    def remove(self, image_ids):
+        """
+        Drop records from whichever shards hold them
+        """
+        for shard in list(self.shards):
+            shard['rows'] = self._call(shard, 'remove', list(image_ids))
+
+    def search(self, hash_key, hash_value, max_distance):
+        """
+        Search every shard and merge the matches
+        :param hash_key: hash16, hash64 or hash256
+        :param hash_value: Hex hash to check
+        :param max_distance: Maximum hamming distance (inclusive) to count as a match
+        :return: List of matching records
+        """
+
+        futures = [self.executor.submit(self._call, shard, 'search', hash_key, hash_value, max_distance)
+                   for shard in list(self.shards)]
+
+        matches = []
+        for future in futures:
+            matches.extend(future.result())
+        return matches
+
+    def search_async(self, hash_key, hash_value, max_distance):
+        """
+        Run search in the background
+        :return: Future with the merged matches
+        """
+        return self.query_executor.submit(self.search, hash_key, hash_value, max_distance)
+
+    def close(self):
+        for shard in self.shards:
+            shard['conn'].close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    # The key comes from the environment so it doesn't show up in the process list
+    if len(sys.argv) != 3:
+        print('Usage: SHARD_AUTH_KEY=key python HashShards.py host port')
+        print('Only listen on an address reachable from the bot\'s trusted network, never the internet')
+        sys.exit(1)
+
+    try:
+        shard = ShardServer((sys.argv[1], int(sys.argv[2])), os.environ.get('SHARD_AUTH_KEY', '').encode())
+    except ValueError as e:
+        print('[!] ERROR: {}'.format(e))
+        sys.exit(1)
+    print('Hash Shard Listening On {}:{}'.format(*shard.address))
+    shard.serve_forever()
@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from HashAlgorithms import DHASH_KEYS
+from HashMatrix import WORDS_PER_HASH, RecordList, hash_to_words
+
+SNAPSHOT_VERSION = 3
+
+# Each save adds a segment holding just the records added since the last one.  Past this many they're merged into one
+MAX_SEGMENTS = 16
+
+
+def _file_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class SnapshotRecords():
+    """
+    Records of one snapshot segment, read straight out of the memory mapped files.  Record dicts are only built when a
+    row is looked up, such as when it's reported as a match, so loading a snapshot doesn't create an object per row
+    """
+
+    def __init__(self, table, packed, hash_keys, rows=None):
+
+        self.table = table
+        self.packed = packed  # {hash_key: memory mapped uint64 matrix}
+        self.hash_keys = hash_keys
+        self.rows = rows  # Rows of the segment in this view or None for all of them
+
+    def __len__(self):
+        return len(self.table) if self.rows is None else len(self.rows)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+
+        row = range(len(self))[i]
+        if self.rows is not None:
+            row = int(self.rows[row])
+
+        image_id, user, url, submitted, valid, frame_hashes = self.table[row].tolist()
+        image_id = image_id.decode()
+        record = {
+            'image_id': image_id,
+            'url': url.decode(),
+            'gallery_url': 'https://imgur.com/gallery/{}'.format(image_id),
+            'user': user.decode() or None,
+            'submitted': submitted if submitted >= 0 else None,
+            'frame_hashes': frame_hashes.decode() or None
+        }
+        for hash_key, has_hash in zip(self.hash_keys, valid):
+            record[hash_key] = self.packed[hash_key][row].astype('>u8').tobytes().hex() if has_hash else None
+        return record
+
+    def valid(self, hash_key):
+        """
+        :return: Bool array, False where the record has no usable hash for hash_key
+        """
+        return np.asarray(self.table['valid'][:, self.hash_keys.index(hash_key)])
+
+    def subset(self, rows):
+        """
+        :param rows: Positions in this view to keep
+        :return: SnapshotRecords of just those rows
+        """
+        return SnapshotRecords(self.table, self.packed, self.hash_keys, rows if self.rows is None else self.rows[rows])
+
+    def image_ids(self):
+        return [image_id.decode() for image_id in self.table['image_id'].tolist()]
+
+    def frame_rows(self):
+        """
+        :return: Rows with GIF frame hashes
+        """
+        return np.flatnonzero(self.table['frame_hashes'] != b'')
+
+
+class HashSnapshot():
+    """
+    On disk snapshot of the hash corpus so a restart doesn't have to reload the whole database.
+
+    Each hash key is saved as a packed uint64 matrix and the image id, user, url, submitted time and GIF frame hashes
+    are saved as a compact fixed width table.  Each save only appends the records added to the database since the last
+    one as a new segment of these files.  All files are memory mapped when loaded and stay that way, so records are
+    read back through SnapshotRecords.  The manifest records the segments, the row count, a checksum of every file and
+    the database high water mark (the newest row id included) so on startup only rows newer than the snapshot need to
+    be pulled from the database.
+
+    New files are written under a new generation name and the manifest is swapped in last, so a crash while saving
+    leaves the previous snapshot intact.
+    """
+
+    def __init__(self, path, storage, database, hash_keys=DHASH_KEYS, rescan_margin=0):
+
+        self.path = path
+        self.hash_keys = list(hash_keys)  # Hash keys saved for every record.  See HashAlgorithms.hash_keys
+        self.storage = storage
+        self.database = database
+        self.manifest_file = os.path.join(path, 'manifest.json')
+        self.high_water_mark = None
+        self.segments = []  # SnapshotRecords per segment
+        self.files = []  # Files of each segment.  {'records': name, hash_key: name}
+        self.checksums = {}
+        self.records = RecordList()
+
+        # Rows just under the high water mark are read again in case they were committed out of id order.  The newest
+        # ids saved are kept so those rows aren't saved twice
+        self.rescan_margin = rescan_margin
+        self.recent_ids = set()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_segment(self, files):
+        table = np.load(os.path.join(self.path, files['records']), mmap_mode='r')
+        packed = {hash_key: np.load(os.path.join(self.path, files[hash_key]), mmap_mode='r')
+                  for hash_key in self.hash_keys}
+        if any(p.shape != (len(table), WORDS_PER_HASH[k]) for k, p in packed.items()):
+            return None
+        return SnapshotRecords(table, packed, self.hash_keys)
+
+    def load(self, verify_count=None):
+        """
+        Load and verify the snapshot.
+        :param verify_count: Optional function taking the high water mark and returning how many rows the database has
+        up to it.  Used to catch a snapshot from a different or modified database
+        :return: True if the snapshot was loaded, False if it's missing, stale or corrupt
+        """
+
+        manifest = self._read_manifest()
+        if not manifest:
+            return False
+
+        if manifest.get('version') != SNAPSHOT_VERSION or manifest.get('storage') != self.storage or \
+                manifest.get('database') != self.database:
+            print('[!] Snapshot Was Built For A Different Database.  Ignoring It')
+            return False
+
+        if manifest.get('hash_keys', list(DHASH_KEYS)) != self.hash_keys:
+            print('[!] Snapshot Was Built For Different Hash Algorithms.  Ignoring It')
+            return False
+
+        for name, checksum in manifest['checksums'].items():
+            file_path = os.path.join(self.path, name)
+            if not os.path.isfile(file_path) or _file_checksum(file_path) != checksum:
+                print('[!] Snapshot File {} Is Missing Or Corrupt.  Ignoring Snapshot'.format(name))
+                return False
+
+        rows = manifest['rows']
+        if verify_count and verify_count(manifest['high_water_mark']) != rows:
+            print('[!] Snapshot Is Stale.  Database Has Changed Since It Was Written')
+            return False
+
+        segments = [self._load_segment(files) for files in manifest['segments']]
+        if None in segments or sum(len(segment) for segment in segments) != rows:
+            print('[!] Snapshot Row Counts Do Not Match.  Ignoring Snapshot')
+            return False
+
+        self.segments = segments
+        self.files = manifest['segments']
+        self.checksums = manifest['checksums']
+        self.records = RecordList()
+        for segment in segments:
+            self.records.extend(segment)
+        self.high_water_mark = manifest['high_water_mark']
+        self.recent_ids = set(manifest.get('recent_ids', []))
+        return True
+
+    def _write_segment(self, generation, table, packed):
+        """
+        Save one segment's arrays and load it back memory mapped
+        :return: Tuple of (SnapshotRecords, {'records': name, hash_key: name})
+        """
+
+        files = {'records': 'records.{}.npy'.format(generation)}
+        np.save(os.path.join(self.path, files['records']), table)
+        for hash_key in self.hash_keys:
+            files[hash_key] = '{}.{}.npy'.format(hash_key, generation)
+            np.save(os.path.join(self.path, files[hash_key]), packed[hash_key])
+        return self._load_segment(files), files
+
+    def _pack_records(self, records):
+        """
+        :return: Tuple of the fixed width record table and {hash_key: packed hashes} for record dicts
+        """
+
+        rows = len(records)
+
+        def width(field):
+            return max([len((r.get(field) or '').encode()) for r in records] + [1])
+
+        table = np.zeros(rows, dtype=[('image_id', 'S{}'.format(width('image_id'))),
+                                      ('user', 'S{}'.format(width('user'))),
+                                      ('url', 'S{}'.format(width('url'))), ('submitted', 'i8'),
+                                      ('valid', '?', (len(self.hash_keys),)),
+                                      ('frame_hashes', 'S{}'.format(width('frame_hashes')))])
+        packed = {hash_key: np.zeros((rows, WORDS_PER_HASH[hash_key]), dtype=np.uint64) for hash_key in self.hash_keys}
+
+        for r, record in enumerate(records):
+            valid = []
+            for hash_key in self.hash_keys:
+                hash_words = hash_to_words(record.get(hash_key), hash_key)
+                valid.append(hash_words is not None)
+                if hash_words is not None:
+                    packed[hash_key][r] = hash_words
+
+            submitted = record.get('submitted')
+            table[r] = ((record.get('image_id') or '').encode(), (record.get('user') or '').encode(),
+                        (record.get('url') or '').encode(), submitted if submitted is not None else -1, valid,
+                        (record.get('frame_hashes') or '').encode())
+
+        return table, packed
+
+    def _merge_segments(self, segments):
+        """
+        Copy several segments into one table and one matrix per hash key.  Strings are widened to the widest segment
+        """
+
+        dtype = []
+        for name in segments[0].table.dtype.names:
+            field = segments[0].table.dtype[name]
+            if field.kind == 'S':
+                field = 'S{}'.format(max(s.table.dtype[name].itemsize for s in segments))
+            dtype.append((name, field))
+
+        table = np.zeros(sum(len(s) for s in segments), dtype=dtype)
+        offset = 0
+        for segment in segments:
+            for name in table.dtype.names:
+                table[name][offset:offset + len(segment)] = segment.table[name]
+            offset += len(segment)
+
+        packed = {hash_key: np.concatenate([s.packed[hash_key] for s in segments]) for hash_key in self.hash_keys}
+        return table, packed
+
+    def append(self, records, high_water_mark):
+        """
+        Add records saved to the database since the last save.  Only these records are written.  Earlier segments are
+        left as they are until there are more than MAX_SEGMENTS, when they're merged into one.
+        :param records: Record dicts with their db_id.  Every record must already be stored in the database.  Rows
+        already in the snapshot that were read again from under the high water mark are skipped
+        :param high_water_mark: Newest database row id included in records
+        """
+
+        if high_water_mark is None:
+            return
+
+        records = [r for r in records if r.get('db_id') not in self.recent_ids]
+        if not records:
+            return
+
+        start = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        generation = str(int(time.time() * 1000))
+
+        segment, files = self._write_segment(generation, *self._pack_records(records))
+        segments = self.segments + [segment]
+        segment_files = self.files + [files]
+
+        if len(segments) > MAX_SEGMENTS:
+            segment, files = self._write_segment(generation + '.merged', *self._merge_segments(segments))
+            segments, segment_files = [segment], [files]
+
+        if self.high_water_mark is not None:
+            high_water_mark = max(high_water_mark, self.high_water_mark)
+        recent_ids = self.recent_ids | {r['db_id'] for r in records}
+        if self.rescan_margin:
+            recent_ids = set(sorted(recent_ids)[-self.rescan_margin:])
+        else:
+            recent_ids = set()
+
+        names = [name for files in segment_files for name in files.values()]
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'storage': self.storage,
+            'database': self.database,
+            'rows': sum(len(s) for s in segments),
+            'high_water_mark': high_water_mark,
+            'recent_ids': sorted(recent_ids),
+            'hash_keys': self.hash_keys,
+            'segments': segment_files,
+            'checksums': {name: self.checksums.get(name) or _file_checksum(os.path.join(self.path, name))
+                          for name in names}
+        }
+
+        temp_manifest = self.manifest_file + '.tmp'
+        with open(temp_manifest, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_manifest, self.manifest_file)
+
+        # Files no longer referenced by the manifest.  Merged segments and anything left from an older snapshot
+        for name in os.listdir(self.path):
+            if name.endswith('.npy') and name not in names:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+        self.segments = segments
+        self.files = segment_files
+        self.checksums = manifest['checksums']
+        self.records = RecordList()
+        for s in segments:
+            self.records.extend(s)
+        self.high_water_mark = high_water_mark
+        self.recent_ids = recent_ids
+        print('Saved {} New Records To Snapshot In {} Seconds'.format(len(records), round(time.time() - start, 1)))
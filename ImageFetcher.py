@@ -0,0 +1,122 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+from Metrics import metrics
+from Profiling import profiler
+
+
+class ImageFetcher():
+    """
+    Downloads images concurrently over a pooled keep-alive session.  Connections to the image host are reused between
+    downloads rather than opening a new TCP/TLS connection for every image.
+    """
+
+    def __init__(self, max_workers=8, per_host_limit=4, timeout=10, max_bytes=20 * 1024 * 1024, output_error=print):
+
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.per_host_limit = per_host_limit
+        self.output_error = output_error
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ImageFetch')
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.Semaphore(self.per_host_limit)
+            return self._host_limits[host]
+
+    def download(self, url):
+        """
+        Download the raw bytes of an image.  Aborts once the body goes over max_bytes
+        :param url: Direct image URL
+        :return: bytes or None if the download failed
+        """
+
+        if not url:
+            return None
+
+        try:
+            with self._host_semaphore(url), metrics.timer('repostbot_stage_seconds', stage='download'):
+                with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                    response.raise_for_status()
+
+                    if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                        self.output_error('Skipping {}.  Image Is Larger Than The Max Image Size'.format(url))
+                        return None
+
+                    data = BytesIO()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        data.write(chunk)
+                        if data.tell() > self.max_bytes:
+                            self.output_error('Skipping {}.  Image Is Larger Than The Max Image Size'.format(url))
+                            return None
+
+                    return data.getvalue()
+        except requests.RequestException as e:
+            metrics.inc('repostbot_stage_errors_total', stage='download')
+            msg = 'Error Downloading Image: \n Error Message: {}'.format(e)
+            self.output_error(msg)
+            return None
+
+    def fetch(self, url):
+        """
+        Download an image and open it with PIL
+        :param url: Direct image URL
+        :return: PIL image or None
+        """
+        return self._fetch_with_digest(url)[0]
+
+    def _fetch_with_digest(self, url):
+        """
+        Download an image and open it with PIL
+        :return: Tuple of PIL image and a digest of the downloaded bytes.  (None, None) on failure
+        """
+        profiler.checkpoint()
+
+        data = self.download(url)
+        if not data:
+            return None, None
+
+        try:
+            return Image.open(BytesIO(data)), hashlib.blake2b(data, digest_size=16).hexdigest()
+        except OSError as e:
+            metrics.inc('repostbot_stage_errors_total', stage='decode')
+            msg = 'Error Generating Image File: \n Error Message: {}'.format(e)
+            self.output_error(msg)
+            return None, None
+
+    def fetch_all(self, items):
+        """
+        Download the images for a batch of gallery items in parallel.
+        Yields each item as soon as its download completes so hashing can start on it right away.
+        :param items: Gallery items with a link attribute
+        :return: Generator of (item, PIL image or None, digest of the downloaded bytes or None)
+        """
+
+        futures = {self.executor.submit(self._fetch_with_digest, item.link): item for item in items}
+        for future in as_completed(futures):
+            try:
+                img, digest = future.result()
+            except Exception as e:
+                # Anything download and open don't handle themselves, like PIL's DecompressionBombError.  Only this
+                # item fails, not the rest of the page
+                metrics.inc('repostbot_stage_errors_total', stage='decode')
+                self.output_error('Error Fetching {}: \n Error Message: {}'.format(futures[future].link, e))
+                img, digest = None, None
+            yield futures[future], img, digest
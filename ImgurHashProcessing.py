@@ -1,57 +1,520 @@
 import threading
-from distance import hamming
-from Dhash import dhash
+import atexit
+import queue
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+from Dhash import gif_frame_hashes, frame_hashes_to_hex, hex_to_frame_hashes
+from HashIndex import BKTree
+from HashAlgorithms import ALGORITHMS, HASH_KEY_SIZES, hash_key, hash_keys, hash_multi
+from HashMatrix import BandedHashMatrix, HashMatrix, RecordList, SharedHashMatrix, WORDS_PER_HASH, hash_to_words, \
+    shared_matching_rows
+from SeenRegistry import SeenRegistry
+from ColdTier import ColdTier, cold_matching_rows
+from HashShards import ShardedIndex, start_local_shards
+from Metrics import metrics
+from Profiling import profiler, init_worker, worker_profiled
 from multiprocessing import Pool, cpu_count
+import math
 import time
+import numpy as np
 
-def proc_cb(r):
-        self.total_in_queue -= 1
-        if r:
-            self.repost_queue.append(r)
+# Hashes and digests kept in each exact duplicate lookup.  The oldest are dropped first
+EXACT_LOOKUP_SIZE = 100000
 
 class HashProcessing():
 
-    def __init__(self, config, image_ids, records):
+    def __init__(self, config, image_ids, records, capacity=0, loading=False):
+        """
+        :param capacity: Number of records expected.  Matrices are sized for it up front instead of growing
+        :param loading: Existing records are still being added.  Checks are held until finish_loading is called
+        """
 
         self.config = config
-        self.hash_queue = []
-        self.repost_queue = []
-        self.records = records
-        self.processed_ids = image_ids
+
+        # Every algorithm in HashAlgorithms is generated and gets its own indexes.  HashAlgorithm picks which one is
+        # matched on.  Changing HashAlgorithms requires a restart
+        self.hash_algorithms = [a for a in ALGORITHMS if a == 'dhash' or a in config.hash_algorithms]
+        self.hash_keys = hash_keys(self.hash_algorithms)
+
+        # Bounded so a backlog can't grow forever.  When the pool falls behind, producers block on put
+        self.hash_queue = queue.Queue(maxsize=config.hash_queue_size)
+        self.repost_queue = queue.Queue(maxsize=config.repost_queue_size)
+        self.pool = None
+        self.pool_slots = None  # Limits tasks in flight in the pool.  Created with the pool
+        self.backpressure_waits = 0  # Times an image had to wait for room in the hash queue
+        self.records = RecordList(records)
+        self.processed_ids = SeenRegistry(image_ids)
         self.total_default_threads = threading.active_count() + 1
         self.active_hash_threads = 0
         self.total_in_queue = 0
         self.pool_status = 'Running'
 
+        # Checks queued while existing records are still loading wait until they are all in.  Otherwise they'd only be
+        # compared against part of the corpus.  Capped at the size of the hash queue
+        self.loaded = threading.Event()
+        self.waiting_checks = []
+        self._waiting_lock = threading.Lock()
+        if not loading:
+            self.loaded.set()
+
+        # Exact duplicate lookups for images added by this run, checked before the near duplicate search.
+        # {content digest: [records]} and {hash_key: {hash: [records]}}.  Capped at EXACT_LOOKUP_SIZE entries each.
+        # Digests are only kept here and never stored with the records
+        self.digests = OrderedDict()
+        self.exact_hashes = {key: OrderedDict() for key in self.hash_keys}
+        self.match_counts = {'digest': 0, 'exact_hash': 0, 'gif': 0, 'near': 0}  # Reposts found by each stage
+        self.repost_waits = 0  # Times a repost had to wait for room in the repost queue
+
+        # Reposts found by pool and shard callbacks, on their way to the repost queue.  Each one holds the pool slot of
+        # the check that found it, so there are never more than the pool has slots
+        self.repost_relay = queue.Queue()
+
+        # Sampled frame hashes of animated GIFs.  One row per frame, mapped back to the GIF's record.  Kept in this
+        # process for every match engine since only GIFs have them.  Hot tier only
+        self.gif_frames = HashMatrix('hash16')
+
+        # Hot tier is the in memory indexes.  When HotTierDays is set, older records are demoted to the on disk cold
+        # tier which is only searched when the hot tier finds nothing.  Changes require a restart
+        self.cold_tier = ColdTier(config.cold_tier_path, self.hash_keys) if config.hot_tier_days else None
+        if self.cold_tier is not None:
+            self.processed_ids.update(self.cold_tier.ids)
+        self.tier_stats = {tier: {'searches': 0, 'hits': 0, 'seconds': 0.0} for tier in ('hot', 'cold')}
+
+        # One index per hash size so HashSize can be changed in the ini without rebuilding anything.
+        # The engine is fixed at startup since switching means rebuilding every index
+        self.match_engine = self.config.match_engine
+        self.index_lock = threading.Lock()
+        self.shards = None
+        if self.match_engine == 'sharded':
+            self.shards = self._connect_shards()
+        # With tiering most records end up in the cold tier so only the ones passed in are sized for
+        self.indexes = self._new_indexes(len(self.records) if self.cold_tier is not None else
+                                         max(len(self.records), capacity))
+        if self.match_engine == 'matrix':
+            atexit.register(self.close)
+
+        self._index_records(records)
+
         threading.Thread(target=self._spawn_main_hash_thread_proc, name="Main Hash Thread").start()
+        threading.Thread(target=self._relay_reposts, name='RepostRelay', daemon=True).start()
+
+        if self.cold_tier is not None:
+            threading.Thread(target=self._demotion_thread, name='TierDemotion', daemon=True).start()
+
+    def _connect_shards(self):
+        """
+        Connect to the shard servers in the config.  Starts local shard processes when none are listed
+        """
+        authkey = self.config.shard_auth_key.encode()
+        addresses = self.config.shard_addresses or start_local_shards(self.config.local_shards, authkey)
+        return ShardedIndex(addresses, authkey)
+
+    def add_shard(self, address):
+        """
+        Add another shard server while running.  New records start going to it straight away
+        :param address: (host, port) of a running shard server
+        """
+        self.shards.add_shard(address)
+
+    def _new_indexes(self, capacity=0):
+        if self.match_engine == 'sharded':
+            return {}
 
+        if self.match_engine == 'bktree':
+            return {key: BKTree() for key in self.hash_keys}
 
-    def proc_cb(self, r):
+        capacity = max(1024, capacity)
+        if self.match_engine == 'banded':
+            # Bucketed for the cutoff at startup.  A higher cutoff set while running compares every row instead
+            return {key: BandedHashMatrix(key, max(self.config.hamming_cutoff - 1, 0), capacity=capacity)
+                    for key in self.hash_keys}
+
+        return {key: SharedHashMatrix(key, capacity=capacity) for key in self.hash_keys}
+
+
+    def _index_exact(self, record, digest):
+        lookups = [(self.digests, digest)]
+        for key in self.hash_keys:
+            hash_value = record.get(key)
+            if isinstance(hash_value, str) and len(hash_value) == WORDS_PER_HASH[key] * 16:
+                lookups.append((self.exact_hashes[key], hash_value))
+
+        for lookup, value in lookups:
+            if not value:
+                continue
+            lookup.setdefault(value, []).append(record)
+            lookup.move_to_end(value)
+            while len(lookup) > EXACT_LOOKUP_SIZE:
+                lookup.popitem(last=False)
+
+    def _drop_exact(self, image_ids):
+        """
+        Remove records from the exact duplicate lookups
+        """
+        for lookup in [self.digests] + list(self.exact_hashes.values()):
+            for value in list(lookup):
+                kept = [r for r in lookup[value] if r['image_id'] not in image_ids]
+                if kept:
+                    lookup[value] = kept
+                else:
+                    del lookup[value]
+
+    def _index_frames(self, record, gif_frames):
+        frames = hex_to_frame_hashes(record.get('frame_hashes'))
+        if frames is not None:
+            gif_frames.extend(frames, [record] * len(frames))
+
+    def _index_record(self, record, indexes, gif_frames):
+        self._index_frames(record, gif_frames)
+
+        for key in self.hash_keys:
+            hash_words = hash_to_words(record.get(key), key)
+            if hash_words is None:
+                continue
+
+            if self.match_engine == 'bktree':
+                indexes[key].add(int(record[key], 16), record)
+            else:
+                indexes[key].add(hash_words, record)
+
+    def _index_batch(self, records, indexes, gif_frames):
+        """
+        Index a batch of records in the provided indexes.  The banded engine adds every row of a hash key in one go
+        """
+        if self.match_engine != 'banded':
+            for r in records:
+                self._index_record(r, indexes, gif_frames)
+            return
+
+        for r in records:
+            self._index_frames(r, gif_frames)
+        for key, index in indexes.items():
+            rows = [(hash_to_words(r.get(key), key), r) for r in records]
+            rows = [(hash_words, r) for hash_words, r in rows if hash_words is not None]
+            if rows:
+                index.extend(np.array([hash_words for hash_words, r in rows]), [r for hash_words, r in rows])
+
+    def _index_records(self, records):
+        """
+        Index a batch of records.  The sharded engine sends the whole batch to a shard in one request
+        """
+        if self.match_engine != 'sharded':
+            self._index_batch(records, self.indexes, self.gif_frames)
+            return
+
+        for r in records:
+            self._index_frames(r, self.gif_frames)
+        self.shards.add_records(records)
+
+    def add_records(self, records):
+        """
+        Add a chunk of records loaded from the database
+        :param records: List of record dicts
+        """
+        with self.index_lock:
+            self.processed_ids.update(r['image_id'] for r in records)
+
+            # Anything older than the hot tier window goes straight to the cold tier unless it's already there
+            if self.cold_tier is not None:
+                records, old_records = self._split_by_age(records)
+                self.cold_tier.append([r for r in old_records if r['image_id'] not in self.cold_tier])
+
+            self.records.extend(records)
+            self._index_records(records)
+
+    def add_snapshot(self, snapshot):
+        """
+        Bulk load the records of a HashSnapshot.  The matrix and banded engines copy packed hashes straight out of the
+        memory mapped snapshot and keep its rows as they are.  Record dicts are only built for matches and GIFs
+        :param snapshot: Loaded HashSnapshot
+        """
+
+        if self.match_engine not in ('matrix', 'banded') or self.cold_tier is not None:
+            self.add_records(list(snapshot.records))
+            return
+
+        with self.index_lock:
+            for segment in snapshot.segments:
+                self.records.extend(segment)
+                self.processed_ids.update(segment.image_ids())
+                for row in segment.frame_rows():
+                    self._index_frames(segment[row], self.gif_frames)
+                for hash_key, index in self.indexes.items():
+                    rows = np.flatnonzero(segment.valid(hash_key))
+                    index.extend(segment.packed[hash_key][rows],
+                                 segment if len(rows) == len(segment) else segment.subset(rows))
+
+    def add_record(self, record, digest=None):
+        """
+        Add a newly inserted record to the in memory records and the hash indexes
+        :param record: Record dict as built in insert_latest_images
+        :param digest: Digest of the downloaded file.  Only used for exact duplicate checks
+        """
+        with self.index_lock:
+            self.records.append(record)
+            self._index_exact(record, digest)
+            self._index_records([record])
+
+    def _split_by_age(self, records):
+        """
+        Split records into those inside the hot tier window and those older than it
+        :return: Tuple of (hot records, cold records)
+        """
+        cutoff = time.time() - self.config.hot_tier_days * 86400
+        hot, cold = [], []
+        for r in records:
+            if r.get('submitted') is not None and r['submitted'] < cutoff:
+                cold.append(r)
+            else:
+                hot.append(r)
+        return hot, cold
+
+    def demote_old_records(self):
+        """
+        Move records that have aged out of the hot tier window to the cold tier and rebuild the hot indexes without
+        them.  The new indexes are built without holding index_lock and swapped in once they're ready
+        :return: Number of records demoted
+        """
+
+        with self.index_lock:
+            records, count = self.records, len(self.records)
+
+        hot, cold = self._split_by_age(islice(records, count))
+        if not cold:
+            return 0
+
+        # Built outside the lock so hash checks and new records aren't held up while every hot record is indexed
+        indexes = self._new_indexes(len(hot))
+        gif_frames = HashMatrix('hash16')
+        self._index_hot(hot, indexes, gif_frames)
+
+        with self.index_lock:
+            self.cold_tier.append(cold)
+
+            # Records added while the new indexes were being built
+            added = list(islice(self.records, count, None))
+            hot.extend(added)
+            self._index_hot(added, indexes, gif_frames)
+
+            old_indexes = self.indexes
+            self.records = RecordList(hot)
+            self.indexes = indexes
+            self.gif_frames = gif_frames
+            self._drop_exact({r['image_id'] for r in cold})
+
+            # Tasks already submitted against the old matrices still map their rows through them
+            if self.match_engine == 'matrix':
+                for index in old_indexes.values():
+                    index.retire()
+
+        if self.match_engine == 'sharded':
+            self.shards.remove([r['image_id'] for r in cold])
+
+        print('Demoted {} Records To The Cold Tier'.format(len(cold)))
+        return len(cold)
+
+    def _index_hot(self, records, indexes, gif_frames):
+        if self.match_engine == 'sharded':
+            # Shards already hold the hashes.  Only the GIF frames are kept here
+            for r in records:
+                self._index_frames(r, gif_frames)
+        else:
+            self._index_batch(records, indexes, gif_frames)
+
+    def _demotion_thread(self):
+        while True:
+            time.sleep(3600)
+            self.demote_old_records()
+
+    def _record_tier(self, tier, started, hit):
+        elapsed = time.time() - started
+        metrics.observe('repostbot_stage_seconds', elapsed, stage='match', tier=tier)
+        self.tier_stats[tier]['searches'] += 1
+        self.tier_stats[tier]['seconds'] += elapsed
+        if hit:
+            self.tier_stats[tier]['hits'] += 1
+
+    def _search_cold(self, to_be_checked, hash_key, slot_held=False):
+        """
+        Search the cold tier in the process pool.  Only called once the hot tier has found nothing.  Takes a pool slot
+        like any other pool task
+        :param slot_held: Called from a hot search callback that's handing over its pool slot.  Waiting for a new slot
+        there would block the pool's result thread, which is what frees them
+        """
+
+        hash_words = hash_to_words(to_be_checked.get(hash_key), hash_key)
+        if self.cold_tier is None or not self.config.search_cold_tier or not len(self.cold_tier) or \
+                hash_words is None or hash_key not in self.cold_tier.hash_keys:
+            if slot_held:
+                self.pool_slots.release()
+            return
+
+        if not slot_held:
+            self.pool_slots.acquire()
+
+        column = self.cold_tier.hash_keys.index(hash_key)
+        self.total_in_queue += 1
+        try:
+            self.pool.apply_async(cold_matching_rows,
+                                  args=(self.cold_tier.hash_file(hash_key), self.cold_tier.valid_file(),
+                                        WORDS_PER_HASH[hash_key], column, len(self.cold_tier.hash_keys),
+                                        len(self.cold_tier), hash_words, self.config.hamming_cutoff - 1),
+                                  callback=partial(self.cold_cb, to_be_checked, time.time()),
+                                  error_callback=self.cold_error_cb)
+        except ValueError:
+            # Pool is being replaced after a process limit change
+            self.total_in_queue -= 1
+            self.pool_slots.release()
+
+    def cold_cb(self, to_be_checked, started, rows):
+
+        self.total_in_queue -= 1
+        result = self._build_result(to_be_checked, self.cold_tier.get_records(rows))
+        self._record_tier('cold', started, result)
+        if result:
+            self._repost_found(result, 'near', slot_held=True)
+        else:
+            self.pool_slots.release()
+
+    def cold_error_cb(self, r):
 
         self.total_in_queue -= 1
-        if r:
-            self.repost_queue.append(r)
+        self.pool_slots.release()
+        self.cb_error(r)
+
+    def queue_hash(self, record, digest=None):
+        """
+        Add a record to be checked for reposts.  Blocks while the hash queue is full, and while records are loading once
+        as many checks are held as the hash queue holds
+        :param digest: Digest of the downloaded file, as passed to add_record
+        """
+        if not self.loaded.is_set():
+            with self._waiting_lock:
+                if not self.loaded.is_set() and len(self.waiting_checks) < self.config.hash_queue_size:
+                    self.waiting_checks.append((record, digest))
+                    return
+
+            if not self.loaded.is_set():
+                self.backpressure_waits += 1
+                self.loaded.wait()
+
+        if self.hash_queue.full():
+            self.backpressure_waits += 1
+        self.hash_queue.put((record, digest))
+
+    def finish_loading(self):
+        """
+        Every existing record has been added.  Queue the checks that were held while loading
+        """
+        with self._waiting_lock:
+            waiting, self.waiting_checks = self.waiting_checks, []
+            self.loaded.set()
+
+        if waiting:
+            print('Checking {} Images Queued While Records Were Loading'.format(len(waiting)))
+        for record, digest in waiting:
+            self.queue_hash(record, digest)
+
+    def _repost_found(self, result, match_type, slot_held=False):
+        """
+        Hand a repost to the repost thread.  Waits while the repost queue is full, which holds up the hash thread and in
+        turn ingest.  No repost is ever dropped
+        :param slot_held: Called from a pool or shard callback holding the pool slot of the check.  Waiting there would
+        block the thread that finishes every other check, so the repost goes through the relay instead.  The slot is
+        only released once the repost is in the repost queue, so the hash thread stops submitting checks meanwhile
+        """
+        self.match_counts[match_type] += 1
+        metrics.inc('repostbot_reposts_found_total', match_type=match_type)
+        if slot_held:
+            self.repost_relay.put((result, self.pool_slots))
+        else:
+            self._queue_repost(result)
+
+    def _queue_repost(self, result):
+        if self.repost_queue.full():
+            self.repost_waits += 1
+        self.repost_queue.put(result)
+
+    def _relay_reposts(self):
+        while True:
+            result, pool_slots = self.repost_relay.get()
+            self._queue_repost(result)
+            pool_slots.release()
+
+    def close(self):
+        """
+        Release the shared memory used by the matrix engine and the shard connections
+        """
+        if self.match_engine == 'matrix':
+            with self.index_lock:
+                for index in self.indexes.values():
+                    index.close()
+        if self.shards:
+            self.shards.close()
+
+    def matrix_cb(self, to_be_checked, index, segment_name, started, rows):
+
+        self.total_in_queue -= 1
+        with self.index_lock:
+            index.release(segment_name)
+            matches = [index.records[i] for i in rows]
+
+        result = self._build_result(to_be_checked, matches)
+        self._record_tier('hot', started, result)
+        if result:
+            self._repost_found(result, 'near', slot_held=True)
+        else:
+            self._search_cold(to_be_checked, index.hash_key, slot_held=True)
+
+    def shard_cb(self, to_be_checked, started, future):
+
+        self.total_in_queue -= 1
+        try:
+            matches = future.result()
+        except Exception as e:
+            self.pool_slots.release()
+            self.cb_error(e)
+            return
+
+        result = self._build_result(to_be_checked, matches)
+        self._record_tier('hot', started, result)
+        if result:
+            self._repost_found(result, 'near', slot_held=True)
+        else:
+            self._search_cold(to_be_checked, self.match_key(), slot_held=True)
+
+    def matrix_error_cb(self, index, segment_name, r):
+
+        self.total_in_queue -= 1
+        self.pool_slots.release()
+        with self.index_lock:
+            index.release(segment_name)
+
+        self.cb_error(r)
 
     def cb_error(self, r):
-        print('Error in process: ' + r)
+        metrics.inc('repostbot_stage_errors_total', stage='match')
+        print('Error in process: {}'.format(r))
 
     def _spawn_main_hash_thread_proc(self):
         """
         Starts up a process pool using the number of processes set in the config.
-        As new images are added to the hash queue they are popped off and submitted to the process pool.
+        As new images are added to the hash queue they are taken off and submitted to the process pool.
+        Blocks while waiting for new images and while the pool has no free slots
         """
         while True:
             self.pool_status = 'Running'
             process_limit = self.config.hash_proc_limit
             pool = self.create_pool(process_limit)
+            self.pool = pool
+
+            # Keep each process busy with one task queued behind it.  Anything more waits in the hash queue
+            self.pool_slots = threading.BoundedSemaphore(process_limit * 2)
+
             while True:
 
-                if len(self.hash_queue) > 0:
-                    current_hash = self.hash_queue.pop(0)
-                    self.total_in_queue += 1
-                    pool.apply_async(self._repost_checker_proc, args=(current_hash, self.records, self.config.hash_size,
-                                                                      self.config.hamming_cutoff), callback=self.proc_cb,
-                                     error_callback=self.cb_error)
+                profiler.checkpoint()
 
                 # If user changes process limit close down pool and recreate
                 if process_limit != self.config.hash_proc_limit:
@@ -61,43 +524,201 @@ class HashProcessing():
                     pool.join()
                     break
 
+                # Wake up now and then to check for a process limit change
+                try:
+                    current_hash, digest = self.hash_queue.get(timeout=3)
+                except queue.Empty:
+                    continue
+
+                hash_key = self.match_key()
+
+                # Byte identical re-uploads and identical hashes of images added by this run are answered straight
+                # away.  Only misses go on to the near duplicate search
+                match_type, exact = self._exact_checker(current_hash, digest, hash_key)
+                if exact:
+                    self._repost_found(self._build_result(current_hash, exact), match_type)
+                    continue
+
+                # Animated GIFs are matched on their sampled frames so a re-cut or new first frame is still caught
+                if self.config.gif_frames and current_hash.get('frame_hashes'):
+                    with metrics.timer('repostbot_stage_seconds', stage='match', tier='gif'):
+                        result = self._gif_checker(current_hash)
+                    if result:
+                        self._repost_found(result, 'gif')
+                        continue
+
+                # Index lookups are cheap enough to do right here.  Shipping the index to a worker costs more
+                if self.match_engine in ('banded', 'bktree'):
+                    started = time.time()
+                    result = self._repost_checker_index(current_hash, hash_key, self.config.hamming_cutoff)
+                    self._record_tier('hot', started, result)
+                    if result:
+                        self._repost_found(result, 'near')
+                    else:
+                        self._search_cold(current_hash, hash_key)
+                    continue
+
+                hash_words = hash_to_words(current_hash.get(hash_key), hash_key)
+                if hash_words is None:
+                    continue
+
+                self.pool_slots.acquire()
+
+                # Every shard searches its part of the corpus.  The matches come back merged
+                if self.match_engine == 'sharded':
+                    self.total_in_queue += 1
+                    future = self.shards.search_async(hash_key, current_hash[hash_key], self.config.hamming_cutoff - 1)
+                    future.add_done_callback(partial(self.shard_cb, current_hash, time.time()))
+                    continue
+
+                # Workers read the hashes straight from shared memory.  Only the hash being checked is sent
+                with self.index_lock:
+                    index = self.indexes[hash_key]
+                    segment_name, rows = index.acquire()
+
+                # Existing check is hamming_distance < hd so search up to hd - 1
+                self.total_in_queue += 1
+                pool.apply_async(self._repost_checker_proc,
+                                 args=(segment_name, WORDS_PER_HASH[hash_key], rows, hash_words,
+                                       self.config.hamming_cutoff - 1),
+                                 callback=partial(self.matrix_cb, current_hash, index, segment_name, time.time()),
+                                 error_callback=partial(self.matrix_error_cb, index, segment_name))
+
+    def match_key(self):
+        """
+        Hash key new images are matched on.  Falls back to dhash if HashAlgorithm isn't one of the generated algorithms
+        """
+        key = hash_key(self.config.hash_algorithm, self.config.hash_size)
+        return key if key in self.hash_keys else hash_key('dhash', self.config.hash_size)
+
     def create_pool(self, process_limit):
-        return Pool(processes=process_limit, maxtasksperchild=15)
+        return Pool(processes=process_limit, maxtasksperchild=15, initializer=init_worker,
+                    initargs=profiler.worker_initargs(self.config.profile_path))
 
-    def _repost_checker_proc(self, to_be_checked, records, hashsize, hd):
+    def _build_result(self, to_be_checked, matches):
+        """
+        Drop matches from the same image or same user and build the result passed to the repost queue
+        :param to_be_checked: Record that was checked
+        :param matches: Records within the hamming cutoff
+        """
+
+        older_images = [r for r in matches
+                        if to_be_checked['image_id'] != r['image_id'] and r['user'] != to_be_checked['user']]
 
-        results = [{
+        if not older_images:
+            return None
+
+        return [{
             'image_id': to_be_checked['image_id'],
-            'older_images': []
+            'older_images': older_images
         }]
 
-        found_repost = None
+    def _exact_checker(self, to_be_checked, digest, hash_key):
+        """
+        Look for exact duplicates among the images added by this run.  First by content digest of the downloaded file
+        then by exact hash value
+        :return: Tuple of the match type to report a repost as and the records found.  ('near', []) if none
+        """
 
-        hash_size = 'hash' + hashsize
+        with self.index_lock:
+            by_digest = list(self.digests.get(digest, [])) if digest else []
+            by_hash = list(self.exact_hashes[hash_key].get(to_be_checked.get(hash_key), []))
 
-        for r in records:
+        if digest and self._build_result(to_be_checked, by_digest):
+            return 'digest', by_digest
 
-            if to_be_checked['image_id'] == r['image_id'] or r['user'] == to_be_checked['user']:
-                continue
+        if to_be_checked.get(hash_key) and self._build_result(to_be_checked, by_hash):
+            return 'exact_hash', by_hash
 
-            try:
-                hamming_distance = hamming(to_be_checked[hash_size], r[hash_size])
-            except ValueError:
-                continue
+        return 'near', []
+
+    def _gif_checker(self, to_be_checked):
+        """
+        Find GIFs sharing enough sampled frames with the provided one.  A GIF matches when at least GifFrameQuorum of
+        the frames of the shorter of the two sets are within GifHammingCutoff of a frame in the other
+        """
+
+        frames = hex_to_frame_hashes(to_be_checked.get('frame_hashes'))
+        if frames is None:
+            return None
 
-            if hamming_distance < hd:
-                found_repost = True
-                results[0]['older_images'].append(r)
+        # {image_id: [record, query frames that matched]}
+        hits = {}
+        with self.index_lock:
+            for i, frame in enumerate(frames):
+                for row in self.gif_frames.search(frame, self.config.gif_hamming_cutoff - 1):
+                    record = self.gif_frames.records[row]
+                    hits.setdefault(record['image_id'], [record, set()])[1].add(i)
 
-        return results if found_repost else None
+        matches = []
+        for record, matched in hits.values():
+            shorter = min(len(frames), len(record['frame_hashes']) // 16)
+            if len(matched) >= max(math.ceil(self.config.gif_frame_quorum * shorter), 1):
+                matches.append(record)
+
+        return self._build_result(to_be_checked, matches)
+
+    def _repost_checker_index(self, to_be_checked, hash_key, hd):
+        """
+        Find reposts of the provided record using the banded matrix or BK-tree for the selected hash size.
+        Returns results in the same format as the process pool checks
+        """
+
+        hash_words = hash_to_words(to_be_checked.get(hash_key), hash_key)
+        if hash_words is None:
+            return None
+
+        # Existing check is hamming_distance < hd so search up to hd - 1
+        with self.index_lock:
+            index = self.indexes[hash_key]
+            if self.match_engine == 'bktree':
+                matches = [r for d, r in index.search(int(to_be_checked[hash_key], 16), hd - 1)]
+            else:
+                matches = [index.records[i] for i in index.search(hash_words, hd - 1)]
+
+        return self._build_result(to_be_checked, matches)
+
+    @staticmethod
+    @worker_profiled
+    def _repost_checker_proc(segment_name, words, rows, hash_words, max_distance):
+        """
+        Runs in the process pool.  Compare the packed hash against every row of the shared hash matrix in one pass
+        :param segment_name: Shared memory segment holding the hash matrix
+        :param words: Words per hash in the matrix
+        :param rows: Number of rows to search
+        :param hash_words: Packed hash being checked
+        :param max_distance: Maximum bit distance to count as a match
+        :return: Matching row indexes
+        """
+        return shared_matching_rows(segment_name, words, rows, hash_words, max_distance)
 
 
     def generate_hash(self, img):
         """
-        Generate the dhash of the provided image.
+        Generate every hash of the provided image.  All 3 sizes of each algorithm come from a single decode of the
+        image.  With ReducedDecode only hash16 is generated and the larger sizes are left empty
         """
+        timings = {}
+        hash_sizes = (8,) if self.config.reduced_decode else tuple(HASH_KEY_SIZES.values())
+        hashes = hash_multi(img, algorithms=self.hash_algorithms, hash_sizes=hash_sizes,
+                            reduced_decode=self.config.reduced_decode, timings=timings) or {}
+        for stage, seconds in timings.items():
+            metrics.observe('repostbot_stage_seconds', seconds, stage=stage)
+        if not hashes:
+            metrics.inc('repostbot_stage_errors_total', stage='hash')
         results = {}
-        results['hash16'] = dhash(img, hash_size=8)
-        results['hash64'] = dhash(img, hash_size=16)
-        results['hash256'] = dhash(img, hash_size=32)
+        for algorithm in self.hash_algorithms:
+            for size, grid in HASH_KEY_SIZES.items():
+                results[hash_key(algorithm, size)] = hashes[algorithm][grid][0] if grid in hashes.get(algorithm, {}) \
+                    else None
+
+        # Animated GIFs also get a set of sampled frame hashes
+        if hashes and self.config.gif_frames:
+            gif_timings = {}
+            frames = gif_frame_hashes(img, max_frames=self.config.gif_frames, timings=gif_timings)
+            if frames is not None:
+                results['frame_hashes'] = frame_hashes_to_hex(frames)
+                metrics.observe('repostbot_stage_seconds', gif_timings['gif'], stage='gif_frames')
+                metrics.inc('repostbot_gif_frames_decoded_total', gif_timings['gif_scanned'])
+                metrics.inc('repostbot_gif_frames_hashed_total', gif_timings['gif_frames'])
         return results
\ No newline at end of file
@@ -1,16 +1,22 @@
-from ImgurRepostDB import ImgurRepostDB
+from ImgurRepostDB import ImgurRepostDB, RESCAN_MARGIN
 from imgurpython import ImgurClient
 from ConfigManager import ConfigManager
 from imgurpython.helpers.error import ImgurClientError, ImgurClientRateLimitError
-from urllib import request
-from urllib.error import HTTPError
-from PIL import Image
-from io import BytesIO
 import threading
 import time
 import os
 import logging
 from ImgurHashProcessing import HashProcessing
+from ImageFetcher import ImageFetcher
+from HashAlgorithms import hash_keys
+from HashSnapshot import HashSnapshot
+from Metrics import metrics, MetricsServer
+from Profiling import profiler
+from RequestScheduler import RequestScheduler
+from ActionDispatcher import ActionDispatcher
+from BackfillCheckpoint import BackfillCheckpoint
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from operator import itemgetter
 
 class ImgurRepostBot():
@@ -18,13 +24,18 @@ class ImgurRepostBot():
     def __init__(self):
 
         os.system('cls')
-        self.failed_downvotes = []  # Store failed downvotes for later processing
-        self.failed_comments = []  # Store failed comments for later processing
-        self.delay_between_requests = 5  # Changed on the fly depending on remaining credits and time until reset
         self.thread_lock = threading.Lock()
         self.logger = None
         self.detected_reposts = 0
 
+        # Incremental polling state.  Submitted time of the newest image handled by live polling and the observed
+        # submission rate in images per second.  The rate sets how long to wait between polls
+        self.newest_submitted = 0
+        self.submission_rate = None
+        self.poll_interval = None
+        self.last_poll = None
+        self.last_poll_pages = 0
+
 
         self.config = ConfigManager()
         self._setup_logging()
@@ -34,19 +45,67 @@ class ImgurRepostBot():
                                         self.config.api_details['access_token'],
                                         self.config.api_details['refresh_token'])
 
+        # Every API request takes a token.  Live polling gets priority over retries and backfill
+        self.scheduler = RequestScheduler(self.imgur_client, self.config)
+
+        # Votes and comments run on their own workers from a queue that survives restarts
+        self.actions = ActionDispatcher(self.config.action_queue, self._perform_action, self.scheduler,
+                                        workers=self.config.action_threads,
+                                        max_attempts=self.config.action_max_attempts)
+
+        self.image_fetcher = ImageFetcher(max_workers=self.config.download_threads,
+                                          per_host_limit=self.config.downloads_per_host,
+                                          timeout=self.config.download_timeout,
+                                          max_bytes=self.config.max_image_size * 1024 * 1024,
+                                          output_error=self._output_error)
+
         self.db_conn = ImgurRepostDB(self.config)
 
-        self.backfill_progress = 1 if self.config.backfill else 'Disabled'
+        self.backfill_progress = 'Starting' if self.config.backfill else 'Disabled'
 
-        records, processed_ids = self.db_conn.build_existing_ids()
+        self.snapshot = None
+        if self.config.snapshot:
+            self.snapshot = HashSnapshot(self.config.snapshot_path, self.config.database_details['storage'],
+                                         '{}/{}'.format(self.config.database_details['Host'],
+                                                        self.config.database_details['Database']),
+                                         hash_keys(self.config.hash_algorithms), rescan_margin=RESCAN_MARGIN)
+
+        # Records are streamed in the background, newest first.  Live polling starts once the newest chunk is in but
+        # repost checks are held until every record is loaded
+        latest = self.db_conn.latest_record_id()
+        expected_records = (self.db_conn.count_records_until(latest) if latest is not None else 0) or 0
+        self.hash_processing = HashProcessing(self.config, [], [], capacity=expected_records, loading=True)
+        threading.Thread(target=self._load_existing_records, name='RecordLoader').start()
 
         if self.config.backfill:
             threading.Thread(target=self._backfill_database, name='Backfill').start()
 
-        self.hash_processing = HashProcessing(self.config, processed_ids, records)
-
         threading.Thread(target=self._repost_processing_thread, name='RepostProcessing').start()
+        threading.Thread(target=profiler.run, args=(self.config,), name='Profiler', daemon=True).start()
 
+        if self.config.metrics_port:
+            self._register_gauges()
+            MetricsServer(self.config.metrics_host, self.config.metrics_port).start()
+
+    def _register_gauges(self):
+        """
+        Values read straight from the bot each time the metrics endpoint is scraped
+        """
+        hash_processing = self.hash_processing
+        metrics.gauge('repostbot_queue_depth', hash_processing.hash_queue.qsize, queue='hash')
+        metrics.gauge('repostbot_queue_depth', hash_processing.repost_queue.qsize, queue='repost')
+        metrics.gauge('repostbot_queue_depth', lambda: len(self.db_conn.write_buffer), queue='db_write')
+        metrics.gauge('repostbot_pool_tasks_in_flight', lambda: hash_processing.total_in_queue)
+        metrics.gauge('repostbot_pool_utilisation',
+                      lambda: hash_processing.total_in_queue / (self.config.hash_proc_limit * 2))
+        metrics.gauge('repostbot_images_seen', lambda: len(hash_processing.processed_ids))
+        metrics.gauge('repostbot_reposts_detected', lambda: self.detected_reposts)
+        metrics.gauge('repostbot_queue_depth', self.actions.pending, queue='actions')
+        metrics.gauge('repostbot_api_tokens', lambda: self.scheduler.tokens)
+        metrics.gauge('repostbot_api_requests_per_minute', lambda: self.scheduler.rate * 60)
+        for credit in ('ClientRemaining', 'UserRemaining'):
+            metrics.gauge('repostbot_api_credits', lambda credit=credit: self.imgur_client.credits[credit],
+                          credit=credit)
 
 
     def _check_thread_status(self):
@@ -107,66 +166,138 @@ class ImgurRepostBot():
         if self.config.logging:
             self.logger.info(msg)
 
-    def _backfill_database(self):
+    def _load_existing_records(self):
         """
-        Backfill the database with older posts.  Useful if script hasn't been run in some time"
-        :return:
+        Load existing records into hash processing.  When snapshots are enabled the snapshot is loaded first and only
+        rows newer than it are pulled from the database.  Falls back to a full load if the snapshot is missing, stale
+        or corrupt
         """
 
+        after = None
+        if self.snapshot:
+            start = time.time()
+            if self.snapshot.load(verify_count=self.db_conn.count_records_until):
+                self.hash_processing.add_snapshot(self.snapshot)
+                after = self.snapshot.high_water_mark
+                self._output_info('Loaded {} Records From Snapshot In {} Seconds'.format(
+                    len(self.snapshot.records), round(time.time() - start, 1)))
+
+        new_records = []
+
+        def on_chunk(chunk):
+            profiler.checkpoint()
+            if after is not None:
+                # Skip rows under the high water mark that were read again and are already in the snapshot
+                chunk = [r for r in chunk if r['image_id'] not in self.hash_processing.processed_ids]
+            self.hash_processing.add_records(chunk)
+            if self.snapshot:
+                new_records.extend(chunk)
+
+        self.db_conn.build_existing_ids(on_chunk, after=after)
+        self.hash_processing.finish_loading()
+
+        if self.snapshot:
+            if new_records:
+                self.snapshot.append(new_records, max(r['db_id'] for r in new_records))
+            threading.Thread(target=self._snapshot_thread, name='SnapshotWriter', daemon=True).start()
+
+    def _snapshot_thread(self):
+        """
+        Keep the snapshot current.  Only rows added to the database since the last snapshot are fetched
+        """
         while True:
-            if self.config.backfill:
-                original_start_page = self.config.backfill_start_page # So we can detect if it's changed in the config
-                current_page = self.config.backfill_start_page
-                while current_page < self.config.backfill_depth + self.config.backfill_start_page:
+            time.sleep(self.config.snapshot_interval * 60)
 
-                    if not self.db_conn.records_loaded:
-                        continue
+            new_records = []
+            for chunk in self.db_conn.stream_records(after=self.snapshot.high_water_mark):
+                new_records.extend(chunk)
 
-                    self.backfill_progress = current_page
-                    self.insert_latest_images(page=current_page, backfill=True)
-                    current_page += 1
-                    time.sleep(self.delay_between_requests)
+            if new_records:
+                self.snapshot.append(new_records, max(r['db_id'] for r in new_records))
 
-                    if self.config.backfill_start_page != original_start_page:
-                        print('Backfill Start Page Changed In Config')
-                        break
+    def _backfill_database(self):
+        """
+        Backfill the database with older posts.  Useful if script hasn't been run in some time.
+        Several pages are worked on at once within the API budget.  Finished pages are saved to a checkpoint so a
+        restart carries on from where the last run stopped
+        """
 
-                self.backfill_progress = 'Completed'
-                break
-            else:
+        while True:
+            if not self.config.backfill:
                 self.backfill_progress = 'Disabled'
                 time.sleep(5)
+                continue
 
-    def _generate_img(self, url=None):
+            self.db_conn.records_loaded.wait()
+
+            checkpoint = BackfillCheckpoint(self.config.backfill_checkpoint, self.config.backfill_start_page,
+                                            self.config.backfill_depth)
+            self._update_backfill_progress(checkpoint)
+
+            with ThreadPoolExecutor(max_workers=self.config.backfill_threads,
+                                    thread_name_prefix='Backfill') as executor:
+                list(executor.map(partial(self._backfill_page, checkpoint), checkpoint.remaining()))
+
+            if self._backfill_moved(checkpoint):
+                print('Backfill Start Page Changed In Config')
+                continue
+
+            if not checkpoint.remaining():
+                # Stay parked rather than exit so the thread check doesn't restart it.  Carries on if backfill is
+                # moved or switched back on in the config
+                self.backfill_progress = 'Completed'
+                while self.config.backfill and not self._backfill_moved(checkpoint):
+                    time.sleep(60)
+                continue
+
+            # Pages that failed to load are tried again
+            time.sleep(60)
+
+    def _backfill_moved(self, checkpoint):
         """
-        Generate the image files provided from Imgur.  We pass the data straight from the request into PIL.Image
+        BackfillStartPage or BackfillDepth has changed in the config since the checkpoint was made
         """
+        return (checkpoint.start_page, checkpoint.depth) != (self.config.backfill_start_page,
+                                                             self.config.backfill_depth)
 
-        img = None
-        if not url:
-            return None
+    def _backfill_page(self, checkpoint, page):
 
-        try:
-            response = request.urlopen(url)
-            img = Image.open(BytesIO(response.read()))
-        except (HTTPError, ConnectionError, OSError) as e:
-            msg = 'Error Generating Image File: \n Error Message: {}'.format(e)
-            self._output_error(msg)
+        # Let the remaining pages drain if backfill was switched off or moved while running
+        if not self.config.backfill or self._backfill_moved(checkpoint):
+            return
 
-            return None
+        profiler.checkpoint()
+        new_images = self.insert_latest_images(page=page, backfill=True)
+        if new_images is not None:
+            checkpoint.mark_done(page, all_seen=not new_images)
+        self._update_backfill_progress(checkpoint)
 
-        return img if img else None
+    def _update_backfill_progress(self, checkpoint):
+        self.backfill_progress = '{} / {} Pages ({} Already In Database)'.format(len(checkpoint.completed),
+                                                                                 checkpoint.depth, checkpoint.skipped)
 
-    def generate_latest_images(self, section='user', sort='time', page=0):
+    def _generate_img(self, url=None):
+        """
+        Generate the image files provided from Imgur.  We pass the data straight from the request into PIL.Image
+        """
+
+        return self.image_fetcher.fetch(url)
 
-        self._adjust_rate_limit_timing()
+    def generate_latest_images(self, section='user', sort='time', page=0, priority='live'):
+
+        self.scheduler.acquire(priority)
 
         items = []
         try:
-            temp = self.imgur_client.gallery(section=section, sort=sort, page=page, show_viral=False)
+            with metrics.timer('repostbot_stage_seconds', stage='gallery_fetch'):
+                temp = self.imgur_client.gallery(section=section, sort=sort, page=page, show_viral=False)
             if temp:
                 items = [i for i in temp if not i.is_album and not self.check_post_title(title=i.title)]
         except (ImgurClientError, ImgurClientRateLimitError) as e:
+            items = None
+            if isinstance(e, ImgurClientRateLimitError):
+                self.scheduler.rate_limited()
+            metrics.inc('repostbot_stage_errors_total', stage='gallery_fetch')
             msg = 'Error Getting Gallery: {}'.format(e)
             self._output_error(msg)
 
@@ -175,23 +306,94 @@ class ImgurRepostBot():
     def insert_latest_images(self, section='user', sort='time', page=0, backfill=False):
         """
         Pull all current images from user sub, get the hashes and insert into database.
+        :return: Number of images on the page that hadn't been seen before.  None if the page couldn't be loaded or any
+        image on it failed to download, so backfill tries the page again
         """
 
-        # Don't start inserts until all records are loaded
-        if not self.db_conn.records_loaded:
+        # Don't start inserts until the newest records are loaded.  Backfill reaches older images so it waits for all
+        if not self.db_conn.recent_records_loaded.is_set():
+            return
+
+        if backfill and not self.db_conn.records_loaded.is_set():
             return
 
-        items = self.generate_latest_images(section=section, sort=sort, page=page)
+        items = self.generate_latest_images(section=section, sort=sort, page=page,
+                                            priority='backfill' if backfill else 'live')
+
+        if items is None:
+            return None
+
+        new_images, failed = self._insert_items(items, backfill=backfill)
+        return None if failed else new_images
+
+    def poll_new_images(self):
+        """
+        Walk forward through user sub from the first page until we reach images that were handled on an earlier poll.
+        When submissions spike, new images pushed past the first page between polls are still picked up.
+        """
 
-        if not items:
+        if not self.db_conn.recent_records_loaded.is_set():
             return
 
-        # Don't add again if we have already done this image ID
-        for item in items:
-            if item.id in self.hash_processing.processed_ids:
-                continue
+        now = time.time()
+        new_images = 0
+        pages = 0
+        newest = self.newest_submitted
+
+        for page in range(self.config.max_poll_pages):
+            items = self.generate_latest_images(page=page)
+            pages += 1
+            if items is None:
+                break
+
+            # Check before inserting.  Inserting marks everything on the page as seen
+            reached_seen = any(item.id in self.hash_processing.processed_ids or item.datetime <= self.newest_submitted
+                               for item in items)
+
+            new_images += self._insert_items(items)[0]
+            newest = max([newest] + [item.datetime for item in items])
+
+            if reached_seen:
+                break
+
+        self.newest_submitted = newest
+        self.last_poll_pages = pages
+        self._adjust_poll_interval(new_images, now)
+
+    def _adjust_poll_interval(self, new_images, now):
+        """
+        Aim to find about PollTargetImages new images on each poll.  Faster when submissions pick up, slower when quiet
+        """
+
+        if self.last_poll:
+            rate = new_images / max(now - self.last_poll, 1)
+            self.submission_rate = rate if self.submission_rate is None else self.submission_rate * 0.7 + rate * 0.3
+        self.last_poll = now
+
+        if not self.submission_rate:
+            interval = self.config.max_poll_interval
+        else:
+            interval = self.config.poll_target_images / self.submission_rate
+
+        # Needing more than one page means we fell behind
+        if self.last_poll_pages > 1:
+            interval = self.config.min_time_between_requests
+
+        self.poll_interval = min(max(interval, self.config.min_time_between_requests), self.config.max_poll_interval)
+
+    def _insert_items(self, items, backfill=False):
+        """
+        Download, hash and insert the gallery items we haven't seen before
+        :return: Tuple of the number of new images and how many of them failed to download
+        """
+
+        # Don't add again if we have already done this image ID.  Claiming the ID up front stops the live and
+        # backfill threads from both processing the same image
+        new_items = [item for item in items if self.hash_processing.processed_ids.add(item.id)]
+        failed = 0
 
-            img = self._generate_img(url=item.link)
+        # Download the whole page in parallel and hash each image as soon as it arrives
+        for item, img, digest in self.image_fetcher.fetch_all(new_items):
             if img:
                 image_hash = self.hash_processing.generate_hash(img)
                 if image_hash:
@@ -201,56 +403,69 @@ class ImgurRepostBot():
                         'url': item.link,
                         'gallery_url': 'https://imgur.com/gallery/{}'.format(item.id),
                         'user': item.account_url,
-                        'submitted': item.datetime,
-                        'hash16': image_hash['hash16'],
-                        'hash64': image_hash['hash64'],
-                        'hash256': image_hash['hash256']
+                        'submitted': item.datetime
                     }
+                    # Every hash key of every algorithm in HashAlgorithms, plus frame_hashes for animated GIFs
+                    record.update(image_hash)
 
-                    self.hash_processing.processed_ids.append(item.id)
-                    self.hash_processing.records.append(record)
+                    self.hash_processing.add_record(record, digest)
+
+                    metrics.inc('repostbot_images_processed_total', source='backfill' if backfill else 'live')
 
                     # If this is called from back filling don't add hash to be checked
                     if not backfill:
-                        self.hash_processing.hash_queue.append(record)
+                        self.hash_processing.queue_hash(record, digest)
                         print('Processing {}'.format(item.link))
                     else:
                         print('Backfill Insert {}'.format(item.link))
 
                     self.db_conn.add_entry(record)
+            else:
+                # Download failed.  Release the ID so it's tried again on a later pass
+                self.hash_processing.processed_ids.discard(item.id)
+                failed += 1
+
+        return len(new_items), failed
 
     def downvote_repost(self, image_id):
         """
-        Downvote the provided Image ID
+        Queue a downvote on the provided Image ID
         """
-        try:
-            self.imgur_client.gallery_item_vote(image_id, vote="down")
-        except ImgurClientError as e:
-            self.failed_downvotes.append(image_id)
-            msg = 'Error Voting: {}'.format(e)
-            self._output_error(msg)
+        self.actions.submit('downvote', image_id)
 
     def comment_repost(self, image_id=None, values=None):
         """
-        Leave a comment on the detected repost.
+        Queue a comment on the detected repost.
         :param image_id: ID of image to leave comment on.
         :param values: Values to be inserted into the message template
         :return:
         """
+        self.actions.submit('comment', image_id, values)
 
-        self._output_info('Leaving Comment On {}'.format(image_id))
-        message = self.build_comment_message(values=values)
-
-        if not message:
-            return
+    def _perform_action(self, action, image_id, payload):
+        """
+        Called by the action dispatcher workers.  Raises on failure so the action is retried
+        """
 
         try:
-            self.imgur_client.gallery_comment(image_id, message)
-        except (ImgurClientError, ImgurClientRateLimitError) as e:
-            self.failed_comments.append({'image_id': image_id, 'values': values})
-            msg = 'Error Posting Commment: {}'.format(e)
-            self._output_error(msg)
+            if action == 'downvote':
+                with metrics.timer('repostbot_stage_seconds', stage='vote'):
+                    self.imgur_client.gallery_item_vote(image_id, vote="down")
 
+            elif action == 'comment':
+                self._output_info('Leaving Comment On {}'.format(image_id))
+                message = self.build_comment_message(values=payload)
+                if not message:
+                    return
+                with metrics.timer('repostbot_stage_seconds', stage='comment'):
+                    self.imgur_client.gallery_comment(image_id, message)
+
+        except (ImgurClientError, ImgurClientRateLimitError) as e:
+            if isinstance(e, ImgurClientRateLimitError):
+                self.scheduler.rate_limited()
+            metrics.inc('repostbot_stage_errors_total', stage='vote' if action == 'downvote' else 'comment')
+            self._output_error('Error Posting {} On {}: {}'.format(action.title(), image_id, e))
+            raise
 
     def build_comment_message(self, values=None):
 
@@ -279,38 +494,15 @@ class ImgurRepostBot():
             return None
 
 
-    def flush_failed_votes_and_comments(self):
-        """
-        If there have been any failed votes or comments (due to imgur server overload) try to redo them
-        """
-
-        if self.failed_downvotes:
-            for image_id in self.failed_downvotes:
-                try:
-                    self.imgur_client.gallery_item_vote(image_id, vote="down")
-                    self.failed_downvotes.remove(image_id)
-                except (ImgurClientError, ImgurClientRateLimitError) as e:
-                    msg = 'Failed To Retry Downvote On Image {}.  \nError: {}'.format(image_id, e)
-                    self._output_error(msg)
-
-        if self.failed_comments:
-            for failed in self.failed_comments:
-                try:
-                    message = self.build_comment_message(values=failed['values'])
-                    self.imgur_client.gallery_comment(failed['image_id'], message)
-                    self.failed_comments.remove(failed['image_id'])
-                except (ImgurClientError, ImgurClientRateLimitError) as e:
-                    msg = 'Failed To Retry Comment On Image {}.  \nError: {}'.format(failed['image_id'], e)
-                    self._output_error(msg)
-
     def _repost_processing_thread(self):
         """
         Runs in background monitor the queue for detected reposts
         :return:
         """
         while True:
-            if len(self.hash_processing.repost_queue) > 0:
-                current_repost = self.hash_processing.repost_queue.pop(0)
+            current_repost = self.hash_processing.repost_queue.get()
+            profiler.checkpoint()
+            if current_repost:
                 image_id = current_repost[0]['image_id']
                 sorted_reposts = sorted(current_repost[0]['older_images'], key=itemgetter('submitted'))
 
@@ -329,39 +521,6 @@ class ImgurRepostBot():
                         for r in sorted_reposts:
                             f.write(r['gallery_url'] + '\n')
 
-    def _adjust_rate_limit_timing(self):
-        """
-        Adjust the timing used between request to spread all requests over allowed rate limit
-
-        """
-
-        # API Fails To Return This At Times
-        if not self.imgur_client.credits['ClientRemaining']:
-            return
-
-        remaining_credits_before = int(self.imgur_client.credits['ClientRemaining'])
-        self.imgur_client.credits = self.imgur_client.get_credits()  # Refresh the credit data
-
-        # Imgur API sometimes returns 12500 credits remaining in error.  If this happens don't update request delay.
-        # Otherwise the delay will drop to the minimum set in the config and can cause premature credit exhaustion
-        if int(self.imgur_client.credits['ClientRemaining']) - remaining_credits_before > 100:
-            """
-            print('Imgur API Returned Wrong Remaining Credits.  Keeping Last Request Delay Time')
-            print('API Credits: ' + str(self.imgur_client.credits['ClientRemaining']))
-            print('Last Credits: ' + str(remaining_credits_before))
-            """
-            return
-
-        remaining_credits = self.imgur_client.credits['ClientRemaining']
-        reset_time = self.imgur_client.credits['UserReset'] + 240  # Add a 4 minute buffer so we don't cut it so close
-        remaining_seconds = reset_time - round(time.time())
-        seconds_per_credit = round(remaining_seconds / remaining_credits)  # TODO Getting division by zero sometimes
-
-        if seconds_per_credit < self.config.min_time_between_requests:
-            self.delay_between_requests = self.config.min_time_between_requests
-        else:
-            self.delay_between_requests = seconds_per_credit
-
     def check_post_title(self, title=None):
         """
         Checks the post title for values that we will use to skip over it
@@ -381,17 +540,51 @@ class ImgurRepostBot():
         print('[+] Backfill: {} '.format('Enabled' if self.config.backfill else 'Disabled'))
         print('[+] Backfill Depth: {} '.format(self.config.backfill_depth if self.config.backfill else 'Disabled'))
         print('[+] Process Pool Size: {} '.format(self.config.hash_proc_limit))
-        print('[+] Hash Size: {} bit'.format(self.config.hash_size))
+        print('[+] Hash Size: {} bit  Matching On: {}'.format(self.config.hash_size, self.hash_processing.match_key()))
+        print('[+] Match Engine: {}'.format(self.config.match_engine))
         print('[+] Hamming Distance: {}{}'.format(self.config.hamming_cutoff, '\n'))
 
     def print_current_stats(self):
         print('Current Stats')
         print('[+] Total Images In Database: {}'.format(str(len(self.hash_processing.processed_ids))))
+        print('[+] Seen Image Registry Size: {} MB'.format(
+            round(self.hash_processing.processed_ids.memory_usage() / 1024 / 1024, 1)))
+        if not self.db_conn.records_loaded.is_set():
+            print('[+] Loading Records From Database: {} Loaded.  {} Checks Waiting For The Load'.format(
+                self.db_conn.records_loading_progress, len(self.hash_processing.waiting_checks)))
         print('[+] Total Hashes Waiting In Pool: {}'.format(str(self.hash_processing.total_in_queue)))
-        print('[+] Total Hashes In Hash Queue: {}'.format(str(len(self.hash_processing.hash_queue))))
+        print('[+] Total Hashes In Hash Queue: {} / {}'.format(self.hash_processing.hash_queue.qsize(),
+                                                               self.hash_processing.hash_queue.maxsize))
+        print('[+] Total Reposts Waiting For Action: {}  Times Checks Waited On Full Repost Queue: {}'.format(
+            self.hash_processing.repost_queue.qsize() + self.hash_processing.repost_relay.qsize(),
+            self.hash_processing.repost_waits))
+        print('[+] Times Ingest Waited On Full Hash Queue: {}'.format(self.hash_processing.backpressure_waits))
+        match_counts = self.hash_processing.match_counts
+        exact = match_counts['digest'] + match_counts['exact_hash']
+        total_matches = exact + match_counts['gif'] + match_counts['near']
+        print('[+] Exact Duplicates: {}% Of Reposts (File: {}  Hash: {}  GIF Frames: {}  Near: {})'.format(
+            round(exact / total_matches * 100, 1) if total_matches else 0, match_counts['digest'],
+            match_counts['exact_hash'], match_counts['gif'], match_counts['near']))
+        if self.hash_processing.cold_tier is not None:
+            for tier, stats in self.hash_processing.tier_stats.items():
+                print('[+] {} Tier: {} Images  Hit Rate: {}%  Avg Search: {} ms'.format(
+                    tier.title(),
+                    len(self.hash_processing.records) if tier == 'hot' else len(self.hash_processing.cold_tier),
+                    round(stats['hits'] / stats['searches'] * 100, 1) if stats['searches'] else 0,
+                    round(stats['seconds'] / stats['searches'] * 1000, 1) if stats['searches'] else 0))
+        if self.hash_processing.shards:
+            print('[+] Hash Shards: {}  Records Per Shard: {}'.format(
+                len(self.hash_processing.shards.shards),
+                ', '.join(str(shard['rows']) for shard in self.hash_processing.shards.shards)))
         print('[+] Process Pool Status: {}'.format(self.hash_processing.pool_status))
         print('[+] Total Reposts Found: {}'.format(str(self.detected_reposts)))
-        print('[+] Backfill Progress: {}\n'.format('Page ' + str(self.backfill_progress) if self.config.backfill else 'Disabled'))
+        print('[+] Votes And Comments Queued: {}  Done: {}  Given Up: {}'.format(self.actions.pending(),
+                                                                              self.actions.completed,
+                                                                              self.actions.failed()))
+        print('[+] DB Writes Buffered: {}  Last Flush: {}  Total Flushed: {}'.format(len(self.db_conn.write_buffer),
+                                                                               self.db_conn.last_flush_count,
+                                                                               self.db_conn.total_flushed))
+        print('[+] Backfill Progress: {}\n'.format(self.backfill_progress if self.config.backfill else 'Disabled'))
 
 
     def print_api_stats(self):
@@ -400,12 +593,15 @@ class ImgurRepostBot():
         if self.imgur_client.credits['UserReset']:
             print('[+] Time Until Credit Reset: {} Minutes'.format(round((int(self.imgur_client.credits['UserReset']) - time.time()) / 60)))
 
-        # Make it clear we are overriding the default delay to meet credit refill window
-        if self.delay_between_requests == self.config.min_time_between_requests:
-            request_delay = str(self.delay_between_requests) + ' Seconds'
-        else:
-            request_delay = str(self.delay_between_requests) + ' Seconds (Overridden By Rate Limit)'
-        print('[+] Delay Between Requests: {} \n'.format(request_delay))
+        scheduler = self.scheduler
+        print('[+] Request Budget: {} Per Minute  Tokens Available: {}'.format(round(scheduler.rate * 60, 1),
+                                                                          round(scheduler.tokens, 1)))
+        if self.poll_interval:
+            print('[+] Poll Interval: {} Seconds  Submission Rate: {} Per Minute  Pages Last Poll: {}'.format(
+                round(self.poll_interval), round((self.submission_rate or 0) * 60, 1), self.last_poll_pages))
+        print('[+] Requests Made: Live {}  Retry {}  Backfill {} \n'.format(scheduler.granted['live'],
+                                                                         scheduler.granted['retry'],
+                                                                         scheduler.granted['backfill']))
 
     def run(self):
 
@@ -413,15 +609,15 @@ class ImgurRepostBot():
 
         while True:
 
+            profiler.checkpoint()
             os.system('cls')
 
             self.print_current_stats()
             self.print_current_settings()
             self.print_api_stats()
 
-            if round(time.time()) - last_run > self.delay_between_requests:
-                self.insert_latest_images()
-                self.flush_failed_votes_and_comments()
+            if round(time.time()) - last_run > (self.poll_interval or self.config.min_time_between_requests):
+                self.poll_new_images()
                 last_run = round(time.time())
 
             self._check_thread_status()
@@ -434,7 +630,10 @@ def main():
     # TODO This is sloppy.  Quick way to keep it running when I'm not watching it
 
     rcheck = ImgurRepostBot()
-    rcheck.run()
+    try:
+        rcheck.run()
+    finally:
+        rcheck.db_conn.flush()  # Don't lose buffered records on shutdown
     """
     while True:
         try:
@@ -1,11 +1,24 @@
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.exc import OperationalError, InternalError
-from sqlalchemy.orm import Session, scoped_session, sessionmaker
-from sqlalchemy import create_engine, DateTime, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, select, func
 import datetime
 import sys
 import time
-from pymongo import MongoClient
+import threading
+import atexit
+from pymongo import MongoClient, UpdateOne
+from bson import ObjectId
+
+from HashAlgorithms import ALGORITHMS, DHASH_KEYS, hash_keys
+from Metrics import metrics
+
+# Columns older tables may not have.  Hashes from the extra algorithms and GIF frame hashes
+OPTIONAL_COLUMNS = [k for k in hash_keys(ALGORITHMS) if k not in DHASH_KEYS] + ['frame_hashes']
+
+# MySQL ids are handed out when a row is inserted but rows can be committed out of id order, so a row just under the
+# newest id seen may not have been visible yet.  Reads after an id go back this many ids and callers skip what they have
+RESCAN_MARGIN = 1000
 
 class ImgurRepostDB():
     """
@@ -15,15 +28,26 @@ class ImgurRepostDB():
 
     def __init__(self, config):
 
-        self.records_loaded = False
+        self.records_loaded = threading.Event()
+        self.recent_records_loaded = threading.Event()  # First chunk (newest records) has been loaded
+        self.records_loading_progress = 0
         self.config = config  # TODO might be better to skip not set as instance variable
         self.storage_engine = config.database_details['storage']
 
+        # Write behind buffer.  New records are collected and written in a single bulk insert
+        self.write_buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush_count = 0
+        self.total_flushed = 0
+
         if self.storage_engine == 'mysql':
             self._setup_mysql()
         elif self.storage_engine == 'mongodb':
             self._setup_mongodb()
 
+        threading.Thread(target=self._flush_thread, name='DBWriter', daemon=True).start()
+        atexit.register(self.flush)
 
 
     def _setup_mysql(self):
@@ -41,6 +65,7 @@ class ImgurRepostDB():
             print('[!] ERROR: Problem Connecting To Database {}'.format(e))
             sys.exit(1)
 
+        self.engine = engine
         self.imgur_reposts = Base.classes.imgur_reposts
         self.Session = scoped_session(sessionmaker(bind=engine))
 
@@ -52,23 +77,75 @@ class ImgurRepostDB():
 
     def add_entry(self, record):
         """
-        Forward add requests to correct mathod for storage engine
+        Add a record to the write buffer.  The buffer is written to the database once it reaches DBFlushSize records
+        or every DBFlushInterval seconds, whichever comes first
         :param record:
         :return:
         """
-        if self.storage_engine == 'mysql':
-            self._add_entry_mysql(record)
-        elif self.storage_engine == 'mongodb':
-            self._add_entry_mongodb(record)
+        with self.buffer_lock:
+            self.write_buffer.append(record)
+            buffered = len(self.write_buffer)
+
+        if buffered >= self.config.db_flush_size:
+            self.flush()
+
+    def _flush_thread(self):
+        """
+        Flush the write buffer on a timer so records don't sit in memory when traffic is slow
+        """
+        while True:
+            time.sleep(self.config.db_flush_interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Write everything in the buffer to the database in one bulk insert.  Forward to correct method for storage engine
+        :return: Number of records written
+        """
+
+        # Only one flush at a time so a slow insert doesn't get a second one stacked on top of it
+        with self.flush_lock:
+            with self.buffer_lock:
+                records, self.write_buffer = self.write_buffer, []
+
+            if not records:
+                return 0
 
+            start = time.perf_counter()
+            if self.storage_engine == 'mysql':
+                written = self._flush_mysql(records)
+            elif self.storage_engine == 'mongodb':
+                written = self._flush_mongodb(records)
+            else:
+                written = 0
 
-    def _add_entry_mongodb(self, record):
-        record['date'] = datetime.datetime.utcnow()
-        result = self.mongodb_db[self.config.database_details['Collection']].insert_one(record)
+            metrics.observe('repostbot_stage_seconds', time.perf_counter() - start, stage='db_write')
+            metrics.inc('repostbot_db_records_written_total', written)
+            if written < len(records):
+                metrics.inc('repostbot_stage_errors_total', len(records) - written, stage='db_write')
 
-    def _add_entry_mysql(self, record):
+            self.last_flush_count = written
+            self.total_flushed += written
+            print('Flushed {} Records To Database'.format(written))
+            return written
+
+    def _flush_mongodb(self, records):
+
+        # Copy so Mongo doesn't add date and _id to the records we keep in memory
+        now = datetime.datetime.utcnow()
+        documents = [dict(r, date=now) for r in records]
+
+        try:
+            self.mongodb_db[self.config.database_details['Collection']].insert_many(documents, ordered=False)
+            return len(documents)
+        except Exception as e:
+            print('Exception during bulk insert')
+            print(e)
+            return getattr(e, 'details', {}).get('nInserted', 0)
+
+    def _mysql_mapping(self, record, now):
         """
-        Insert the provided data into the database
+        Convert a record to the column mapping used for the imgur_reposts table
         """
         hash16, hash64, hash256 = 'NULL', 'NULL', 'NULL'
 
@@ -81,65 +158,203 @@ class ImgurRepostDB():
         if record['hash256'] != 'NULL':
             hash256 = record['hash256']
 
+        mapping = {'date': now, 'url': record['url'], 'hash': hash16, 'hash64': hash64, 'hash256': hash256,
+                   'user': record['user'], 'image_id': record['image_id'], 'submitted_to_imgur': record['submitted']}
+
+        # Older tables don't have columns for GIF frame hashes or the extra hash algorithms
+        for column in OPTIONAL_COLUMNS:
+            if column in self.imgur_reposts.__table__.c:
+                mapping[column] = record.get(column)
+
+        return mapping
+
+    def _flush_mysql(self, records):
+        """
+        Insert the provided records into the database as a single multi row insert.
+        If the bulk insert fails fall back to one at a time so a single bad row doesn't lose the whole batch
+        """
+
+        now = datetime.datetime.utcnow()
+        mappings = [self._mysql_mapping(r, now) for r in records]
+
         local_session = self.Session()  # Grab the DB session for this thread
 
         try:
-            local_session.add(self.imgur_reposts(date=datetime.datetime.utcnow(), url=record['url'], hash=hash16, hash64=hash64,
-                                                 hash256=hash256, user=record['user'], image_id=record['image_id'], submitted_to_imgur=record['submitted']))
-            local_session.flush()
+            local_session.bulk_insert_mappings(self.imgur_reposts, mappings)
             local_session.commit()
+            return len(mappings)
         except Exception as e:
-            print('Exception during insert')
+            local_session.rollback()
+            print('Exception during bulk insert.  Retrying records individually')
             print(e)
 
-    def build_existing_ids(self):
+        written = 0
+        for mapping in mappings:
+            try:
+                local_session.add(self.imgur_reposts(**mapping))
+                local_session.commit()
+                written += 1
+            except Exception as e:
+                local_session.rollback()
+                print('Exception during insert')
+                print(e)
+
+        return written
+
+    def build_existing_ids(self, on_chunk, after=None):
+        """
+        Stream all existing records out of the database, newest first, passing them to on_chunk as each chunk arrives.
+        Only the columns needed for repost checks are loaded.
+        :param on_chunk: Called with a list of record dicts for each chunk
+        :param after: Only load rows newer than this database id.  Used when the rest came from a snapshot.  Rows just
+        under it can be returned again.  See stream_records
+        :return: Total records loaded
+        """
+
+        print('Loading Records From The Database.  This May Take Several Minutes.')
+
+        total = 0
+        for chunk in self.stream_records(after=after):
+            on_chunk(chunk)
+            total += len(chunk)
+            self.records_loading_progress = total
+            self.recent_records_loaded.set()
+
+        print('Loaded {} Records From Database'.format(total))
+        self.recent_records_loaded.set()
+        self.records_loaded.set()
+        return total
+
+    def stream_records(self, after=None, before=None):
+        """
+        Generator of record chunks, newest first.  Each record includes its database id as db_id
+        :param after: Only return rows newer than this database id.  MySQL also returns the RESCAN_MARGIN ids below it
+        :param before: Only return rows older than this database id
+        """
         if self.storage_engine == 'mysql':
-            return self._build_existing_ids_mysql()
+            return self._stream_existing_records_mysql(after, before)
         elif self.storage_engine == 'mongodb':
-            return self._build_existing_ids_mongodb()
+            return self._stream_existing_records_mongodb(after, before)
+        return iter([])
 
-    def _build_existing_ids_mongodb(self):
-        existing_records = []
-        image_ids = []
-        result = self.mongodb_db[self.config.database_details['Collection']].find()
+    def latest_record_id(self):
+        """
+        Database id of the newest row or None if the database is empty
+        """
+        if self.storage_engine == 'mysql':
+            table = self.imgur_reposts.__table__
+            with self.engine.connect() as conn:
+                return conn.execute(select(func.max(table.c.id))).scalar()
+        elif self.storage_engine == 'mongodb':
+            newest = self.mongodb_db[self.config.database_details['Collection']].find_one(
+                {}, projection={'_id': 1}, sort=[('_id', -1)])
+            return str(newest['_id']) if newest else None
 
+    def update_hashes(self, updates):
+        """
+        Overwrite the hash columns of existing rows in one bulk update
+        :param updates: List of dicts with db_id and the hash keys (hash16, phash64, frame_hashes etc) to set
+        :return: Number of rows updated
+        """
+
+        if not updates:
+            return 0
+
+        if self.storage_engine == 'mysql':
+            # hash16 is stored in the hash column.  Everything else has a column of the same name
+            mappings = [dict({{'hash16': 'hash'}.get(k, k): v for k, v in u.items() if k != 'db_id'}, id=u['db_id'])
+                        for u in updates]
+            local_session = self.Session()
+            try:
+                local_session.bulk_update_mappings(self.imgur_reposts, mappings)
+                local_session.commit()
+                return len(mappings)
+            except Exception as e:
+                local_session.rollback()
+                print('Exception during bulk update')
+                print(e)
+                return 0
+        elif self.storage_engine == 'mongodb':
+            operations = [UpdateOne({'_id': ObjectId(u['db_id'])},
+                                    {'$set': {k: v for k, v in u.items() if k != 'db_id'}}) for u in updates]
+            try:
+                return self.mongodb_db[self.config.database_details['Collection']].bulk_write(
+                    operations, ordered=False).matched_count
+            except Exception as e:
+                print('Exception during bulk update')
+                print(e)
+                return getattr(e, 'details', {}).get('nMatched', 0)
+        return 0
+
+    def count_records_until(self, high_water_mark):
+        """
+        Count the rows with a database id up to and including the provided one.  Used to verify snapshots
+        """
+        if self.storage_engine == 'mysql':
+            table = self.imgur_reposts.__table__
+            with self.engine.connect() as conn:
+                return conn.execute(select(func.count()).select_from(table)
+                                    .where(table.c.id <= high_water_mark)).scalar()
+        elif self.storage_engine == 'mongodb':
+            collection = self.mongodb_db[self.config.database_details['Collection']]
+            return collection.count_documents({'_id': {'$lte': ObjectId(high_water_mark)}})
+
+    def _stream_existing_records_mongodb(self, after=None, before=None):
+
+        query = {}
+        if after:
+            query.setdefault('_id', {})['$gt'] = ObjectId(after)
+        if before:
+            query.setdefault('_id', {})['$lt'] = ObjectId(before)
+        projection = {'_id': 1, 'image_id': 1, 'url': 1, 'user': 1, 'submitted_to_imgur': 1}
+        projection.update({column: 1 for column in list(DHASH_KEYS) + OPTIONAL_COLUMNS})
+        result = self.mongodb_db[self.config.database_details['Collection']].find(
+            query, projection=projection, batch_size=self.config.load_chunk_size).sort('_id', -1)
+
+        chunk = []
         for r in result:
-            image_ids.append(r['image_id'])
             record = {
+                'db_id': str(r['_id']),
                 'image_id': r['image_id'],
                 'url': r['url'],
                 'gallery_url': 'https://imgur.com/gallery/{}'.format(r['image_id']),
                 'user': r['user'],
-                'submitted': r['submitted_to_imgur'],
-                'hash16': r['hash16'],
-                'hash64': r['hash64'],
-                'hash256': r['hash256']
+                'submitted': r.get('submitted_to_imgur')
             }
-            existing_records.append(record)
+            for column in list(DHASH_KEYS) + OPTIONAL_COLUMNS:
+                record[column] = r.get(column)
+            chunk.append(record)
 
-        print('Loaded {} Records From Database'.format(len(existing_records)))
-        self.records_loaded = True
-        return existing_records, image_ids
+            if len(chunk) >= self.config.load_chunk_size:
+                yield chunk
+                chunk = []
 
-    def _build_existing_ids_mysql(self):
+        if chunk:
+            yield chunk
+
+    def _stream_existing_records_mysql(self, after=None, before=None):
         """
-        Build a list of all existing Image IDs in the database.  The prevents us from reinserting an image we have already
-        checked.
+        Stream existing records through a server side cursor so the full table is never held in memory at once.
+        The url is loaded along with the hash columns since comments and the repost log link to it.
         """
 
-        print('Loading Records From The Database.  This May Take Several Minutes.')
-        local_session = self.Session()  # Grab the DB session for this thread
-
         # TODO We can probably limit this to last 24 hours of IDs.
-        existing_records = []
-        #result = local_session.query(self.imgur_reposts).all()
-        result = local_session.query(self.imgur_reposts).from_statement(text("SELECT * from imgur_reposts")).all()
-
-        image_ids = []
-        if len(result) > 0:
-            for r in result:
-                image_ids.append(r.image_id)
-                record = {
+        table = self.imgur_reposts.__table__
+        columns = [table.c.id, table.c.image_id, table.c.url, table.c.user, table.c.submitted_to_imgur,
+                   table.c.hash, table.c.hash64, table.c.hash256]
+        optional = [column for column in OPTIONAL_COLUMNS if column in table.c]
+        columns += [table.c[column] for column in optional]
+        query = select(*columns).order_by(table.c.id.desc())
+        if after is not None:
+            query = query.where(table.c.id > after - RESCAN_MARGIN)
+        if before is not None:
+            query = query.where(table.c.id < before)
+
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            for rows in result.partitions(self.config.load_chunk_size):
+                yield [dict({
+                    'db_id': r.id,
                     'image_id': r.image_id,
                     'url': r.url,
                     'gallery_url': 'https://imgur.com/gallery/{}'.format(r.image_id),
@@ -148,9 +363,4 @@ class ImgurRepostDB():
                     'hash16': r.hash,
                     'hash64': r.hash64,
                     'hash256': r.hash256
-                }
-                existing_records.append(record)
-
-        print('Loaded {} Records From Database'.format(len(existing_records)))
-        self.records_loaded = True
-        return existing_records, image_ids
+                }, **{column: getattr(r, column, None) for column in OPTIONAL_COLUMNS}) for r in rows]
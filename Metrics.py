@@ -0,0 +1,196 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bound of each latency histogram bucket in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Metrics():
+    """
+    Counters, latency histograms and gauges updated by the bot threads.
+
+    Updates are a dict lookup and an add under one lock so they are cheap enough to call for every image.  Gauges are
+    functions that are only called when the metrics are read, so queue depths and credit levels cost nothing between
+    scrapes.  Every metric can carry labels, passed as keyword arguments.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): [count per bucket..., count over the last bucket, sum]}
+        self.gauges = {}  # {(name, labels): function returning the current value}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add to a counter
+        """
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a latency in a histogram
+        """
+        key = _key(name, labels)
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram = self.histograms[key]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the body of a with block into a histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a function that returns the current value of a gauge.  Called each time metrics are read
+        """
+        with self.lock:
+            self.gauges[_key(name, labels)] = func
+
+    def _read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+
+        values = {}
+        for key, func in gauges:
+            try:
+                value = func()
+            except Exception:
+                continue
+            if value is not None:
+                values[key] = float(value)
+        return values
+
+    def snapshot(self):
+        """
+        Current value of every metric as a JSON friendly dict
+        """
+
+        gauges = self._read_gauges()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        def entries(items, build):
+            return [dict(name=name, labels=dict(labels), **build(value)) for (name, labels), value in sorted(items)]
+
+        return {
+            'timestamp': time.time(),
+            'counters': entries(counters.items(), lambda v: {'value': v}),
+            'gauges': entries(gauges.items(), lambda v: {'value': v}),
+            'histograms': entries(histograms.items(), lambda v: {
+                'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], v[:-1])),
+                'count': sum(v[:-1]),
+                'sum': v[-1]
+            })
+        }
+
+    def prometheus(self):
+        """
+        Current value of every metric in the Prometheus text format
+        """
+
+        gauges = self._read_gauges()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for (name, labels), value in sorted(counters.items()):
+            add_type(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+        for (name, labels), value in sorted(gauges.items()):
+            add_type(name, 'gauge')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+        for (name, labels), values in sorted(histograms.items()):
+            add_type(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by every module.  Threads update it directly
+metrics = Metrics()
+
+
+class MetricsServer():
+    """
+    Serves metrics over HTTP.  /metrics is the Prometheus text format and /metrics.json is JSON
+    """
+
+    def __init__(self, host, port, registry=metrics):
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body, content_type = registry.prometheus(), 'text/plain; version=0.0.4'
+                elif path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would flood the console
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True).start()
+        print('Serving Metrics On http://{}:{}/metrics'.format(*self.address))
@@ -0,0 +1,251 @@
+"""
+Find near duplicate images in a local directory or tar archive without touching the Imgur API.
+
+Usage:
+    python OfflineDedup.py /path/to/images
+    python OfflineDedup.py images.tar.gz --hash-size 64 --cutoff 6 --output clusters.jsonl
+    python OfflineDedup.py /path/to/images --algorithm phash --cutoff 4
+    python OfflineDedup.py /path/to/images --include-singletons --output hashes.jsonl
+
+Images are read one at a time from the directory or archive and hashed across a process pool, so the whole set is
+never held in memory.  Hashes are indexed as they arrive and every pair closer than the cutoff is joined into the same
+cluster.  Each cluster is written as one line of JSON with the name and hash of every image in it.  With
+--include-singletons every image is written, which can be used to seed a new database.
+
+HashSize, HashAlgorithm and HammingCutoff mean the same as in bot.ini.  A progress line and summary are printed to
+stderr.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tarfile
+import time
+from collections import deque
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+
+from PIL import Image
+
+from HashAlgorithms import ALGORITHMS, HASH_KEY_SIZES, hash_key as algorithm_hash_key, hash_multi
+from HashMatrix import BandedHashMatrix
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+BATCH_SIZE = 16  # Images sent to a worker per task
+
+
+def read_images(source):
+    """
+    Yield (name, image bytes) for every image in a directory or tar archive.  Tar archives are read as a stream so
+    compressed archives don't need to be extracted first
+    """
+
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if not file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    with open(path, 'rb') as f:
+                        yield os.path.relpath(path, source), f.read()
+                except OSError as e:
+                    print('[!] Unable To Read {}: {}'.format(path, e), file=sys.stderr)
+        return
+
+    with tarfile.open(source, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield member.name, tar.extractfile(member).read()
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def hash_batch(batch, algorithm, hash_size, reduced_decode):
+    """
+    Runs in a pool worker.  Hash a batch of images with one algorithm
+    :return: List of (name, hex hash, packed words).  Hash and words are None if the image couldn't be hashed
+    """
+
+    results = []
+    for name, data in batch:
+        try:
+            hashes = hash_multi(Image.open(BytesIO(data)), (algorithm,), (hash_size,), reduced_decode)
+        except OSError:
+            hashes = None
+        results.append((name,) + (hashes[algorithm][hash_size] if hashes else (None, None)))
+    return results
+
+
+class Clusters():
+    """
+    Union find over image rows.  Near duplicates are chained together, so A ~ B and B ~ C puts all three in one
+    cluster even when A and C are further apart than the cutoff
+    """
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, row):
+        parent = self.parent
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # Keep the earliest image as the root
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def groups(self):
+        """
+        :return: {root row: [rows]} in the order images were read
+        """
+        groups = {}
+        for row in range(len(self.parent)):
+            groups.setdefault(self.find(row), []).append(row)
+        return groups
+
+
+class OfflineDedup():
+
+    def __init__(self, hash_key=16, hamming_cutoff=3, processes=None, reduced_decode=False, algorithm='dhash'):
+
+        if hash_key not in HASH_KEY_SIZES:
+            raise ValueError('Hash size must be one of {}'.format(', '.join(str(s) for s in HASH_KEY_SIZES)))
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Hash algorithm must be one of {}'.format(', '.join(ALGORITHMS)))
+        if reduced_decode and hash_key != 16:
+            raise ValueError('Reduced decode only works with hash size 16')
+
+        self.algorithm = algorithm
+        self.hash_key = algorithm_hash_key(algorithm, hash_key)
+        self.hash_size = HASH_KEY_SIZES[hash_key]
+        self.max_distance = hamming_cutoff - 1  # Same as the bot.  A match is anything under the cutoff
+        self.processes = processes or cpu_count()
+        self.reduced_decode = reduced_decode
+
+        self.index = BandedHashMatrix(self.hash_key, self.max_distance)
+        self.clusters = Clusters()
+        self.names = []  # Image name for each index row
+        self.read = 0
+        self.errors = 0
+
+    def _index(self, results):
+        for name, hash_value, words in results:
+            if words is None:
+                self.errors += 1
+                print('[!] Unable To Hash {}'.format(name), file=sys.stderr)
+                continue
+
+            row = self.clusters.add()
+            for match in self.index.search(words, self.max_distance):
+                self.clusters.union(row, int(match))
+            self.index.add(words, hash_value)
+            self.names.append(name)
+
+    def run(self, source, progress_interval=10):
+        """
+        Hash and index every image in the source.  At most a few batches per process are in flight so memory use
+        stays flat however large the source is
+        """
+
+        start = last_progress = time.time()
+        pending = deque()
+
+        with Pool(processes=self.processes) as pool:
+            for batch in batches(read_images(source), BATCH_SIZE):
+                self.read += len(batch)
+                pending.append(pool.apply_async(hash_batch, (batch, self.algorithm, self.hash_size,
+                                                                self.reduced_decode)))
+
+                if len(pending) >= self.processes * 2:
+                    self._index(pending.popleft().get())
+
+                if time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    print('Read {} Images.  Indexed {} ({} / sec)'.format(
+                        self.read, len(self.index), round(len(self.index) / (last_progress - start))), file=sys.stderr)
+
+            while pending:
+                self._index(pending.popleft().get())
+
+        return time.time() - start
+
+    def write_clusters(self, output, include_singletons=False):
+        """
+        Write one JSON line per cluster, largest first
+        :return: Number of clusters with more than one image
+        """
+
+        duplicates = 0
+        groups = sorted(self.clusters.groups().values(), key=lambda rows: (-len(rows), rows[0]))
+        for cluster, rows in enumerate(groups):
+            if len(rows) > 1:
+                duplicates += 1
+            elif not include_singletons:
+                break
+
+            output.write(json.dumps({
+                'cluster': cluster,
+                'size': len(rows),
+                'hash_key': self.hash_key,
+                'images': [{'name': self.names[row], self.hash_key: self.index.records[row]} for row in rows]
+            }) + '\n')
+
+        return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near duplicate images in a directory or tar archive')
+    parser.add_argument('source', help='Image directory or tar archive')
+    parser.add_argument('--hash-size', type=int, default=16, choices=sorted(HASH_KEY_SIZES),
+                        help='Same as HashSize in bot.ini')
+    parser.add_argument('--algorithm', default='dhash', choices=list(ALGORITHMS),
+                        help='Same as HashAlgorithm in bot.ini')
+    parser.add_argument('--cutoff', type=int, default=3, help='Same as HammingCutoff in bot.ini')
+    parser.add_argument('--processes', type=int, default=None, help='Hashing processes.  Defaults to every core')
+    parser.add_argument('--reduced-decode', action='store_true', help='Same as ReducedDecode in bot.ini')
+    parser.add_argument('--include-singletons', action='store_true', help='Also write images with no duplicates')
+    parser.add_argument('--output', help='JSONL file to write.  Defaults to stdout')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        parser.error('{} does not exist'.format(args.source))
+    if args.cutoff < 1:
+        parser.error('--cutoff must be at least 1')
+    if args.reduced_decode and args.hash_size != 16:
+        parser.error('--reduced-decode only works with --hash-size 16')
+
+    dedup = OfflineDedup(args.hash_size, args.cutoff, args.processes, args.reduced_decode, args.algorithm)
+    elapsed = dedup.run(args.source)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            duplicates = dedup.write_clusters(f, args.include_singletons)
+    else:
+        duplicates = dedup.write_clusters(sys.stdout, args.include_singletons)
+
+    print('Hashed {} Of {} Images In {} Seconds ({} Errors).  Found {} Duplicate Clusters'.format(
+        len(dedup.index), dedup.read, round(elapsed, 1), dedup.errors, duplicates), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import cProfile
+import functools
+import os
+import threading
+import time
+from multiprocessing import Value
+from multiprocessing.util import Finalize
+
+# Profiling state of a pool worker.  Only set in processes started with init_worker
+_worker = {}
+
+
+def _dump(profile, path, label):
+    os.makedirs(path, exist_ok=True)
+    file_name = os.path.join(path, '{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), label.replace(' ', '_')))
+    profile.dump_stats(file_name)
+    return file_name
+
+
+class Profiler():
+    """
+    cProfile capture that can be switched on and off per thread while the bot is running.
+
+    cProfile only profiles the thread that enabled it, so each instrumented thread calls checkpoint() once per loop
+    and starts, stops or dumps its own profile there.  While nothing has changed checkpoint is a single attribute
+    compare, so leaving the calls in costs nothing when profiling is off.  A thread that is blocked waiting for work
+    picks up changes the next time it wakes.
+
+    Pool workers get the state through shared values set up by init_worker.  Each worker dumps its profile when
+    profiling is switched off, when a dump is requested and when the worker exits.
+    """
+
+    def __init__(self):
+
+        self.enabled = False
+        self.workers = False
+        self.threads = set()  # Thread name prefixes to profile.  Empty profiles every instrumented thread
+        self.path = os.path.join(os.getcwd(), 'profiles')
+        self.version = 0  # Bumped whenever threads need to look at the settings again
+        self.dump_version = 0
+        self._local = threading.local()
+        self._worker_enabled = None
+        self._worker_dump = None
+
+    def checkpoint(self):
+        """
+        Call from thread loops.  Applies any change to the profiling settings to the calling thread
+        """
+        if getattr(self._local, 'version', 0) != self.version:
+            self._sync_thread()
+
+    def _sync_thread(self):
+
+        local = self._local
+        name = threading.current_thread().name
+        wanted = self.enabled and (not self.threads or any(name.startswith(t) for t in self.threads))
+        profile = getattr(local, 'profile', None)
+
+        if profile and (not wanted or local.dump_version != self.dump_version):
+            profile.disable()
+            print('Saved Profile {}'.format(_dump(profile, self.path, name)))
+            local.profile = profile = None
+
+        if wanted and not profile:
+            local.profile = cProfile.Profile()
+            try:
+                local.profile.enable()
+            except ValueError as e:
+                # Newer Pythons only allow one active cProfile at a time
+                print('[!] Unable To Profile Thread {}: {}'.format(name, e))
+                local.profile = None
+
+        local.version = self.version
+        local.dump_version = self.dump_version
+
+    def worker_initargs(self, path):
+        """
+        Arguments for init_worker when creating a process pool
+        """
+        if self._worker_enabled is None:
+            self._worker_enabled = Value('b', int(self.enabled and self.workers), lock=False)
+            self._worker_dump = Value('i', 0, lock=False)
+        return self._worker_enabled, self._worker_dump, path
+
+    def update(self, config):
+        """
+        Pick up changes to the profiling options in the config
+        """
+
+        threads = set(config.profile_threads)
+        if (config.profile, config.profile_workers, threads) == (self.enabled, self.workers, self.threads):
+            return
+
+        self.path = config.profile_path
+        self.enabled = config.profile
+        self.workers = config.profile_workers
+        self.threads = threads
+        self.version += 1
+        if self._worker_enabled is not None:
+            self._worker_enabled.value = int(self.enabled and self.workers)
+        print('Profiling {}'.format('Enabled' if self.enabled else 'Disabled'))
+
+    def request_dump(self):
+        """
+        Ask every profiled thread and worker to save what it has captured so far and start a new profile
+        """
+        self.dump_version += 1
+        self.version += 1
+        if self._worker_dump is not None:
+            self._worker_dump.value += 1
+
+    def run(self, config):
+        """
+        Watch the config for profiling changes and dump on a schedule.  Creating a file named DUMP in ProfilePath
+        triggers a dump straight away
+        """
+
+        last_dump = time.time()
+        while True:
+            self.update(config)
+
+            trigger = os.path.join(config.profile_path, 'DUMP')
+            due = self.enabled and config.profile_dump_interval and \
+                time.time() - last_dump >= config.profile_dump_interval * 60
+
+            if os.path.isfile(trigger) or due:
+                if os.path.isfile(trigger):
+                    os.remove(trigger)
+                self.request_dump()
+                last_dump = time.time()
+
+            time.sleep(3)
+
+
+# Shared by every module.  Threads call profiler.checkpoint() from their loops
+profiler = Profiler()
+
+
+def init_worker(enabled, dump_version, path):
+    """
+    Process pool initializer.  Hooks the worker up to the shared profiling state
+    """
+    _worker.update(enabled=enabled, dump=dump_version, seen_dump=dump_version.value, path=path, profile=None)
+    Finalize(None, _stop_worker_profile, exitpriority=10)
+
+
+def _stop_worker_profile():
+    profile = _worker.get('profile')
+    if profile:
+        _dump(profile, _worker['path'], 'worker-{}'.format(os.getpid()))
+        _worker['profile'] = None
+
+
+def worker_profiled(func):
+    """
+    Profile a pool task in the worker while worker profiling is switched on
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        if not _worker or (not _worker['enabled'].value and not _worker['profile']):
+            return func(*args, **kwargs)
+
+        if not _worker['enabled'].value or _worker['dump'].value != _worker['seen_dump']:
+            _stop_worker_profile()
+            _worker['seen_dump'] = _worker['dump'].value
+
+        if not _worker['enabled'].value:
+            return func(*args, **kwargs)
+
+        # Only profile while a task runs so time spent waiting for the next one doesn't swamp the results
+        if not _worker['profile']:
+            _worker['profile'] = cProfile.Profile()
+        _worker['profile'].enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _worker['profile'].disable()
+
+    return wrapper
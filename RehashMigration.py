@@ -0,0 +1,321 @@
+"""
+Re-download and re-hash the images of existing database rows and write the new hashes back.
+
+Usage:
+    python RehashMigration.py
+    python RehashMigration.py --columns hash64,hash256 --only-missing
+    python RehashMigration.py --columns phash16,phash64,phash256 --only-missing
+    python RehashMigration.py --processes 2 --max-rate 20
+
+Run from the folder holding bot.ini.  The database settings and ReducedDecode are read from it.  With ReducedDecode
+on, hash16 columns come from a reduced decode like the bot makes them and larger columns from a full decode.
+
+Rows are read newest first in pages of LoadChunkSize and downloaded and hashed across a process pool.  New hashes
+are written back in bulk every --write-size rows.  Progress is saved to a checkpoint after every write so a stopped
+migration picks up where it left off.  Rows added after the migration started are left alone since the running bot
+already hashes them.
+
+The bot can keep running while this runs.  Writes are small bulk updates, workers run at a lower CPU priority and
+--max-rate caps the rows handled per second.  Once it finishes, delete the hash snapshot and restart the bot so the
+new hashes are loaded.
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+
+from PIL import Image
+
+from ConfigManager import ConfigManager
+from Dhash import REDUCED_DECODE_HASH_SIZE, gif_frame_hashes, frame_hashes_to_hex
+from HashAlgorithms import ALGORITHMS, DHASH_KEYS, hash_keys as algorithm_hash_keys, hash_multi, parse_hash_key
+from ImageFetcher import ImageFetcher
+from ImgurRepostDB import ImgurRepostDB
+
+# Every column that can be regenerated.  A hash column for every algorithm and size, plus frame_hashes which is only set
+# for animated GIFs
+COLUMNS = algorithm_hash_keys(ALGORITHMS) + ['frame_hashes']
+BATCH_SIZE = 16  # Rows sent to a worker per task
+
+# Set in each pool worker by init_worker
+_fetcher = None
+
+
+def init_worker(download_threads, timeout, max_bytes):
+    global _fetcher
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    _fetcher = ImageFetcher(max_workers=download_threads, timeout=timeout, max_bytes=max_bytes,
+                            output_error=lambda msg: None)
+
+
+def rehash_batch(batch, hash_keys, reduced_decode, gif_frames):
+    """
+    Runs in a pool worker.  Download a batch of images in parallel and hash each one
+    :param batch: List of (db_id, url)
+    :param gif_frames: Frames to sample from animated GIFs when frame_hashes is one of the hash keys
+    :return: List of update dicts with db_id and the new hash for each hash key.  None for images that failed
+    """
+
+    # Always hash something since it's what tells us the image could be hashed at all
+    parsed = {k: parse_hash_key(k) for k in hash_keys if k != 'frame_hashes'}
+    algorithms = sorted({algorithm for algorithm, grid in parsed.values()}) or ['dhash']
+    hash_sizes = sorted({grid for algorithm, grid in parsed.values()}) or [8]
+
+    # Sizes a reduced decode can't make get their own full decode
+    if reduced_decode:
+        decodes = [([s for s in hash_sizes if s <= REDUCED_DECODE_HASH_SIZE], True),
+                   ([s for s in hash_sizes if s > REDUCED_DECODE_HASH_SIZE], False)]
+    else:
+        decodes = [(hash_sizes, False)]
+    decodes = [(sizes, reduced) for sizes, reduced in decodes if sizes]
+
+    results = []
+    for (db_id, url), data in zip(batch, _fetcher.executor.map(_fetcher.download, [url for db_id, url in batch])):
+        update = None
+        try:
+            hashes = {} if data else None
+            for sizes, reduced in decodes if data else ():
+                # A JPEG drafted for a reduced decode can't be decoded again at full size so each decode reopens it
+                part = hash_multi(Image.open(BytesIO(data)), algorithms, sizes, reduced)
+                if not part:
+                    hashes = None
+                    break
+                for algorithm, by_size in part.items():
+                    hashes.setdefault(algorithm, {}).update(by_size)
+            if hashes:
+                update = {k: hashes[algorithm][grid][0] for k, (algorithm, grid) in parsed.items()}
+                if 'frame_hashes' in hash_keys:
+                    frames = gif_frame_hashes(Image.open(BytesIO(data)), max_frames=gif_frames)
+                    update['frame_hashes'] = frame_hashes_to_hex(frames) if frames is not None else None
+                update['db_id'] = db_id
+        except OSError:
+            update = None
+        results.append(update)
+    return results
+
+
+class RehashCheckpoint():
+    """
+    Oldest row the migration has written back so far.  Only reused for the same high water mark and hash columns
+    """
+
+    def __init__(self, path, high_water_mark, hash_keys):
+
+        self.path = path
+        self.high_water_mark = high_water_mark
+        self.hash_keys = list(hash_keys)
+        self.cursor = None  # db_id of the oldest row handled.  Everything newer is done
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get('high_water_mark') != self.high_water_mark or data.get('hash_keys') != self.hash_keys:
+            print('[!] Rehash Checkpoint Is For A Different Run.  Starting Over')
+            return
+
+        self.cursor = data.get('cursor')
+        self.done = data.get('done', 0)
+        self.failed = data.get('failed', 0)
+        self.skipped = data.get('skipped', 0)
+        print('Resuming Rehash.  {} Rows Already Done'.format(self.done + self.failed + self.skipped))
+
+    def save(self, cursor, done, failed, skipped):
+        self.cursor, self.done, self.failed, self.skipped = cursor, done, failed, skipped
+        data = {'high_water_mark': self.high_water_mark, 'hash_keys': self.hash_keys, 'cursor': cursor,
+                'done': done, 'failed': failed, 'skipped': skipped}
+        temp_file = self.path + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_file, self.path)
+
+
+def _missing(value):
+    return not value or value == 'NULL'
+
+
+class RehashMigration():
+
+    def __init__(self, config, hash_keys, checkpoint_path, processes=None, write_size=500, max_rate=0,
+                 only_missing=False):
+
+        self.config = config
+        self.hash_keys = hash_keys
+        self.processes = processes or max(cpu_count() // 2, 1)
+        self.write_size = write_size
+        self.max_rate = max_rate
+        self.only_missing = only_missing
+
+        self.db = ImgurRepostDB(config)
+        if config.database_details['storage'] == 'mysql':
+            table_columns = self.db.imgur_reposts.__table__.c
+            missing = [k for k in hash_keys if {'hash16': 'hash'}.get(k, k) not in table_columns]
+            if missing:
+                raise ValueError('imgur_reposts has no column for {}.  Add it before migrating'.format(
+                    ', '.join(missing)))
+
+        high_water_mark = self.db.latest_record_id()
+        self.checkpoint = RehashCheckpoint(checkpoint_path, high_water_mark, hash_keys)
+        self.total = self.db.count_records_until(high_water_mark) if high_water_mark is not None else 0
+        self.done = self.checkpoint.done
+        self.failed = self.checkpoint.failed
+        self.skipped = self.checkpoint.skipped
+        self.updates = []
+
+    def _pages(self):
+        """
+        Yield rows from the checkpoint onwards, newest first.  Each page is a fresh query so no cursor is held open on
+        the database for the length of the migration
+        """
+
+        before = self.checkpoint.cursor
+        while True:
+            records = self.db.stream_records(before=before)
+            page = next(records, None)
+            records.close()
+            if not page:
+                return
+
+            before = page[-1]['db_id']
+            # Leave rows added since the migration started to the bot.  Mongo ids are hex strings that sort by age
+            page = [r for r in page if r['db_id'] <= self.checkpoint.high_water_mark]
+            if page:
+                yield page
+
+    def _batches(self):
+        """
+        Yield (cursor, batch, skipped) for each batch of rows.  cursor is the db_id of the last row covered by the batch
+        and skipped the number of rows in that range --only-missing left out
+        """
+        for page in self._pages():
+            batch = []
+            skipped = 0
+            for record in page:
+                if self.only_missing and not any(_missing(record.get(k)) for k in self.hash_keys):
+                    skipped += 1
+                    continue
+                if self.hash_keys == ['frame_hashes'] and not record['url'].lower().endswith('.gif'):
+                    # Only GIFs have frame hashes.  No point downloading anything else
+                    skipped += 1
+                    continue
+                batch.append((record['db_id'], record['url']))
+                if len(batch) == BATCH_SIZE:
+                    yield batch[-1][0], batch, skipped
+                    batch = []
+                    skipped = 0
+            if batch or skipped:
+                # Taking the cursor from the page moves the checkpoint past skipped rows at the end of it
+                yield page[-1]['db_id'], batch, skipped
+
+    def _write(self, cursor):
+        written = self.db.update_hashes(self.updates)
+        if written < len(self.updates):
+            raise RuntimeError('Bulk update failed.  Stopping so the checkpoint stays behind the failed rows')
+        self.updates = []
+        self.checkpoint.save(cursor, self.done, self.failed, self.skipped)
+
+    def _progress(self, started, handled):
+        elapsed = time.time() - started
+        rate = handled / elapsed if elapsed else 0
+        remaining = max(self.total - self.done - self.failed - self.skipped, 0)
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate else '?'
+        print('Rehashed {} Of {} Rows ({} / sec, {} Failed, {} Skipped).  ETA {}'.format(
+            self.done + self.failed, self.total, round(rate, 1), self.failed, self.skipped, eta))
+
+    def run(self, progress_interval=10):
+
+        if not self.total:
+            print('Nothing To Rehash')
+            return
+
+        started = last_progress = time.time()
+        handled = 0
+        pending = deque()
+        cursor = None
+
+        initargs = (self.config.download_threads, self.config.download_timeout,
+                    self.config.max_image_size * 1024 * 1024)
+        with Pool(processes=self.processes, initializer=init_worker, initargs=initargs) as pool:
+
+            def collect():
+                nonlocal cursor, handled
+                batch_cursor, result, skipped = pending.popleft()
+                self.skipped += skipped
+                for update in result.get() if result else []:
+                    if update:
+                        self.updates.append(update)
+                        self.done += 1
+                    else:
+                        self.failed += 1
+                    handled += 1
+                cursor = batch_cursor
+                if len(self.updates) >= self.write_size:
+                    self._write(cursor)
+
+            for batch_cursor, batch, skipped in self._batches():
+                args = (batch, self.hash_keys, self.config.reduced_decode, self.config.gif_frames or 8)
+                result = pool.apply_async(rehash_batch, args) if batch else None
+                pending.append((batch_cursor, result, skipped))
+
+                if len(pending) >= self.processes * 2:
+                    collect()
+
+                if self.max_rate:
+                    # Sleep off any time we're ahead of the allowed rate
+                    time.sleep(max(handled / self.max_rate - (time.time() - started), 0))
+
+                if time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    self._progress(started, handled)
+
+            while pending:
+                collect()
+
+        if cursor is not None:
+            self._write(cursor)
+        self._progress(started, handled)
+        print('Rehash Complete.  Delete The Hash Snapshot And Restart The Bot To Load The New Hashes')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-hash the images of existing database rows')
+    parser.add_argument('--columns', default=','.join(DHASH_KEYS),
+                        help='Comma separated columns to regenerate from {}.  Defaults to the dhash columns'.format(
+                            ', '.join(COLUMNS)))
+    parser.add_argument('--only-missing', action='store_true', help='Only rows missing one of the columns')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes.  Defaults to half the cores')
+    parser.add_argument('--write-size', type=int, default=500, help='Rows per bulk update')
+    parser.add_argument('--max-rate', type=float, default=0, help='Max rows per second.  0 is unlimited')
+    parser.add_argument('--checkpoint', default=os.path.join(os.getcwd(), 'rehash_checkpoint.json'))
+    args = parser.parse_args()
+
+    hash_keys = [c.strip() for c in args.columns.split(',') if c.strip()]
+    invalid = [k for k in hash_keys if k not in COLUMNS]
+    if invalid or not hash_keys:
+        parser.error('--columns must be from {}'.format(', '.join(COLUMNS)))
+
+    config = ConfigManager()
+    try:
+        migration = RehashMigration(config, hash_keys, args.checkpoint, args.processes, args.write_size,
+                                    args.max_rate, args.only_missing)
+    except ValueError as e:
+        parser.error(str(e))
+    migration.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import threading
+import time
+
+from Metrics import metrics
+
+# Highest priority first
+PRIORITIES = ('live', 'retry', 'backfill')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler():
+    """
+    Token bucket that every Imgur API request has to take a token from.
+
+    The refill rate is worked out from the rate limit headers imgurpython stores in client.credits after every
+    response, so no extra requests are spent checking credits.  Remaining credits are spread evenly over the time left
+    until they reset, but never faster than one request every MinTimeBetweenRequests.
+
+    Tokens are handed out by priority.  Live polling always goes first, then retries of failed votes and comments, then
+    backfill.  A lower priority never takes a token while a higher priority is waiting, and retries and backfill leave
+    tokens in the bucket for the priorities above them, so backfill only uses spare budget.
+    """
+
+    BUCKET_SIZE = 10
+    RESET_BUFFER = 240  # Seconds.  Plan to run out this long before the credits reset so we don't cut it so close
+    RATE_LIMIT_PAUSE = 60  # Seconds to stop handing out tokens after Imgur returns a 429
+
+    def __init__(self, client, config):
+
+        self.client = client
+        self.config = config
+        self.condition = threading.Condition()
+        self.tokens = 1.0
+        self.rate = self._fallback_rate()  # Tokens per second.  Lowered once the credit headers have been seen
+        self.last_refill = time.time()
+        self.last_backfill = 0
+        self.paused_until = 0
+        self.credits_remaining = None
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.granted = {priority: 0 for priority in PRIORITIES}
+        self.update_credits()
+
+    def update_credits(self):
+        """
+        Work out the refill rate from the credit headers of the last response
+        """
+
+        credits = self.client.credits or {}
+        client_remaining = _to_int(credits.get('ClientRemaining'))
+        user_remaining = _to_int(credits.get('UserRemaining'))
+        reset = _to_int(credits.get('UserReset'))
+
+        # API fails to return these at times.  Keep the last rate, which is the fallback until they've been seen
+        if client_remaining is None or reset is None:
+            return
+
+        # Imgur API sometimes returns 12500 credits remaining in error.  If this happens keep the last rate.
+        # Otherwise the rate jumps and can cause premature credit exhaustion
+        if self.credits_remaining is not None and client_remaining - self.credits_remaining > 100 and \
+                time.time() < reset:
+            return
+
+        self.credits_remaining = client_remaining
+        remaining = client_remaining if user_remaining is None else min(client_remaining, user_remaining)
+        seconds = reset + self.RESET_BUFFER - time.time()
+
+        if seconds <= 0:
+            # Credits have reset but we haven't seen a response since.  Trickle tokens until we do
+            self.rate = self._fallback_rate()
+        else:
+            self.rate = min(max(remaining - self.BUCKET_SIZE, 0) / seconds, self._fallback_rate())
+
+    def _fallback_rate(self):
+        """
+        One request every MinTimeBetweenRequests.  Used while the credits are unknown and the most ever used after
+        """
+        return 1 / max(self.config.min_time_between_requests, 1)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.BUCKET_SIZE, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _reserve(self, priority):
+        """
+        Tokens that must be left in the bucket after this priority takes one.  One for each priority above it
+        """
+        return PRIORITIES.index(priority)
+
+    def _can_take(self, priority, cost):
+
+        if time.time() < self.paused_until:
+            return False
+
+        if any(self.waiting[p] for p in PRIORITIES[:PRIORITIES.index(priority)]):
+            return False
+
+        if priority == 'backfill':
+            # BackfillRequestDivider = 2 lets backfill request twice as often as MinTimeBetweenRequests
+            spacing = self.config.min_time_between_requests / max(self.config.backfill_request_divider, 1)
+            if time.time() - self.last_backfill < spacing:
+                return False
+
+        return self.tokens >= cost + self._reserve(priority)
+
+    def _wait_time(self, priority, cost):
+        """
+        Seconds until a token could be available.  Capped so waiters re-check after credit updates
+        """
+        waits = [1.0]
+        if self.rate:
+            waits.append((cost + self._reserve(priority) - self.tokens) / self.rate)
+        return max(min(waits), 0.05)
+
+    def acquire(self, priority, cost=1, timeout=None):
+        """
+        Take a token for a request.  Blocks until one is free for the provided priority
+        :param priority: live, retry or backfill
+        :param cost: Credits the request uses
+        :param timeout: Max seconds to wait.  None waits forever, 0 only takes a token if one is free right now
+        :return: True if a token was taken
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self.update_credits()
+                    self._refill()
+                    if self._can_take(priority, cost):
+                        self.tokens -= cost
+                        self.granted[priority] += 1
+                        if priority == 'backfill':
+                            self.last_backfill = time.time()
+                        metrics.inc('repostbot_api_requests_total', priority=priority)
+                        return True
+
+                    wait = self._wait_time(priority, cost)
+                    if deadline is not None:
+                        if time.time() >= deadline:
+                            return False
+                        wait = min(wait, deadline - time.time())
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def rate_limited(self):
+        """
+        Imgur returned a rate limit error.  Empty the bucket and stop handing out tokens for a while
+        """
+        with self.condition:
+            self.tokens = 0
+            self.paused_until = time.time() + self.RATE_LIMIT_PAUSE
@@ -0,0 +1,63 @@
+import sys
+import threading
+
+
+class SeenRegistry():
+    """
+    Registry of every image ID we have already processed.  Backed by a hash set so lookups stay constant time no
+    matter how many images are in the database.
+
+    Shared by the live and backfill threads.  add() checks and marks an ID in one step so two threads that see the same
+    gallery item can't both process it.
+    """
+
+    def __init__(self, image_ids=None):
+
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._id_bytes = 0  # Running total of the size of the stored ID strings
+        if image_ids:
+            self.update(image_ids)
+
+    def __contains__(self, image_id):
+        return image_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, image_id):
+        """
+        Mark an image ID as seen.
+        :return: True if the ID was new, False if it had already been seen
+        """
+        with self._lock:
+            if image_id in self._ids:
+                return False
+            self._ids.add(image_id)
+            self._id_bytes += sys.getsizeof(image_id)
+            return True
+
+    def update(self, image_ids):
+        """
+        Mark many image IDs as seen.  Used when loading existing records
+        """
+        with self._lock:
+            for image_id in image_ids:
+                if image_id not in self._ids:
+                    self._ids.add(image_id)
+                    self._id_bytes += sys.getsizeof(image_id)
+
+    def discard(self, image_id):
+        """
+        Forget an image ID.  Used when processing fails so the image is tried again later
+        """
+        with self._lock:
+            if image_id in self._ids:
+                self._ids.discard(image_id)
+                self._id_bytes -= sys.getsizeof(image_id)
+
+    def memory_usage(self):
+        """
+        Approximate memory used by the registry in bytes.  The set table plus the ID strings it holds
+        """
+        return sys.getsizeof(self._ids) + self._id_bytes
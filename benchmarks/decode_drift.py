@@ -0,0 +1,109 @@
+"""
+Measure how often reduced resolution decoding (ReducedDecode in bot.ini) changes image hashes compared to a full decode.
+
+Usage:
+    python benchmarks/decode_drift.py --images /path/to/images
+    python benchmarks/decode_drift.py --synthetic 200
+
+Prints a JSON report with, for each hash size made from a reduced decode, the fraction of images whose hash changed
+and the bit distance between the full and reduced hashes, plus the average time per image for each decode mode and
+how many times faster the reduced decode is, overall and per image format.  --margin tries a different
+REDUCED_DECODE_MARGIN.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Dhash
+from HashAlgorithms import hash_multi
+from synthetic import directory_images, synthetic_images
+
+# Only sizes that can be made from a reduced decode are compared
+HASH_SIZES = tuple(size for size in (8, 16, 32) if size <= Dhash.REDUCED_DECODE_HASH_SIZE)
+
+
+def bit_distance(hex_a, hex_b):
+    return bin(int(hex_a, 16) ^ int(hex_b, 16)).count('1')
+
+
+def measure(images):
+
+    distances = {size: [] for size in HASH_SIZES}
+    timings = {}  # {image format: {decode mode: seconds}}
+    counts = {}  # {image format: images}
+
+    for name, data in images:
+        results = {}
+        seconds = {}
+        for mode, reduced in (('full', False), ('reduced', True)):
+            try:
+                img = Image.open(BytesIO(data))
+            except OSError:
+                break
+            start = time.perf_counter()
+            # Same call the bot's generate_hash makes
+            results[mode] = (hash_multi(img, ('dhash',), HASH_SIZES, reduced) or {}).get('dhash')
+            seconds[mode] = time.perf_counter() - start
+
+        if not results.get('full') or not results.get('reduced'):
+            continue
+
+        image_format = img.format or 'unknown'
+        counts[image_format] = counts.get(image_format, 0) + 1
+        for mode, elapsed in seconds.items():
+            timings.setdefault(image_format, {}).setdefault(mode, 0.0)
+            timings[image_format][mode] += elapsed
+        for size in HASH_SIZES:
+            distances[size].append(bit_distance(results['full'][size][0], results['reduced'][size][0]))
+
+    checked = sum(counts.values())
+    report = {'images': checked, 'hashes': {}}
+    if not checked:
+        return report
+
+    for size in HASH_SIZES:
+        values = np.array(distances[size])
+        report['hashes']['hash{}'.format(size * size // 4)] = {
+            'bits': size * size,
+            'changed_fraction': round(float((values > 0).mean()), 4),
+            'mean_bit_distance': round(float(values.mean()), 3),
+            'p95_bit_distance': round(float(np.percentile(values, 95)), 1),
+            'max_bit_distance': int(values.max())
+        }
+
+    totals = {mode: sum(t[mode] for t in timings.values()) for mode in ('full', 'reduced')}
+    report['ms_per_image'] = {mode: round(total / checked * 1000, 2) for mode, total in totals.items()}
+    report['speedup'] = round(totals['full'] / totals['reduced'], 2)
+    report['formats'] = {image_format: {
+        'images': counts[image_format],
+        'ms_per_image': {mode: round(t[mode] / counts[image_format] * 1000, 2) for mode in ('full', 'reduced')},
+        'speedup': round(t['full'] / t['reduced'], 2)
+    } for image_format, t in timings.items()}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full and reduced resolution decode hashes')
+    parser.add_argument('--images', help='Directory of images to check')
+    parser.add_argument('--synthetic', type=int, default=100, help='Number of synthetic images if --images is not set')
+    parser.add_argument('--margin', type=int, default=Dhash.REDUCED_DECODE_MARGIN,
+                        help='Times larger than the hash grid to decode at')
+    args = parser.parse_args()
+
+    Dhash.REDUCED_DECODE_MARGIN = args.margin
+
+    images = directory_images(args.images) if args.images else synthetic_images(args.synthetic)
+    print(json.dumps(measure(images), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Compare the hash algorithms (HashAlgorithm in bot.ini) on compute cost and match quality over the same images.
+
+Usage:
+    python benchmarks/hash_algorithms.py --images /path/to/images
+    python benchmarks/hash_algorithms.py --synthetic 100 --output algorithms.json
+
+Every image is hashed with each algorithm and size.  Cost is the average time per image to hash the decoded image,
+reported along with the decode time shared by all of them.
+
+For match quality each image is also edited the way reposts usually are (downscaled, recompressed, cropped and
+brightened).  The distance between an image and its edits should be under the cutoff (recall) and the distance between
+two different images should not (false positive rate).  Both are reported at a range of cutoffs given as a fraction of
+the hash bits, along with the highest recall reachable with no false positives.  HammingCutoff works the same way, a
+match is anything under the cutoff.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from HashAlgorithms import ALGORITHMS, HASH_KEY_SIZES, hash_key, hash_multi, parse_hash_key
+from synthetic import directory_images, synthetic_images
+
+
+def _reencode(image, image_format='JPEG', **kwargs):
+    buffer = BytesIO()
+    image.convert('RGB').save(buffer, image_format, **kwargs)
+    return Image.open(BytesIO(buffer.getvalue()))
+
+
+def _crop(image, fraction=0.05):
+    width, height = image.size
+    x, y = int(width * fraction), int(height * fraction)
+    return image.crop((x, y, width - x, height - y))
+
+
+# Edits made to each image to build the near duplicates.  Each takes and returns a decoded RGB image
+TRANSFORMS = {
+    'downscale': lambda image: image.resize((max(image.width // 2, 1), max(image.height // 2, 1)), Image.LANCZOS),
+    'recompress': lambda image: image,  # The re-encode below is the edit
+    'crop': _crop,
+    'brighten': lambda image: ImageEnhance.Brightness(image).enhance(1.2)
+}
+TRANSFORM_QUALITY = {'recompress': 40}  # JPEG quality per transform.  Others are saved at 90
+
+
+def bit_distance(hex_a, hex_b):
+    return bin(int(hex_a, 16) ^ int(hex_b, 16)).count('1')
+
+
+def hash_image(image, grids):
+    """
+    :return: {hash_key: hex hash} for every algorithm and size or None if the image can't be hashed
+    """
+    hashes = hash_multi(image, tuple(ALGORITHMS), grids)
+    if not hashes:
+        return None
+    return {hash_key(a, size): hashes[a][grid][0] for a in ALGORITHMS for size, grid in HASH_KEY_SIZES.items()}
+
+
+def measure_cost(image, grids):
+    """
+    Time each algorithm and size on its own against one decode of the image
+    :return: Tuple of ({hash_key: seconds}, decode seconds)
+    """
+    timings = {}
+    costs = {}
+    decode = None
+    for algorithm in ALGORITHMS:
+        for size, grid in HASH_KEY_SIZES.items():
+            if not hash_multi(image, (algorithm,), (grid,), timings=timings):
+                return None, None
+            costs[hash_key(algorithm, size)] = timings['hash']
+            # Only the first call reads the file.  Later ones reuse the loaded pixels
+            decode = timings['decode'] if decode is None else decode
+    return costs, decode
+
+
+def measure(images, cutoff_fractions, negative_pairs, seed=0):
+
+    grids = tuple(HASH_KEY_SIZES.values())
+    keys = [hash_key(a, size) for a in ALGORITHMS for size in HASH_KEY_SIZES]
+    costs = {key: 0.0 for key in keys}
+    decode = 0.0
+    originals = []  # {hash_key: hex} per image
+    positives = {key: {name: [] for name in TRANSFORMS} for key in keys}
+
+    for name, data in images:
+        try:
+            image = Image.open(BytesIO(data))
+            cost, decode_time = measure_cost(image, grids)
+            if cost is None:
+                continue
+            original = hash_image(Image.open(BytesIO(data)), grids)
+            rgb = Image.open(BytesIO(data)).convert('RGB')
+        except OSError:
+            continue
+        if not original:
+            continue
+
+        variants = {}
+        for transform, edit in TRANSFORMS.items():
+            variant = hash_image(_reencode(edit(rgb), quality=TRANSFORM_QUALITY.get(transform, 90)), grids)
+            if not variant:
+                break
+            variants[transform] = variant
+        if len(variants) != len(TRANSFORMS):
+            continue
+
+        originals.append(original)
+        decode += decode_time
+        for key in keys:
+            costs[key] += cost[key]
+            for transform, variant in variants.items():
+                positives[key][transform].append(bit_distance(original[key], variant[key]))
+
+    report = {'images': len(originals), 'hashes': {}}
+    if len(originals) < 2:
+        return report
+
+    # Pairs of different images.  All of them when there aren't too many
+    rng = np.random.default_rng(seed)
+    count = len(originals)
+    if count * (count - 1) // 2 <= negative_pairs:
+        pairs = [(a, b) for a in range(count) for b in range(a + 1, count)]
+    else:
+        pairs = {tuple(sorted(rng.choice(count, 2, replace=False))) for i in range(negative_pairs)}
+    report['negative_pairs'] = len(pairs)
+
+    for key in keys:
+        bits = parse_hash_key(key)[1] ** 2
+        same = np.array([d for distances in positives[key].values() for d in distances])
+        different = np.array([bit_distance(originals[a][key], originals[b][key]) for a, b in pairs])
+
+        at_cutoff = {}
+        for fraction in cutoff_fractions:
+            cutoff = max(int(round(bits * fraction)), 1)
+            at_cutoff[str(cutoff)] = {
+                'recall': round(float((same < cutoff).mean()), 4),
+                'false_positive_rate': round(float((different < cutoff).mean()), 4)
+            }
+
+        # Largest cutoff that still doesn't flag any pair of different images
+        safe_cutoff = int(different.min()) if len(different) else bits
+        report['hashes'][key] = {
+            'bits': bits,
+            'ms_per_image': round(costs[key] / len(originals) * 1000, 3),
+            'mean_distance': {transform: round(float(np.mean(d)), 2) for transform, d in positives[key].items()},
+            'mean_distance_different': round(float(different.mean()), 2),
+            'cutoffs': at_cutoff,
+            'no_false_positive_cutoff': safe_cutoff,
+            'recall_at_no_false_positive_cutoff': round(float((same < safe_cutoff).mean()), 4)
+        }
+
+    report['decode_ms_per_image'] = round(decode / len(originals) * 1000, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare hash algorithms on cost and match quality')
+    parser.add_argument('--images', help='Directory of images to check')
+    parser.add_argument('--synthetic', type=int, default=100, help='Number of synthetic images if --images is not set')
+    parser.add_argument('--cutoffs', default='0.02,0.05,0.1,0.15,0.2,0.25',
+                        help='Comma separated cutoffs as a fraction of the hash bits')
+    parser.add_argument('--negative-pairs', type=int, default=20000, help='Max pairs of different images to compare')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    images = directory_images(args.images) if args.images else synthetic_images(args.synthetic, args.seed)
+    start = time.time()
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'seed': args.seed
+    }
+    report.update(measure(images, [float(c) for c in args.cutoffs.split(',')], args.negative_pairs, args.seed))
+    report['seconds'] = round(time.time() - start, 1)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
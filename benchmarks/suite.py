@@ -0,0 +1,316 @@
+"""
+Benchmark hashing, repost matching and database ingestion against a synthetic corpus.
+
+Usage:
+    python benchmarks/suite.py
+    python benchmarks/suite.py --records 10000,1000000 --output results.json
+    python benchmarks/suite.py --skip hash,db
+
+Hash throughput is measured per image size and format for both full and reduced decode.  Match latency is measured
+for each hash size at each corpus size.  Every corpus has near duplicates planted at known bit distances so the
+report also shows whether each one was found.  Database insert and load throughput is measured against a local
+SQLite database through ImgurRepostDB's normal write buffer and streaming load.
+
+Results are printed as JSON (or written to --output) so runs can be compared.  The 10M record corpus needs around
+1.5 GB of memory for hash256.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from HashAlgorithms import DHASH_KEYS, HASH_KEY_SIZES, hash_multi
+from HashIndex import BKTree
+from HashMatrix import BandedHashMatrix, SharedHashMatrix, WORDS_PER_HASH
+from ImgurHashProcessing import HashProcessing
+from ImgurRepostDB import ImgurRepostDB
+from synthetic import IMAGE_FORMATS, synthetic_image
+
+IMAGE_SIZES = {'small': (320, 240), 'medium': (1280, 960), 'large': (3000, 2000)}
+NEAR_DUPLICATE_DISTANCES = (0, 1, 2, 4, 8, 16)
+
+
+def flip_bits(hash_words, distance, rng):
+    """
+    Copy of a packed hash with exactly distance bits flipped
+    """
+    flipped = hash_words.copy()
+    for bit in rng.choice(len(hash_words) * 64, size=distance, replace=False):
+        flipped[bit // 64] ^= np.uint64(1) << np.uint64(bit % 64)
+    return flipped
+
+
+def words_to_hex(hash_words):
+    return hash_words.astype('>u8').tobytes().hex()
+
+
+def synthetic_hash_corpus(records, hash_key, rng, distances=NEAR_DUPLICATE_DISTANCES):
+    """
+    Random packed hashes with near duplicate queries planted at known distances
+    :param records: Number of hashes in the corpus
+    :param hash_key: hash16, hash64 or hash256
+    :param distances: Bit distance of each planted query from its original
+    :return: Tuple of (uint64 matrix, [(query words, original row, distance)])
+    """
+    hashes = rng.integers(0, np.iinfo(np.uint64).max, size=(records, WORDS_PER_HASH[hash_key]), dtype=np.uint64,
+                          endpoint=True)
+    originals = rng.choice(records, size=len(distances), replace=False)
+    queries = [(flip_bits(hashes[row], distance, rng), int(row), distance)
+               for row, distance in zip(originals, distances)]
+    return hashes, queries
+
+
+def synthetic_records(count, rng):
+    """
+    Records shaped like the ones built in insert_latest_images
+    """
+    records = []
+    for i in range(count):
+        hashes = {hash_key: words_to_hex(rng.integers(0, np.iinfo(np.uint64).max, size=WORDS_PER_HASH[hash_key],
+                                                      dtype=np.uint64, endpoint=True))
+                  for hash_key in DHASH_KEYS}
+        records.append({
+            'image_id': 'bench{}'.format(i),
+            'url': 'https://i.imgur.com/bench{}.jpg'.format(i),
+            'gallery_url': 'https://imgur.com/gallery/bench{}'.format(i),
+            'user': 'user{}'.format(i % 1000),
+            'submitted': int(time.time()) - i,
+            'hash16': hashes['hash16'],
+            'hash64': hashes['hash64'],
+            'hash256': hashes['hash256']
+        })
+    return records
+
+
+def bench_hashing(images_per_case, rng):
+    """
+    Images per second through hash_multi, as called by the bot's generate_hash, for each image size, format and decode
+    mode
+    """
+
+    results = []
+    for size_name, (width, height) in IMAGE_SIZES.items():
+        for image_format in IMAGE_FORMATS:
+            images = [synthetic_image(width, height, image_format, rng) for i in range(images_per_case)]
+            for mode, reduced in (('full', False), ('reduced', True)):
+                start = time.perf_counter()
+                for data in images:
+                    hash_multi(Image.open(BytesIO(data)), ('dhash',), tuple(HASH_KEY_SIZES.values()), reduced)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    'size': size_name,
+                    'width': width,
+                    'height': height,
+                    'format': image_format,
+                    'decode': mode,
+                    'images': images_per_case,
+                    'ms_per_image': round(elapsed / images_per_case * 1000, 3),
+                    'images_per_second': round(images_per_case / elapsed, 1)
+                })
+    return results
+
+
+def bench_matching(record_counts, hash_cutoff, queries_per_case, bktree_max, rng):
+    """
+    Latency of a single repost check for each hash size and corpus size.  Runs the same function the process pool
+    does against a shared memory matrix, the banded matrix searched by the Banded engine, plus the BK-tree for corpora
+    up to bktree_max records
+    """
+
+    results = []
+    for records in record_counts:
+        for hash_key in DHASH_KEYS:
+            words = WORDS_PER_HASH[hash_key]
+            hashes, planted = synthetic_hash_corpus(records, hash_key, rng)
+            cutoff = hash_cutoff[hash_key]
+
+            matrix = SharedHashMatrix(hash_key, capacity=records)
+            matrix.extend(hashes, range(records))
+            segment_name, rows = matrix.acquire()
+
+            def matrix_check(query):
+                return HashProcessing._repost_checker_proc(segment_name, words, rows, query, cutoff - 1)
+
+            banded = BandedHashMatrix(hash_key, cutoff - 1, capacity=records)
+            banded.extend(hashes, range(records))
+
+            engines = {'matrix': matrix_check, 'banded': lambda query: banded.search(query, cutoff - 1)}
+
+            if records <= bktree_max:
+                tree = BKTree()
+                for row in range(records):
+                    tree.add(int(words_to_hex(hashes[row]), 16), row)
+                engines['bktree'] = lambda query: [r for d, r in tree.search(int(words_to_hex(query), 16), cutoff - 1)]
+
+            random_queries = [rng.integers(0, np.iinfo(np.uint64).max, size=words, dtype=np.uint64, endpoint=True)
+                              for i in range(queries_per_case)]
+
+            for engine, check in engines.items():
+                check(random_queries[0])  # Attach to the segment outside the timings
+
+                latencies = []
+                for query in random_queries:
+                    start = time.perf_counter()
+                    check(query)
+                    latencies.append(time.perf_counter() - start)
+
+                near_duplicates = []
+                for query, row, distance in planted:
+                    found = row in set(int(r) for r in check(query))
+                    near_duplicates.append({'distance': distance, 'found': found,
+                                            'expected': distance < cutoff})
+
+                latencies = np.array(latencies) * 1000
+                results.append({
+                    'engine': engine,
+                    'hash': hash_key,
+                    'records': records,
+                    'hamming_cutoff': cutoff,
+                    'queries': queries_per_case,
+                    'mean_ms': round(float(latencies.mean()), 3),
+                    'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+                    'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+                    'near_duplicates': near_duplicates
+                })
+
+            matrix.release(segment_name)
+            matrix.close()
+    return results
+
+
+class BenchmarkConfig():
+    """
+    Just the settings ImgurRepostDB reads
+    """
+
+    def __init__(self, flush_size, chunk_size):
+        self.database_details = {'storage': 'mysql'}
+        self.db_flush_size = flush_size
+        self.db_flush_interval = 3600
+        self.load_chunk_size = chunk_size
+
+
+class SQLiteRepostDB(ImgurRepostDB):
+    """
+    ImgurRepostDB pointed at a local SQLite file instead of MySQL
+    """
+
+    def __init__(self, config, path):
+        self.path = path
+        super().__init__(config)
+
+    def _setup_mysql(self):
+        from sqlalchemy import create_engine, text
+        from sqlalchemy.ext.automap import automap_base
+        from sqlalchemy.orm import scoped_session, sessionmaker
+
+        engine = create_engine('sqlite:///{}'.format(self.path))
+        with engine.begin() as conn:
+            conn.execute(text('CREATE TABLE imgur_reposts (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                              'image_id VARCHAR(100), date DATETIME, url TEXT, hash VARCHAR(16), hash64 VARCHAR(64), '
+                              'hash256 VARCHAR(256), user VARCHAR(100), submitted_to_imgur INTEGER)'))
+
+        Base = automap_base()
+        Base.prepare(autoload_with=engine)
+        self.engine = engine
+        self.imgur_reposts = Base.classes.imgur_reposts
+        self.Session = scoped_session(sessionmaker(bind=engine))
+
+
+def bench_database(record_count, flush_size, chunk_size, rng):
+    """
+    Insert throughput through the write buffer and load throughput through the streaming loader
+    """
+
+    records = synthetic_records(record_count, rng)
+
+    # Flush messages go to stderr so stdout stays valid JSON
+    with tempfile.TemporaryDirectory() as path, contextlib.redirect_stdout(sys.stderr):
+        db = SQLiteRepostDB(BenchmarkConfig(flush_size, chunk_size), os.path.join(path, 'bench.db'))
+
+        start = time.perf_counter()
+        for record in records:
+            db.add_entry(record)
+        db.flush()
+        insert_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = sum(len(chunk) for chunk in db.stream_records())
+        load_seconds = time.perf_counter() - start
+
+        db.engine.dispose()
+
+    return {
+        'backend': 'sqlite',
+        'records': record_count,
+        'flush_size': flush_size,
+        'load_chunk_size': chunk_size,
+        'inserted': db.total_flushed,
+        'insert_records_per_second': round(record_count / insert_seconds, 1),
+        'loaded': loaded,
+        'load_records_per_second': round(loaded / load_seconds, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hashing, matching and database ingestion')
+    parser.add_argument('--records', default='10000,1000000,10000000',
+                        help='Comma separated corpus sizes for the match benchmark')
+    parser.add_argument('--queries', type=int, default=20, help='Checks timed per corpus size and hash size')
+    parser.add_argument('--cutoffs', default='10,30,100', help='Hamming cutoff for hash16, hash64 and hash256')
+    parser.add_argument('--bktree-max', type=int, default=100000,
+                        help='Largest corpus to build a BK-tree for.  Building one in Python is slow')
+    parser.add_argument('--images', type=int, default=5, help='Images per size and format for the hash benchmark')
+    parser.add_argument('--db-records', type=int, default=20000, help='Records inserted for the database benchmark')
+    parser.add_argument('--db-flush-size', type=int, default=50, help='DBFlushSize used for the database benchmark')
+    parser.add_argument('--db-chunk-size', type=int, default=10000,
+                        help='LoadChunkSize used for the database benchmark')
+    parser.add_argument('--skip', default='', help='Comma separated sections to skip.  hash, match or db')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here instead of printing it')
+    args = parser.parse_args()
+
+    skip = set(s.strip() for s in args.skip.split(',') if s.strip())
+    rng = np.random.default_rng(args.seed)
+
+    report = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'seed': args.seed
+    }
+
+    if 'hash' not in skip:
+        report['hashing'] = bench_hashing(args.images, rng)
+
+    if 'match' not in skip:
+        cutoffs = dict(zip(DHASH_KEYS, (int(c) for c in args.cutoffs.split(','))))
+        record_counts = [int(r) for r in args.records.split(',')]
+        report['matching'] = bench_matching(record_counts, cutoffs, args.queries, args.bktree_max, rng)
+
+    if 'db' not in skip:
+        report['database'] = bench_database(args.db_records, args.db_flush_size, args.db_chunk_size, rng)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
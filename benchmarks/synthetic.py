@@ -0,0 +1,53 @@
+"""
+Test images shared by the benchmarks.
+"""
+
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF')
+
+
+def synthetic_image(width, height, image_format, rng):
+    """
+    Photo like test image.  A smooth gradient with a few solid shapes
+    :return: Encoded image bytes
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    channels = []
+    for c in range(3):
+        angle = rng.random() * np.pi
+        channels.append((np.cos(angle) * x / width + np.sin(angle) * y / height) * 127 + rng.random() * 128)
+    pixels = np.stack(channels, axis=-1)
+
+    for s in range(int(rng.integers(2, 6))):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        shape_height, shape_width = int(rng.integers(20, height // 2)), int(rng.integers(20, width // 2))
+        pixels[y0:y0 + shape_height, x0:x0 + shape_width] = rng.random(3) * 255
+
+    buffer = BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def synthetic_images(count, seed=0):
+    """
+    Yield (name, image bytes) for count synthetic images of random sizes, saved in a mix of formats
+    """
+    rng = np.random.default_rng(seed)
+
+    for i in range(count):
+        width, height = int(rng.integers(640, 4000)), int(rng.integers(480, 3000))
+        image_format = IMAGE_FORMATS[i % len(IMAGE_FORMATS)]
+        yield 'synthetic_{}.{}'.format(i, image_format.lower()), synthetic_image(width, height, image_format, rng)
+
+
+def directory_images(path):
+    for name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, name)
+        if os.path.isfile(full_path):
+            with open(full_path, 'rb') as f:
+                yield name, f.read()
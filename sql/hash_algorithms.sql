@@ -0,0 +1,11 @@
+-- Columns for the extra hash algorithms (HashAlgorithms in bot.ini).  Only needed for the algorithms you enable.
+-- Existing rows can be filled in with: python RehashMigration.py --columns phash16,phash64,phash256 --only-missing
+USE `imgur_repost`;
+
+ALTER TABLE `imgur_reposts`
+  ADD COLUMN `phash16` varchar(16) NULL DEFAULT NULL,
+  ADD COLUMN `phash64` varchar(64) NULL DEFAULT NULL,
+  ADD COLUMN `phash256` varchar(256) NULL DEFAULT NULL,
+  ADD COLUMN `ahash16` varchar(16) NULL DEFAULT NULL,
+  ADD COLUMN `ahash64` varchar(64) NULL DEFAULT NULL,
+  ADD COLUMN `ahash256` varchar(256) NULL DEFAULT NULL;